@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Multipliers to nM, keys are lower case units with micro sign variants folded to "u"
+UNIT_TO_NM = {
+    "fm": 1e-6,
+    "pm": 1e-3,
+    "nm": 1.0,
+    "um": 1e3,
+    "mm": 1e6,
+    "m": 1e9,
+}
+
+QUALIFIERS = {
+    "<": "<",
+    ">": ">",
+    "<=": "<=",
+    ">=": ">=",
+    "≤": "<=",
+    "≥": ">=",
+    "=<": "<=",
+    "=>": ">=",
+    "~": "~",
+    "≈": "~",
+    "ca.": "~",
+    "approx.": "~",
+    "=": "=",
+}
+
+
+def number_pattern(name: str) -> str:
+    """
+    Non-negative decimal number with optional exponent as 1.2e-3, 1.2 x 10^-3
+    or 1.2×10-3, a leading minus does not match as constants are never negative
+    """
+    return (
+        rf"(?P<{name}>\+?(?:\d+(?:\.\d*)?|\.\d+))"
+        + rf"(?:\s*[eE]\s*(?P<{name}_e>[+-]?\d+)"
+        + rf"|\s*[x×*]\s*10\s*(?:\^|\*\*)?\s*(?P<{name}_p>[+-]?\d+))?"
+    )
+
+
+QUALIFIER_PATTERN = "|".join(
+    q.replace(".", r"\.") for q in sorted(QUALIFIERS, key=len, reverse=True)
+)
+
+# RE2 syntax, as used by pyarrow
+AFFINITY_PATTERN = (
+    rf"(?i)^(?P<qualifier>{QUALIFIER_PATTERN})?\s*"
+    + number_pattern("low")
+    + r"\s*(?P<low_unit>[fpnuµμm]?m)?"
+    + rf"(?:\s*(?:-|–|—|to)\s*{number_pattern('high')})?"
+    + r"(?:\s*±\s*[\d.]+)?"
+    + r"\s*(?P<unit>[fpnuµμm]?m)?$"
+)
+
+
+def to_number(parts: pa.StructArray, name: str) -> np.ndarray:
+    """Mantissa times ten to the exponent of a number_pattern match"""
+    # Groups that did not participate in a match are empty strings
+    exponent_e, exponent_p = parts.field(f"{name}_e"), parts.field(f"{name}_p")
+    exponent = pc.if_else(pc.equal(exponent_e, ""), exponent_p, exponent_e)
+    exponent = pc.if_else(pc.equal(exponent, ""), "0", exponent)
+    mantissa = pc.if_else(pc.equal(parts.field(name), ""), None, parts.field(name))
+    mantissa = pc.cast(mantissa, pa.float64()).to_numpy(zero_copy_only=False)
+    exponent = pc.cast(exponent, pa.float64()).to_numpy(zero_copy_only=False)
+    return mantissa * 10.0**exponent
+
+
+def lookup(keys: pa.Array, mapping: dict[str, object]) -> np.ndarray:
+    """Map lower cased keys through mapping, unknown and empty keys give None"""
+    indices = pc.index_in(pc.utf8_lower(keys), value_set=pa.array(list(mapping)))
+    indices = pc.fill_null(indices, len(mapping)).to_numpy(zero_copy_only=False)
+    return np.array([*mapping.values(), None], dtype=object)[indices]
+
+
+def unit_multiplier(units: pa.Array) -> np.ndarray:
+    units = pc.replace_substring_regex(units, "[µμ]", "u")
+    return lookup(units, UNIT_TO_NM).astype(float)
+
+
+def parse_affinity(text: pa.Array, default_multiplier: float) -> pd.DataFrame:
+    """Parse cleaned strings, see normalize_affinity"""
+    parts = pc.extract_regex(text, AFFINITY_PATTERN)
+
+    multiplier = unit_multiplier(pc.coalesce(parts.field("unit"), ""))
+    low_unit_multiplier = unit_multiplier(pc.coalesce(parts.field("low_unit"), ""))
+    # Values without units are in the default unit
+    multiplier = np.where(np.isnan(multiplier), default_multiplier, multiplier)
+    # "5 µM - 10 nM": the low bound has its own unit
+    low_multiplier = np.where(
+        np.isnan(low_unit_multiplier), multiplier, low_unit_multiplier
+    )
+
+    low = to_number(parts, "low") * low_multiplier
+    high = to_number(parts, "high") * multiplier
+    is_range = ~np.isnan(high)
+    # Mixed units can reverse the bounds, "5 µM - 10 nM", NaN bounds are ignored
+    low, high = np.fmin(low, high), np.where(is_range, np.fmax(low, high), np.nan)
+
+    with np.errstate(invalid="ignore"):
+        value = np.where(is_range, np.sqrt(low * high), low)
+
+    qualifier = lookup(pc.coalesce(parts.field("qualifier"), ""), QUALIFIERS)
+    qualifier = np.where(pd.isna(qualifier), "=", qualifier)
+    qualifier = np.where(is_range, "range", qualifier).astype(object)
+    qualifier[np.isnan(low)] = None
+
+    return pd.DataFrame(
+        {
+            "value_nM": value,
+            # Kept as object, a string column would turn None into NaN
+            "qualifier": pd.Series(qualifier, dtype=object),
+            "low_nM": np.where(is_range, low, np.nan),
+            "high_nM": np.where(is_range, high, np.nan),
+        }
+    )
+
+
+def normalize_affinity(values: pd.Series, default_unit: str = "nM") -> pd.DataFrame:
+    """
+    Parse binding constants to canonical nM floats
+
+    Handles relation qualifiers (<, >=, ~, ≤, ...), ranges (5-10, 5 to 10 µM),
+    scientific notation (1.2e-3, 1.2 x 10^-3), ± errors, decimal commas (1,5) and
+    fM/pM/nM/µM/mM/M units. Negative values are not parsed.
+    Values without a unit are taken in `default_unit`. Ranges are reported as
+    the geometric mean of their bounds with qualifier "range", bounds are
+    ordered after unit conversion.
+    Each distinct string is parsed once, so repeated values cost a lookup.
+
+    Args:
+        values: Raw constants as written in patents, e.g. "<10", "1.2 μM", "5-10"
+
+    Returns:
+        DataFrame with the index of values and columns value_nM, qualifier,
+        low_nM, high_nM; values that cannot be parsed are NaN with no qualifier
+    """
+    codes, uniques = pd.factorize(values)
+
+    text = pc.cast(pa.array(pd.Series(uniques).astype(str)), pa.string())
+    text = pc.utf8_trim_whitespace(text)
+    text = pc.replace_substring(text, "−", "-")
+    # Thousands separators, twice for numbers over a million
+    for _ in range(2):
+        text = pc.replace_substring_regex(text, r"(\d),(\d{3})(\D|$)", r"\1\2\3")
+    # Remaining commas between digits are decimal commas, "1,5 µM"
+    text = pc.replace_substring_regex(text, r"(\d),(\d)", r"\1.\2")
+
+    default_multiplier = UNIT_TO_NM[default_unit.lower().replace("µ", "u")]
+    parsed = parse_affinity(text, default_multiplier)
+
+    # Missing values have code -1 and get the trailing empty row
+    empty = pd.DataFrame({"value_nM": [np.nan], "qualifier": [None]})
+    parsed = pd.concat([parsed, empty], ignore_index=True)
+    codes = np.where(codes == -1, len(parsed) - 1, codes)
+
+    result = parsed.take(codes)
+    result.index = values.index
+    return result
@@ -1,20 +1,35 @@
+import functools
 import json
-import aiofiles
-from typing import Any, List
+from typing import Any, Awaitable, Callable, List
 from langchain.agents import Tool, initialize_agent, AgentType
 # from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
 import logging
 import os
 import asyncio
+import time
+from contextvars import ContextVar
 from dotenv import load_dotenv
 from pathlib import Path
 
-from parse_pdfs import Patent
-from prot_fasta_parser import get_uniprot_fasta_by_gene
-from smiles_parser import get_smiles_by_name
-
-from config import CHECKPOINTS_FOLDER, AGENT_TIMEOUT
+from parse_pdfs import Chunk, Patent, merge_positive_chunks
+from bulk_resolution import resolve_smiles, resolve_fasta
+from local_compound_index import get_compound_index
+from local_protein_index import get_protein_index
+from serialization import write_json_async
+from structured_extraction import ExtractionError
+from metrics import get_metrics, record_llm_call
+
+from config import (
+    CHECKPOINTS_FOLDER,
+    AGENT_TIMEOUT,
+    EXTRACTION_WORKERS,
+    EXTRACTION_QUEUE_SIZE,
+    MERGE_POSITIVE_CHUNKS,
+    EXTRACTION_SPAN_SIZE,
+    USE_LOCAL_COMPOUND_INDEX,
+    USE_LOCAL_PROTEIN_INDEX,
+)
 
 # Load environment variables
 load_dotenv()
@@ -24,49 +39,69 @@ API_KEY = os.getenv("LLM_API_KEY")
 BASE_URL = os.getenv("LLM_BASE_URL")
 MODEL = os.getenv("MODEL")
 
-MAX_CONCURRENT_CONNECTIONS = 6
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_CONNECTIONS)
+# Patent whose chunk is being processed, visible to tools called by the agent
+current_patent: ContextVar[str | None] = ContextVar("current_patent", default=None)
 
-# Initialize async LLM
-llm = ChatOpenAI(
-    model=MODEL,
-    openai_api_key=API_KEY,
-    openai_api_base=BASE_URL,
-    temperature=0.0,
-    max_tokens=4096, 
-)
+
+@functools.lru_cache(maxsize=None)
+def get_llm() -> ChatOpenAI:
+    """Async LLM client, created on first use and shared by all chunks"""
+    return ChatOpenAI(
+        model=MODEL,
+        openai_api_key=API_KEY,
+        openai_api_base=BASE_URL,
+        temperature=0.0,
+        max_tokens=4096,
+    )
 
 
-# Async versions of tools with concurrency control
+# Async tools, per-host concurrency is limited by the shared HTTP client
 async def smiles_tool(name: str) -> str:
-    async with semaphore:
-        # If get_smiles_by_name is sync, run in thread to prevent blocking
-        result = await asyncio.to_thread(get_smiles_by_name, name)
-        return result or "Not found"
+    result = await resolve_smiles(name, current_patent.get())
+    return result or "Not found"
 
 
 async def uniprot_tool(gene_name: str) -> str:
-    async with semaphore:
-        # If get_uniprot_fasta_by_gene is sync, run in thread to prevent blocking
-        result = await asyncio.to_thread(get_uniprot_fasta_by_gene, gene_name)
-        return result or "Not found"
-
-
-# Define tools using async functions
-tools = [
-    Tool(
-        name="GetSMILES",
-        func=smiles_tool,
-        description="Use this to convert a ligand name into SMILES notation. Returns 'Not found' if unsuccessful.",
-        coroutine=smiles_tool,
-    ),
-    Tool(
-        name="GetFASTA",
-        func=uniprot_tool,
-        description="Use this to convert a protein name into a FASTA amino acid sequence. Returns 'Not found' if unsuccessful.",
-        coroutine=uniprot_tool,
-    ),
-]
+    result = await resolve_fasta(gene_name)
+    return result or "Not found"
+
+
+@functools.lru_cache(maxsize=None)
+def get_tools() -> tuple[Tool, ...]:
+    """Define tools using async functions"""
+    return (
+        Tool(
+            name="GetSMILES",
+            func=smiles_tool,
+            description="Use this to convert a ligand name into SMILES notation. Returns 'Not found' if unsuccessful.",
+            coroutine=smiles_tool,
+        ),
+        Tool(
+            name="GetFASTA",
+            func=uniprot_tool,
+            description="Use this to convert a protein name into a FASTA amino acid sequence. Returns 'Not found' if unsuccessful.",
+            coroutine=uniprot_tool,
+        ),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_agent_executor():
+    """
+    Build the agent once per process
+
+    The agent has no memory, so the same executor is safe to use
+    from concurrent `arun` calls.
+    """
+    logger.info("Initializing extraction agent")
+    return initialize_agent(
+        list(get_tools()),
+        get_llm(),
+        agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
+        # verbose=True,
+        handle_parsing_errors=True,
+    )
+
 
 prompt = """
 You are an expert cheminformatics and pharmacology data extractor. Your task is to analyze patent text and extract structured binding data.
@@ -77,17 +112,17 @@ INSTRUCTIONS:
 1. Identify ligand mentions (chemical names, references to chemical names (this can be 'example', 'compound', etc.))
 2. Determine the ligand name
 3. Determine protein name
-4. Extract binding constants: Ki, IC50, Kd, EC50 (in nM)
+4. Extract binding constants: Ki, IC50, Kd, EC50 with their units and qualifiers
 5. Extract assay description
 6. Use the GetSMILES tool to convert ligand names to SMILES notation
 7. Use the GetFASTA tool to convert protein names to FASTA sequences
 
 RETURN ONLY A VALID JSON OBJECT with these keys:
 
-"Ki_nM": "value or null",
-"IC50_nM": "value or null", 
-"Kd_nM": "value or null",
-"EC50_nM": "value or null",
+"Ki": "value with unit as written (e.g. '<10 nM', '1.2 μM') or null",
+"IC50": "value with unit as written or null", 
+"Kd": "value with unit as written or null",
+"EC50": "value with unit as written or null",
 "assay_description": "brief description of how binding was measured",
 "ligand_name": "identified ligand name",
 "ligand_SMILES": "SMILES notation from GetSMILES tool or null",
@@ -96,7 +131,7 @@ RETURN ONLY A VALID JSON OBJECT with these keys:
 
 CRITICAL RULES:
 - Only extract values that are explicitly stated with units (nM, μM, etc.)
-- Convert units appropriately (1 μM = 1000 nM)
+- Copy values, units, ranges and qualifiers like < or ~ exactly as written, do not convert units
 - Be conservative - only report high confidence data
 - Return ONLY the JSON, no other text
 - DO NOT USE MARKDOWN
@@ -104,20 +139,19 @@ CRITICAL RULES:
 - Use the provided tools when you have identified ligand or protein names
 """
 
-async def process_patent_chunk(chunk_text: str) -> dict[str, Any]:
+async def process_patent_chunk(
+    chunk_text: str, patent_name: str | None = None
+) -> dict[str, Any]:
+    current_patent.set(patent_name)
     try:
-        agent = initialize_agent(
-            tools,
-            llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            # verbose=True,
-            handle_parsing_errors=True,
-        )
+        agent = get_agent_executor()
         f_prompt = prompt.format(text=chunk_text)
+        started = time.perf_counter()
         try:
 
 
             result = await asyncio.wait_for(agent.arun(f_prompt), timeout=AGENT_TIMEOUT)
+            record_llm_call("agent", started, "ok")
             if "action" in result:
                 if result["action"] == "Final Answer":
                     result = result["action_input"]
@@ -125,8 +159,12 @@ async def process_patent_chunk(chunk_text: str) -> dict[str, Any]:
 
 
         except asyncio.TimeoutError:
+            record_llm_call("agent", started, "timeout")
             logger.warning("Agent timed out processing chunk")
-            return {}
+            raise ExtractionError(f"Agent timed out on chunk of {patent_name}")
+        except Exception:
+            record_llm_call("agent", started, "error")
+            raise
         
         # Clean the result
         result = result.strip()
@@ -139,10 +177,10 @@ async def process_patent_chunk(chunk_text: str) -> dict[str, Any]:
         intermediate_data = json.loads(result)
 
         final_output = {
-            "Ki (nM)": intermediate_data.get("Ki_nM"),
-            "IC50 (nM)": intermediate_data.get("IC50_nM"),
-            "Kd (nM)": intermediate_data.get("Kd_nM"),
-            "EC50 (nM)": intermediate_data.get("EC50_nM"),
+            "Ki (nM)": intermediate_data.get("Ki"),
+            "IC50 (nM)": intermediate_data.get("IC50"),
+            "Kd (nM)": intermediate_data.get("Kd"),
+            "EC50 (nM)": intermediate_data.get("EC50"),
             "assay": intermediate_data.get("assay_description", ""),
             "ligand_name": intermediate_data.get("ligand_name"),
             "ligand_SMILES": intermediate_data.get("ligand_SMILES"),
@@ -168,54 +206,302 @@ async def process_patent_chunk(chunk_text: str) -> dict[str, Any]:
             "protein_FASTA": None,
             "raw_result": result,
         }
+    except ExtractionError:
+        raise
     except Exception as e:
         logger.warning(f"Error processing chunk: {e}")
-        return {}
+        raise ExtractionError(f"Agent failed on chunk of {patent_name}: {e}") from e
+
+
+ChunkExtractor = Callable[
+    [str, str | None], Awaitable[dict[str, Any] | list[dict[str, Any]]]
+]
+
+
+def add_provenance(
+    res: dict[str, Any] | list[dict[str, Any]], chunk: Chunk, indx: int
+) -> list[dict[str, Any]]:
+    """
+    Records of a chunk with chunk index and character offsets in patent text
+
+    Offsets point to the quoted evidence if the extractor found it in the chunk,
+    otherwise to the whole chunk.
+    """
+    records = res if isinstance(res, list) else [res]
+    records = [record for record in records if record]
+    for record in records:
+        offsets = record.pop("evidence_offsets", None) or (0, len(chunk.text))
+        record.update(
+            {
+                "chunk_index": indx,
+                "char_start": chunk.start + offsets[0],
+                "char_end": chunk.start + offsets[1],
+            }
+        )
+    return records
+
+
+def get_extraction_contexts(
+    patent: Patent, merge_chunks: bool = MERGE_POSITIVE_CHUNKS
+) -> list[tuple[int, Chunk]]:
+    """
+    Texts to run extraction on: positive chunks, or merged spans of them
+
+    Overlapping positive chunks repeat the same table rows, so merging them
+    saves extraction calls and duplicate records.
+    """
+    positive_chunks = [
+        (indx, chunk)
+        for indx, chunk in enumerate(patent.chunks)
+        if chunk.has_binding_info
+    ]
+    if not merge_chunks or not positive_chunks:
+        return positive_chunks
+
+    spans = merge_positive_chunks(patent, EXTRACTION_SPAN_SIZE)
+    logger.info(
+        f"Merged {len(positive_chunks)} positive chunks of {patent.name} "
+        + f"into {len(spans)} spans"
+    )
+    return spans
+
+
+def record_extracted_chunk(records: list[dict[str, Any]] | None):
+    """Count an extraction call by outcome, None is a failed call"""
+    metrics = get_metrics()
+    if records is None:
+        status = "error"
+    else:
+        status = "records" if records else "empty"
+        metrics.counter("extraction_records_total", "Extracted records").inc(
+            len(records)
+        )
+    metrics.counter("extraction_chunks_total", "Extraction calls").inc(status=status)
+
+
+def log_extraction_yield(n_calls: int, n_records: int):
+    """Records per extraction call, the main cost metric of extraction"""
+    logger.info(
+        f"Extracted {n_records} records with {n_calls} chunk calls "
+        + f"({n_records / n_calls if n_calls else 0.0:.2f} records per call)"
+    )
 
 
 async def process_all_patents(
-    patents: List[Patent], output_dir: str = "patent_results"
-) -> List[dict[str, Any]]:
+    patents: List[Patent],
+    output_dir: str = "patent_results",
+    extract_chunk: ChunkExtractor = process_patent_chunk,
+    merge_chunks: bool = MERGE_POSITIVE_CHUNKS,
+) -> list[str]:
+    """
+    Extract binding data patent by patent
+
+    Returns:
+        Names of patents whose results were saved with every chunk extracted,
+        see save_patent_results
+    """
     # Ensure base checkpoints folder exists
     output_path = Path(CHECKPOINTS_FOLDER) / output_dir
     output_path.mkdir(parents=True, exist_ok=True)
 
-    all_results = []
+    # Build local indexes off the event loop before the agent needs them
+    if USE_LOCAL_COMPOUND_INDEX:
+        await asyncio.to_thread(get_compound_index)
+    if USE_LOCAL_PROTEIN_INDEX:
+        await asyncio.to_thread(get_protein_index)
+
+    n_records = 0
+    n_calls = 0
+    done = []
 
     for patent in patents:
         logger.info(f"Processing patent: {patent.name}")
         if not patent.has_binding_info:
             logger.info(f"Skipping patent {patent.name}, no binding info")
+            await save_patent_results(output_path, patent, [])
+            done.append(patent.name)
             continue
 
         patent_results = []
-        tasks = [
-            process_patent_chunk(chunk.text)
-            for chunk in patent.chunks
-            if chunk.has_binding_info
-        ]
+        positive_chunks = get_extraction_contexts(patent, merge_chunks)
 
-        if not tasks:
+        if not positive_chunks:
             logger.info(f"No valid chunks to process in patent {patent.name}")
+            await save_patent_results(output_path, patent, [])
+            done.append(patent.name)
             continue
 
-        chunk_results = await asyncio.gather(*tasks, return_exceptions=True)
+        chunk_results = await asyncio.gather(
+            *[extract_chunk(chunk.text, patent.name) for _, chunk in positive_chunks],
+            return_exceptions=True,
+        )
+        n_calls += len(positive_chunks)
 
-        for res in chunk_results:
+        n_failed = 0
+        for (indx, chunk), res in zip(positive_chunks, chunk_results):
             if isinstance(res, Exception):
                 logger.warning(f"Exception during chunk processing: {res}")
+                record_extracted_chunk(None)
+                n_failed += 1
                 continue
-            if res:
-                patent_results.append(res)
+            records = add_provenance(res, chunk, indx)
+            record_extracted_chunk(records)
+            patent_results.extend(records)
+
+        if n_failed:
+            logger.warning(
+                f"{n_failed}/{len(positive_chunks)} chunks of {patent.name} failed, "
+                + "keeping its previous results"
+            )
+            continue
+        try:
+            await save_patent_results(output_path, patent, patent_results)
+        except Exception as e:
+            logger.warning(f"Failed to save results for {patent.name}: {e}")
+            continue
+        n_records += len(patent_results)
+        done.append(patent.name)
+
+    log_extraction_yield(n_calls, n_records)
+    return done
+
+
+async def save_patent_results(
+    output_path: Path, patent: Patent, patent_results: list[dict[str, Any]]
+):
+    """Replace results of a patent, a patent without records has no results file"""
+    patent_output_file = output_path / f"{patent.name}.json"
+    if not patent_results:
+        logger.warning(f"No binding data extracted for patent {patent.name}")
+        await asyncio.to_thread(patent_output_file.unlink, missing_ok=True)
+        return
+    await write_json_async(patent_output_file, patent_results)
+    logger.info(f"Saved {len(patent_results)} results for patent {patent.name}")
+
+
+async def process_all_patents_pool(
+    patents: List[Patent],
+    output_dir: str = "patent_results",
+    n_workers: int = EXTRACTION_WORKERS,
+    queue_size: int = EXTRACTION_QUEUE_SIZE,
+    extract_chunk: ChunkExtractor = process_patent_chunk,
+    merge_chunks: bool = MERGE_POSITIVE_CHUNKS,
+) -> int:
+    """
+    Extract binding data with a fixed pool of workers shared by all patents
+
+    Positive chunks of all patents go into one bounded queue, so the LLM backend
+    stays busy regardless of how chunks are spread across patents. Results of
+    a patent are saved as soon as its last chunk is processed, records of
+    each chunk are appended to the patent results as soon as they arrive.
+    Previous results of a patent with a failed chunk are kept.
+
+    Args:
+        patents: Patents with marked up chunks
+        output_dir: Folder in checkpoints to save per-patent results
+        n_workers: Number of concurrent extraction workers
+        queue_size: Max number of chunks waiting in the queue
+        extract_chunk: Coroutine function extracting a record or a list of
+            records from chunk text
+        merge_chunks: Merge overlapping positive chunks into spans before extraction
+
+    Returns:
+        Names of patents whose results were saved with every chunk extracted,
+        records are only kept on disk
+    """
+    output_path = Path(CHECKPOINTS_FOLDER) / output_dir
+    output_path.mkdir(parents=True, exist_ok=True)
 
-        if patent_results:
-            patent_output_file = output_path / f"{patent.name}.json"
-            async with aiofiles.open(patent_output_file, "w", encoding="utf-8") as f:
-                await f.write(json.dumps(patent_results, indent=2, ensure_ascii=False))
+    # Build local indexes off the event loop before the agent needs them
+    if USE_LOCAL_COMPOUND_INDEX:
+        await asyncio.to_thread(get_compound_index)
+    if USE_LOCAL_PROTEIN_INDEX:
+        await asyncio.to_thread(get_protein_index)
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    pending_chunks: dict[int, int] = {}
+    patent_results: dict[int, list[dict[str, Any]]] = {}
+    failed_chunks: dict[int, int] = {}
+    done: list[str] = []
+    n_records = 0
+    n_calls = 0
+
+    async def finalize(patent: Patent):
+        nonlocal n_records
+        results = sorted(
+            patent_results.pop(id(patent)),
+            key=lambda record: (record["chunk_index"], record["char_start"]),
+        )
+        n_failed = failed_chunks.pop(id(patent), 0)
+        if n_failed:
+            logger.warning(
+                f"{n_failed} chunks of {patent.name} failed, "
+                + "keeping its previous results"
+            )
+            return
+        try:
+            await save_patent_results(output_path, patent, results)
+        except Exception as e:
+            logger.warning(f"Failed to save results for {patent.name}: {e}")
+            return
+        n_records += len(results)
+        done.append(patent.name)
+
+    queue_depth = get_metrics().gauge("queue_depth", "Items waiting in a queue")
+
+    async def worker():
+        nonlocal n_calls
+        while True:
+            patent, chunk, indx = await queue.get()
+            queue_depth.set(queue.qsize(), queue="extraction")
+            try:
+                n_calls += 1
+                res = await extract_chunk(chunk.text, patent.name)
+                records = add_provenance(res, chunk, indx)
+                record_extracted_chunk(records)
+                patent_results[id(patent)].extend(records)
+            except Exception as e:
+                logger.warning(f"Exception during chunk processing: {e}")
+                record_extracted_chunk(None)
+                failed_chunks[id(patent)] = failed_chunks.get(id(patent), 0) + 1
+
+            try:
+                pending_chunks[id(patent)] -= 1
+                if pending_chunks[id(patent)] == 0:
+                    del pending_chunks[id(patent)]
+                    await finalize(patent)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(n_workers)]
+    try:
+        for patent in patents:
+            if not patent.has_binding_info:
+                logger.info(f"Skipping patent {patent.name}, no binding info")
+                await save_patent_results(output_path, patent, [])
+                done.append(patent.name)
+                continue
 
-            all_results.extend(patent_results)
-            logger.info(f"Saved {len(patent_results)} results for patent {patent.name}")
-        else:
-            logger.warning(f"No binding data extracted for patent {patent.name}")
+            positive_chunks = get_extraction_contexts(patent, merge_chunks)
+            if not positive_chunks:
+                logger.info(f"No valid chunks to process in patent {patent.name}")
+                await save_patent_results(output_path, patent, [])
+                done.append(patent.name)
+                continue
 
-    return all_results
+            logger.info(
+                f"Queueing {len(positive_chunks)} chunks of patent: {patent.name}"
+            )
+            pending_chunks[id(patent)] = len(positive_chunks)
+            patent_results[id(patent)] = []
+            for indx, chunk in positive_chunks:
+                await queue.put((patent, chunk, indx))
+
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    log_extraction_yield(n_calls, n_records)
+    return done
@@ -1,23 +1,29 @@
-import json
+import dataclasses
+import logging
 from pathlib import Path
 from parse_pdfs import Patent
+from markup_store import CorpusStore, get_corpus_store
+from serialization import read_json, read_json_files, write_json
 
 from config import INITIAL_PDF_CHUNK_SIZE, CHUNK_OVERLAPS, MIN_PDF_TEXT_LENGTH
 
+logger = logging.getLogger(__name__)
 
-def parse_patent_json(json_file_path: Path) -> Patent:
+
+def parse_patent_json(json_file_path: Path, data: dict | None = None) -> Patent:
     """
     Parse a JSON file and convert it to a Patent object
 
     Args:
         json_file_path: Path to the JSON file
+        data: Already decoded content of the file
 
     Returns:
         Patent object
     """
 
-    with open(json_file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    if data is None:
+        data = read_json(json_file_path)
 
     patent = Patent(
         name=data.get("name", ""),
@@ -49,9 +55,12 @@ def extract_patents_with_binding_data(folder_path: Path) -> list[Patent]:
     folder_path = Path(folder_path)
     patents_with_binding = []
 
-    for json_file in folder_path.glob("*.json"):
+    # Files are read and decoded in parallel, patents are built in order
+    for json_file, data in read_json_files(folder_path.glob("*.json")):
         try:
-            patent = parse_patent_json(json_file)
+            if isinstance(data, Exception):
+                raise data
+            patent = parse_patent_json(json_file, data)
 
             if patent.has_binding_info:
                 indxs_chunks_with_binding_info = patent.chunks_with_binding_info
@@ -66,3 +75,31 @@ def extract_patents_with_binding_data(folder_path: Path) -> list[Patent]:
             continue
 
     return patents_with_binding
+
+
+def export_markup_json(
+    folder_path: Path, store: CorpusStore | None = None, with_binding_info: bool = False
+) -> int:
+    """
+    Write patents of the corpus store as json_binding_data checkpoints
+
+    Args:
+        folder_path: Path to the folder for JSON files
+        store: Corpus store, the shared one by default
+        with_binding_info: Export only patents with binding information
+
+    Returns:
+        Number of written files
+    """
+    store = store or get_corpus_store()
+    folder_path = Path(folder_path)
+    folder_path.mkdir(parents=True, exist_ok=True)
+
+    n_written = 0
+    for patent in store.iter_patents(with_binding_info, positive_only=False):
+        patent.local_path = str(patent.local_path)
+        write_json(Path(folder_path, f"{patent.name}.json"), dataclasses.asdict(patent))
+        n_written += 1
+
+    logger.info(f"Exported {n_written} patents to {folder_path}")
+    return n_written
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from prot_fasta_parser import get_uniprot_fasta_by_gene_async
+from smiles_parser import get_smiles_by_name_async
+from lookup_cache import get_lookup_cache, normalize_key
+from local_compound_index import get_compound_index
+from local_protein_index import get_protein_index
+from serialization import read_json_async, write_json_async
+from utils import map_bounded
+
+from config import (
+    CHECKPOINTS_FOLDER,
+    USE_LOOKUP_CACHE,
+    USE_LOCAL_COMPOUND_INDEX,
+    SMILES_NETWORK_FALLBACK,
+    USE_LOCAL_PROTEIN_INDEX,
+    FASTA_NETWORK_FALLBACK,
+    RESOLUTION_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def cached_lookup(
+    namespace: str, key: str, fetch: Callable[[], Awaitable[Any]]
+) -> Any:
+    """Check the persistent lookup cache before going to the network"""
+    if not USE_LOOKUP_CACHE:
+        return await fetch()
+    return await get_lookup_cache().get_or_fetch(namespace, key, fetch)
+
+
+async def resolve_smiles(name: str, patent_name: str | None = None) -> Any:
+    """
+    Find SMILES by ligand name
+
+    Compounds of the patent in the local index are checked first, then
+    all local compounds, then PubChem through the lookup cache.
+
+    Returns:
+        SMILES, dict with error, or None if the name is not found locally
+        and network lookups are disabled
+    """
+    if USE_LOCAL_COMPOUND_INDEX:
+        smiles = get_compound_index().resolve(name, patent_name)
+        if smiles:
+            return smiles
+        if not SMILES_NETWORK_FALLBACK:
+            return None
+
+    return await cached_lookup("smiles", name, lambda: get_smiles_by_name_async(name))
+
+
+async def resolve_fasta(protein_name: str) -> Any:
+    """
+    Find FASTA by protein name
+
+    The local Swiss-Prot index is checked first, then UniProt through the lookup cache.
+
+    Returns:
+        dict with header and sequence, dict with error, or None if the name is
+        not found locally and network lookups are disabled
+    """
+    if USE_LOCAL_PROTEIN_INDEX:
+        protein_index = get_protein_index()
+        if protein_index is not None:
+            result = protein_index.resolve(protein_name)
+            if result:
+                return result
+            if not FASTA_NETWORK_FALLBACK:
+                return None
+
+    return await cached_lookup(
+        "fasta",
+        protein_name,
+        lambda: get_uniprot_fasta_by_gene_async(protein_name),
+    )
+
+
+def is_resolved(result: Any) -> bool:
+    return bool(result) and not (isinstance(result, dict) and "error" in result)
+
+
+def collect_names(
+    patent_name: str,
+    records: list[dict[str, Any]],
+    ligand_keys: dict[tuple[str, str], str],
+    protein_keys: dict[str, str],
+) -> int:
+    """
+    Add unresolved ligand (per patent) and protein names of records to the keys
+
+    Returns:
+        Number of unresolved names in records
+    """
+    n_unresolved = 0
+    for record in records:
+        if record.get("ligand_name") and not record.get("ligand_SMILES"):
+            key = (patent_name, normalize_key(record["ligand_name"]))
+            ligand_keys.setdefault(key, record["ligand_name"])
+            n_unresolved += 1
+        if record.get("protein_name") and not record.get("protein_FASTA"):
+            protein_keys.setdefault(
+                normalize_key(record["protein_name"]), record["protein_name"]
+            )
+            n_unresolved += 1
+    return n_unresolved
+
+
+async def resolve_names(
+    ligand_keys: dict[tuple[str, str], str], protein_keys: dict[str, str]
+) -> tuple[dict[tuple[str, str], str], dict[str, str]]:
+    """
+    Resolve distinct names with a pool of RESOLUTION_WORKERS lookups in flight,
+    within the per-host limits of the HTTP client
+
+    Returns:
+        SMILES by ligand key and sequences by protein key, unresolved names are left out
+    """
+    logger.info(
+        f"Resolving {len(ligand_keys)} ligand and {len(protein_keys)} protein names"
+    )
+
+    # Build local indexes off the event loop before lookups need them
+    if USE_LOCAL_COMPOUND_INDEX:
+        await asyncio.to_thread(get_compound_index)
+    if USE_LOCAL_PROTEIN_INDEX:
+        await asyncio.to_thread(get_protein_index)
+
+    ligand_results = await map_bounded(
+        lambda item: resolve_smiles(item[1], item[0][0]),
+        ligand_keys.items(),
+        RESOLUTION_WORKERS,
+    )
+    protein_results = await map_bounded(
+        resolve_fasta, protein_keys.values(), RESOLUTION_WORKERS
+    )
+    if USE_LOOKUP_CACHE:
+        await asyncio.to_thread(get_lookup_cache().flush)
+
+    smiles = {
+        key: result
+        for key, result in zip(ligand_keys, ligand_results)
+        if is_resolved(result)
+    }
+    sequences = {
+        key: result["sequence"]
+        for key, result in zip(protein_keys, protein_results)
+        if is_resolved(result)
+    }
+    logger.info(
+        f"Resolved {len(smiles)}/{len(ligand_keys)} ligand "
+        + f"and {len(sequences)}/{len(protein_keys)} protein names"
+    )
+    return smiles, sequences
+
+
+def apply_names(
+    patent_name: str,
+    records: list[dict[str, Any]],
+    smiles: dict[tuple[str, str], str],
+    sequences: dict[str, str],
+) -> int:
+    """
+    Fill ligand_SMILES and protein_FASTA of records in place
+
+    Returns:
+        Number of filled in names
+    """
+    n_filled = 0
+    for record in records:
+        if record.get("ligand_name") and not record.get("ligand_SMILES"):
+            key = (patent_name, normalize_key(record["ligand_name"]))
+            if smiles.get(key):
+                record["ligand_SMILES"] = smiles[key]
+                n_filled += 1
+        if record.get("protein_name") and not record.get("protein_FASTA"):
+            key = normalize_key(record["protein_name"])
+            if sequences.get(key):
+                record["protein_FASTA"] = sequences[key]
+                n_filled += 1
+    return n_filled
+
+
+async def resolve_records(records_by_patent: dict[str, list[dict[str, Any]]]):
+    """
+    Fill ligand_SMILES and protein_FASTA of extracted records in place
+
+    Names are deduplicated across all patents, so every distinct ligand
+    (per patent) and protein is resolved once.
+
+    Args:
+        records_by_patent: Extracted records of each patent
+    """
+    ligand_keys: dict[tuple[str, str], str] = {}
+    protein_keys: dict[str, str] = {}
+    for patent_name, records in records_by_patent.items():
+        collect_names(patent_name, records, ligand_keys, protein_keys)
+
+    smiles, sequences = await resolve_names(ligand_keys, protein_keys)
+    for patent_name, records in records_by_patent.items():
+        apply_names(patent_name, records, smiles, sequences)
+
+
+async def resolve_patent_results(output_dir: str = "patent_results") -> int:
+    """
+    Resolve ligand and protein names of all saved per-patent results
+
+    Files are read twice, to collect names and to fill them in,
+    so only one patent's records are in memory at a time. Only files with
+    unresolved names are read again, and only files with filled in names
+    are rewritten.
+
+    Returns:
+        Number of records in rewritten files
+    """
+    output_path = Path(CHECKPOINTS_FOLDER) / output_dir
+
+    ligand_keys: dict[tuple[str, str], str] = {}
+    protein_keys: dict[str, str] = {}
+    unresolved_files = []
+    for results_file in sorted(output_path.glob("*.json")):
+        records = await read_json_async(results_file)
+        if collect_names(results_file.stem, records, ligand_keys, protein_keys):
+            unresolved_files.append(results_file)
+
+    smiles, sequences = await resolve_names(ligand_keys, protein_keys)
+
+    n_records = 0
+    for results_file in unresolved_files:
+        records = await read_json_async(results_file)
+        if apply_names(results_file.stem, records, smiles, sequences):
+            await write_json_async(results_file, records)
+            n_records += len(records)
+
+    return n_records
@@ -1,46 +1,56 @@
 import logging
-import time
-import random
 
 from pathlib import Path
 
-import requests
 import pandas as pd
 
+import httpx
 from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
 
-HEADERS = {"User-Agent": "Mozilla/5.0"}
+from http_client import get_http_client, run_sync
+from utils import map_bounded
+
+from config import DOWNLOAD_WORKERS
 
 logger = logging.getLogger(__name__)
 
 
-def get_pdf_link(
-    query: str,
-    headers: dict[str, str] = HEADERS,
-    n_retries: int = 3,
-    backoff_factor: float = 0.3,
-) -> str | dict:
-    """Get link to patent pdf from google patents"""
-
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=n_retries,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods=["GET"],
-        backoff_factor=backoff_factor,
-    )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
+def get_pdf_link(query: str) -> str | dict:
+    """Synchronous get_pdf_link_async, for scripts"""
+    return run_sync(get_pdf_link_async(query))
+
+
+def download_pdf(url: str, folder: Path) -> str | dict[str, str]:
+    """Synchronous download_pdf_async, for scripts"""
+    return run_sync(download_pdf_async(url, folder))
+
+
+def collect_pdf_links(checkpoints_folder: Path) -> pd.DataFrame:
+    """Synchronous collect_pdf_links_async, for scripts"""
+    return run_sync(collect_pdf_links_async(checkpoints_folder))
+
+
+def download_patent_data(
+    links_to_pdf: pd.DataFrame, checkpoints_folder: Path
+) -> pd.DataFrame:
+    """Synchronous download_patent_data_async, for scripts"""
+    return run_sync(download_patent_data_async(links_to_pdf, checkpoints_folder))
+
+
+async def get_pdf_link_async(query: str) -> str | dict:
+    """Get link to patent pdf from google patents using the shared HTTP client"""
 
     query = query.replace("-", "")
     logger.info(f"collectng pdf link for: {query}")
 
     url = f"https://patents.google.com/patent/{query}/en?oq={query}"
 
-    resp = session.get(url, headers=headers)
+    try:
+        resp = await get_http_client().get(url)
+    except httpx.HTTPError as e:
+        logger.info(f"error collectng pdf link for: {query}")
+        return {"error": str(e)}
+
     if resp.status_code == 200:
         soup = BeautifulSoup(resp.text, "html.parser")
         tag = soup.find("meta", attrs={"name": "citation_pdf_url"})
@@ -51,36 +61,40 @@ def get_pdf_link(
         return {"error": resp.status_code}
 
 
-def download_pdf(
-    url: str,
-    folder: Path,
-    headers: dict[str, str] = HEADERS,
-) -> str | dict[str, str]:
-    """Download pdf"""
+async def download_pdf_async(url: str, folder: Path) -> str | dict[str, str]:
+    """Download pdf using the shared HTTP client"""
 
     try:
         logger.debug(url)
         filename = folder / Path(url).name
 
-        response = requests.get(url, headers=headers, stream=True, timeout=15)
-        if response.status_code == 200:
-            with filename.open("wb") as f:
-                for chunk in response.iter_content(chunk_size=1024):
-                    f.write(chunk)
+        status_code = await get_http_client().download(url, filename)
+        if status_code == 200:
             logger.info(f"success: downloaded to {filename}")
             return "success"
         else:
-            logger.info({"error": response.status_code, "filename": filename})
-            return {"error": response.status_code}
-    except requests.RequestException as e:
+            logger.info({"error": status_code, "filename": filename})
+            return {"error": status_code}
+    except httpx.HTTPError as e:
         logger.info({"error": e})
-        return {"error": e}
+        return {"error": str(e)}
+
 
+async def collect_pdf_links_async(
+    checkpoints_folder: Path, patent_numbers: list[str] | None = None
+) -> pd.DataFrame:
+    """
+    Parse patent pdf links with a worker pool, google patents host limit and
+    pacing apply
 
-def collect_pdf_links(
-    checkpoints_folder: Path,
-):
-    """Parse patent pdf links"""
+    Args:
+        checkpoints_folder: Folder with preprocessing checkpoints
+        patent_numbers: Look up only these patents and keep previously
+            collected links of the others, all patents by default
+
+    Returns:
+        Links of all preprocessed patents
+    """
 
     comp_with_patent_info_df_path = Path(
         checkpoints_folder, "preprocessing", "comp_with_patent_info.tsv"
@@ -94,60 +108,88 @@ def collect_pdf_links(
         sep="\t",
     )
 
-    link_mapping_list = []
-
-    for patent_number in df["patent_number"].unique():
-        pdf_link = get_pdf_link(patent_number)
-        link_mapping_list.append({"patent_number": patent_number, "pdf_link": pdf_link})
-        time.sleep(random.uniform(0, 1))
-
-    links_to_pdf = pd.DataFrame(link_mapping_list)
-    links_to_pdf.to_csv(
-        Path(pdf_links_checkpoints_folder, "links_to_pdf.tsv"), sep="\t", index=False
+    links_path = Path(pdf_links_checkpoints_folder, "links_to_pdf.tsv")
+    all_patent_numbers = list(df["patent_number"].unique())
+    if patent_numbers is None or not links_path.exists():
+        patent_numbers = all_patent_numbers
+        previous_links = pd.DataFrame(columns=["patent_number", "pdf_link"])
+    else:
+        wanted = set(patent_numbers)
+        patent_numbers = [n for n in all_patent_numbers if n in wanted]
+        previous_links = pd.read_csv(links_path, sep="\t")
+        previous_links = previous_links[
+            previous_links["patent_number"].isin(all_patent_numbers)
+            & ~previous_links["patent_number"].isin(patent_numbers)
+        ]
+
+    pdf_links = await map_bounded(get_pdf_link_async, patent_numbers, DOWNLOAD_WORKERS)
+    link_mapping_list = [
+        {"patent_number": patent_number, "pdf_link": pdf_link}
+        for patent_number, pdf_link in zip(patent_numbers, pdf_links)
+    ]
+
+    links_to_pdf = pd.concat(
+        [previous_links, pd.DataFrame(link_mapping_list)], ignore_index=True
     )
+    links_to_pdf.to_csv(links_path, sep="\t", index=False)
 
     return links_to_pdf
 
 
-def download_patent_data(links_to_pdf: pd.DataFrame, checkpoints_folder: Path):
-    """Download patent pdf"""
+async def download_patent_data_async(
+    links_to_pdf: pd.DataFrame, checkpoints_folder: Path
+) -> pd.DataFrame:
+    """
+    Download patent pdfs with a worker pool, per-host limits and pacing apply
+
+    Download statuses of patents not in links_to_pdf are kept from previous runs.
+
+    Returns:
+        Download statuses of links_to_pdf
+    """
     patent_pdf_folder = Path(checkpoints_folder, "patent_pdfs")
     patent_pdf_folder.mkdir(exist_ok=True, parents=True)
 
     pdf_links_checkpoints_folder = Path(checkpoints_folder, "pdf_links")
     pdf_links_checkpoints_folder.mkdir(exist_ok=True, parents=True)
 
-    flattened_links_to_pdf = links_to_pdf.to_dict(orient="index")
-    link_mapping_list = [d for d in flattened_links_to_pdf.values()]
-
-    link_download_list = []
+    link_mapping_list = links_to_pdf.to_dict(orient="records")
 
-    for link_data in link_mapping_list:
+    async def download(link_data):
         link = link_data["pdf_link"]
-        patent_number = link_data["patent_number"]
-
-        if "error" in link or isinstance(link, dict):
-            link_download_list.append(
-                {
-                    "patent_number": patent_number,
-                    "pdf_link": link,
-                    "download_status": '{"error": "pdf_url not found"}',
-                }
-            )
+        # Missing links are read back from the TSV as NaN
+        if not isinstance(link, str) or "error" in link:
+            status = '{"error": "pdf_url not found"}'
         else:
-            link_download_list.append(
-                {
-                    "patent_number": patent_number,
-                    "pdf_link": link,
-                    "download_status": download_pdf(link, patent_pdf_folder),
-                }
-            )
-        time.sleep(random.uniform(2, 3))
+            status = await download_pdf_async(link, patent_pdf_folder)
+        return {
+            "patent_number": link_data["patent_number"],
+            "pdf_link": link,
+            "download_status": status,
+        }
+
+    link_download_list = await map_bounded(
+        download, link_mapping_list, DOWNLOAD_WORKERS
+    )
 
-    links_to_pdf_with_download_status = pd.DataFrame(link_download_list)
+    links_to_pdf_with_download_status = pd.DataFrame(
+        link_download_list, columns=["patent_number", "pdf_link", "download_status"]
+    )
 
-    links_to_pdf_with_download_status.to_csv(
-        Path(pdf_links_checkpoints_folder, "links_to_pdf_with_download_status.tsv"),
-        sep="\t",
-        index=False,
+    status_path = Path(
+        pdf_links_checkpoints_folder, "links_to_pdf_with_download_status.tsv"
     )
+    all_statuses = links_to_pdf_with_download_status
+    if status_path.exists():
+        previous_statuses = pd.read_csv(status_path, sep="\t")
+        previous_statuses = previous_statuses[
+            ~previous_statuses["patent_number"].isin(
+                links_to_pdf_with_download_status["patent_number"]
+            )
+        ]
+        all_statuses = pd.concat(
+            [previous_statuses, links_to_pdf_with_download_status], ignore_index=True
+        )
+    all_statuses.to_csv(status_path, sep="\t", index=False)
+
+    return links_to_pdf_with_download_status
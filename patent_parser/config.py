@@ -1,11 +1,18 @@
 """This file will contain all configs for patent parser"""
 
+import os
+
 from pathlib import Path
 
 # Paths
 DATA_FOLDER = "data"
+# CHECKPOINTS_FOLDER env variable points hosts of sharded workers to the shared folder
 CHECKPOINTS_FOLDER = Path(
-    DATA_FOLDER, "/home/alex/dev/test-repkAI/data/checkpoints_random_1234567"
+    DATA_FOLDER,
+    os.getenv(
+        "CHECKPOINTS_FOLDER",
+        "/home/alex/dev/test-repkAI/data/checkpoints_random_1234567",
+    ),
 )
 
 # Set up pdf reading
@@ -15,11 +22,18 @@ CHUNK_OVERLAPS = 5
 
 CHEMBL_FOLDER = Path(DATA_FOLDER, "ChEMBL")
 SURE_CHEMBL_FOLDER = Path(DATA_FOLDER, "SureChEMBL")
+UNIPROT_FOLDER = Path(DATA_FOLDER, "UniProt")
 
 PC_MAP_PQ = Path(SURE_CHEMBL_FOLDER, "patent_compound_map.parquet")
 COMPOUNDS_PQ = Path(SURE_CHEMBL_FOLDER, "compounds.parquet")
 PATENTS_PQ = Path(SURE_CHEMBL_FOLDER, "patents.parquet")
 
+# Swiss-Prot dumps from
+# https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/
+UNIPROT_SPROT_FASTA = Path(UNIPROT_FOLDER, "uniprot_sprot.fasta.gz")
+UNIPROT_SPROT_DAT = Path(UNIPROT_FOLDER, "uniprot_sprot.dat.gz")  # optional synonyms
+UNIPROT_INDEX_FOLDER = Path(UNIPROT_FOLDER, "index")
+
 # URLs
 CHEMBL_URL = "https://ftp.ebi.ac.uk/pub/databases/chembl/ChEMBLdb/latest/"
 SURE_CHEMBL_URL = (
@@ -43,14 +57,177 @@ CHUNKS: list[int] | None = []
 # Patent retrieval
 HEADERS = {"User-Agent": "Mozilla/5.0"}
 
+# Async HTTP (PubChem, UniProt, Google Patents, FTP downloads)
+HTTP_TIMEOUT = 30  # seconds
+HTTP_N_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_DEFAULT_HOST_LIMIT = 4
+HTTP_HOST_LIMITS = {
+    "pubchem.ncbi.nlm.nih.gov": 5,
+    "rest.uniprot.org": 8,
+    "patents.google.com": 1,
+    "patentimages.storage.googleapis.com": 2,
+    "ftp.ebi.ac.uk": 2,
+}
+### Pacing: a request to these hosts starts a random (min, max) seconds after
+### the previous one, as the sequential scraper slept between requests
+HTTP_HOST_INTERVALS = {
+    "patents.google.com": (0.0, 1.0),
+    "patentimages.storage.googleapis.com": (2.0, 3.0),
+}
+### Workers downloading PDFs of a batch, each holds one download at a time
+DOWNLOAD_WORKERS = 4
+
+# Serialization: checkpoints are compact JSON (orjson if installed), encoded,
+# decoded and written by a worker pool off the event loop
+SERIALIZATION_WORKERS = 4
+### Event loop lag is sampled every EVENT_LOOP_LAG_INTERVAL seconds,
+### lag above EVENT_LOOP_STALL_THRESHOLD seconds is logged as a stall
+EVENT_LOOP_LAG_INTERVAL = 0.1
+EVENT_LOOP_STALL_THRESHOLD = 0.25
+
+# Metrics: counters, gauges and histograms of all stages, written in Prometheus
+# text format, e.g. for the node_exporter textfile collector, and summarized in
+# the log at the end of a run
+METRICS_TEXTFILE_PATH = Path(CHECKPOINTS_FOLDER, "metrics", "patent_parser.prom")
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # s
+METRICS_STEP_BUCKETS = (1, 10, 60, 300, 900, 3600, 14400)  # s
+METRICS_LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)  # s
+
 # Requests LLM
 MAX_CONCURRENT_REQUESTS = 6
 USE_PARALLEL = True
 BATCH_SIZE = 20
 
+### Worker pool markup (streams patents instead of gathering a whole batch)
+USE_WORKER_POOL = True
+MARKUP_WORKERS = MAX_CONCURRENT_REQUESTS
+MAX_PATENTS_IN_FLIGHT = 2 * MARKUP_WORKERS
+
+### Coarse-to-fine markup: classify non-overlapping windows first and
+### re-check only positive windows (and their neighbours) with overlapping chunks
+USE_COARSE_TO_FINE = False
+COARSE_TO_FINE_NEIGHBORS = 1
+
+### Markup verdict format:
+###   "json" - free-form json verdict parsed from the answer, as before the modes
+###   "schema" - json-schema constrained decoding, falls back to "logprob"
+###   "logprob" - single yes/no token scored by its logprob, falls back to "json"
+MARKUP_OUTPUT_MODE = "json"
+MARKUP_CONFIDENCE_THRESHOLD = 0.5  # min P(has binding info) for a positive chunk
+
+### Markup model cascade: a cheap model screens every chunk and only uncertain
+### or positive verdicts are escalated to the next tier. Tier endpoints are read
+### from env variables <env_prefix>LLM_BASE_URL, <env_prefix>LLM_API_KEY, <env_prefix>MODEL.
+### A chunk is accepted as negative by a tier if P(binding info) < negative_below
+### and as positive if P(binding info) >= positive_above (None - always escalate).
+USE_MARKUP_CASCADE = False
+MARKUP_CASCADE_TIERS = [
+    {
+        "name": "screen",
+        "env_prefix": "SCREEN_",
+        "max_concurrent": 24,
+        "output_mode": "logprob",
+        "negative_below": 0.2,
+        "positive_above": None,
+    },
+    {
+        "name": "main",
+        "env_prefix": "",
+        "max_concurrent": MAX_CONCURRENT_REQUESTS,
+        "output_mode": MARKUP_OUTPUT_MODE,
+        "negative_below": MARKUP_CONFIDENCE_THRESHOLD,
+        "positive_above": MARKUP_CONFIDENCE_THRESHOLD,
+    },
+]
+
+### Offline batch markup: chunk prompts are written to JSONL files in OpenAI
+### batch format and run by a batch endpoint or a local offline runner
+USE_BATCH_MARKUP = False
+BATCH_MAX_REQUESTS_PER_FILE = 50000
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_POLL_INTERVAL = 60  # seconds
+# Local runner command, {input}, {output} and {model} are substituted, e.g.
+# ["python", "-m", "vllm.entrypoints.openai.run_batch",
+#  "-i", "{input}", "-o", "{output}", "--model", "{model}"]
+BATCH_LOCAL_RUNNER: list[str] | None = None
+
+### Corpus store: marked up patents are kept in one SQLite file, each text once
+### compressed in blocks of CORPUS_TEXT_BLOCK_SIZE symbols, with offsets and
+### verdicts of all chunks. Extraction decompresses only blocks of positive chunks.
+### Patents are committed in atomic batches of CORPUS_COMMIT_BATCH_SIZE.
+USE_CORPUS_STORE = True
+CORPUS_STORE_PATH = Path(CHECKPOINTS_FOLDER, "corpus.sqlite")
+CORPUS_TEXT_BLOCK_SIZE = 64 * 1024
+CORPUS_COMPRESSION_LEVEL = 6
+CORPUS_COMMIT_BATCH_SIZE = 50
+# Also write per-patent json_binding_data checkpoints (always written without the store)
+EXPORT_MARKUP_JSON = False
+
 # AI agent
 AGENT_TIMEOUT = 1000
 
+### Extraction mode:
+###   "agent" - ReAct agent calling GetSMILES / GetFASTA tools while reading a chunk
+###   "structured" - one json-schema constrained LLM call per chunk, ligand and
+###   protein names of the whole run are resolved afterwards in bulk
+EXTRACTION_MODE = "agent"
+# Structured mode only: return every binding record of a chunk instead of one
+MULTI_RECORD_EXTRACTION = True
+
+### Overlapping positive chunks are merged into non-overlapping spans and
+### extraction runs once per span. Span size is in symbols, keep it well below
+### the model context window as prompt and extracted records share it.
+MERGE_POSITIVE_CHUNKS = True
+EXTRACTION_SPAN_SIZE = 4 * INITIAL_PDF_CHUNK_SIZE
+### A span whose records were cut off at the answer token limit is split in
+### halves and extracted again, down to EXTRACTION_MIN_SPLIT_SIZE symbols
+EXTRACTION_MIN_SPLIT_SIZE = INITIAL_PDF_CHUNK_SIZE
+
+### Merge duplicate records of a patent and flag conflicting values after extraction
+RECONCILE_RESULTS = True
+
+### Final results dataset: records of all patents are streamed into rolling
+### part files of a fixed schema, "parquet" or "jsonl"
+RESULTS_DATASET_FOLDER = Path(CHECKPOINTS_FOLDER, "results_dataset")
+RESULTS_DATASET_FORMAT = "parquet"
+RESULTS_DATASET_MAX_FILE_SIZE = 256 * 1024**2  # bytes
+RESULTS_DATASET_BATCH_SIZE = 10000  # records per row group
+
+### Persistent cache for GetSMILES / GetFASTA lookups
+USE_LOOKUP_CACHE = True
+LOOKUP_CACHE_PATH = Path(CHECKPOINTS_FOLDER, "lookup_cache.sqlite")
+LOOKUP_CACHE_TTL = 90 * 24 * 3600  # seconds
+LOOKUP_CACHE_NEGATIVE_TTL = 7 * 24 * 3600  # seconds, for "not found" answers
+LOOKUP_CACHE_COMMIT_BATCH = 100  # new entries written per transaction
+
+### Local name -> SMILES index of SureChEMBL compounds linked to patents,
+### GetSMILES checks it (current patent first) before PubChem
+USE_LOCAL_COMPOUND_INDEX = True
+LOCAL_COMPOUND_TSV = Path(CHECKPOINTS_FOLDER, "preprocessing", "comp_with_patent_info.tsv")
+# Columns holding names, synonyms and identifiers, missing columns are ignored.
+# SureChEMBL compounds carry InChI and InChI keys, names only in other dumps
+LOCAL_COMPOUND_NAME_COLUMNS = ["name", "iupac_name", "synonyms", "inchi_key", "inchi"]
+# SureChEMBL compound ids are indexed as written in patents, e.g. SCHEMBL12345
+LOCAL_COMPOUND_ID_COLUMN = "compound_id"
+LOCAL_COMPOUND_ID_PREFIX = "SCHEMBL"
+LOCAL_COMPOUND_SYNONYM_SEPARATOR = "|"
+SMILES_NETWORK_FALLBACK = True
+
+### Local protein name -> FASTA index built from Swiss-Prot dumps,
+### GetFASTA checks it before UniProt REST API
+USE_LOCAL_PROTEIN_INDEX = True
+FASTA_NETWORK_FALLBACK = True
+
+### Bulk resolution: distinct names are looked up by a fixed pool of workers,
+### network lookups are further limited per host by the HTTP client
+RESOLUTION_WORKERS = 16
+
+### Extraction pool: positive chunks of all patents share one bounded queue
+USE_EXTRACTION_POOL = True
+EXTRACTION_WORKERS = MAX_CONCURRENT_REQUESTS
+EXTRACTION_QUEUE_SIZE = 4 * EXTRACTION_WORKERS
+
 
 LOG_DIR = Path(__file__).parent.parent / "logs"
 
@@ -62,6 +239,34 @@ STEPS = [
     "download_patents",
     "parse_and_markup",
     "extract_patents_with_binding",
+    "finalize_results",
 ]
+# Manifests of inputs and parameters of every step, only stale steps and items rerun
+MANIFESTS_FOLDER = Path(CHECKPOINTS_FOLDER, "manifests")
+
+### Sharded execution: run_parser queues stale patents of download, markup and
+### extraction steps instead of processing them, run_worker processes on any
+### number of hosts sharing CHECKPOINTS_FOLDER claim them under leases. Workers
+### need USE_CORPUS_STORE = False, SQLite WAL needs a single host, and
+### USE_BATCH_MARKUP = False, run_parser, run_service and run_worker refuse to
+### start otherwise.
+USE_WORK_QUEUE = False
+WORK_QUEUE_PATH = Path(CHECKPOINTS_FOLDER, "work_queue.sqlite")
+WORK_LEASE_DURATION = 600  # seconds, renewed while a worker is alive
+WORK_MAX_ATTEMPTS = 3
+WORK_CLAIM_BATCH_SIZE = 16  # patents claimed by a worker at once
+WORK_POLL_INTERVAL = 10  # seconds between claims while other workers hold leases
+
+### Service mode: run_service keeps clients and caches warm and pushes new PDFs of
+### patent_pdfs, or of SERVICE_DROP_FOLDER, through SERVICE_STEPS every poll.
+### Health and progress are served as JSON on SERVICE_HOST:SERVICE_PORT
+### (/health, /status) and written to SERVICE_STATUS_PATH.
+SERVICE_STEPS = ["parse_and_markup", "extract_patents_with_binding", "finalize_results"]
+SERVICE_POLL_INTERVAL = 30  # seconds
+# Folder PDFs are dropped into, moved to patent_pdfs once their size is stable
+SERVICE_DROP_FOLDER: Path | None = None
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_STATUS_PATH = Path(CHECKPOINTS_FOLDER, "service_status.json")
 
 CONTINUE_MARKUP = True
@@ -13,7 +13,6 @@ formatted_datetime = now.strftime("%Y%m%d%H%M")
 if not LOG_DIR or LOG_DIR is None:
     LOG_DIR = Path(__file__).parent / "logs"
 LOG_DIR = Path(LOG_DIR)
-LOG_DIR.mkdir(exist_ok=True)
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -43,4 +42,5 @@ LOGGING_CONFIG = {
 
 
 def setup_logging():
+    LOG_DIR.mkdir(exist_ok=True)
     logging.config.dictConfig(LOGGING_CONFIG)
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import random
+import time
+
+from pathlib import Path
+from typing import Any, Awaitable, TypeVar
+from urllib.parse import urlsplit
+
+import aiofiles
+import httpx
+
+from metrics import acquire_timed, get_metrics
+from config import (
+    HEADERS,
+    HTTP_TIMEOUT,
+    HTTP_N_RETRIES,
+    HTTP_BACKOFF_FACTOR,
+    HTTP_DEFAULT_HOST_LIMIT,
+    HTTP_HOST_LIMITS,
+    HTTP_HOST_INTERVALS,
+)
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+T = TypeVar("T")
+
+
+class AsyncHttpClient:
+    """
+    Shared async HTTP client
+
+    Keeps connections alive between requests, caps concurrent requests per host,
+    paces requests to hosts with `host_intervals` and retries transport errors
+    and 429/5xx answers with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        host_limits: dict[str, int] = HTTP_HOST_LIMITS,
+        default_host_limit: int = HTTP_DEFAULT_HOST_LIMIT,
+        host_intervals: dict[str, tuple[float, float]] = HTTP_HOST_INTERVALS,
+        timeout: float = HTTP_TIMEOUT,
+        n_retries: int = HTTP_N_RETRIES,
+        backoff_factor: float = HTTP_BACKOFF_FACTOR,
+        headers: dict[str, str] = HEADERS,
+    ):
+        self.host_limits = host_limits
+        self.default_host_limit = default_host_limit
+        self.host_intervals = host_intervals
+        self.n_retries = n_retries
+        self.backoff_factor = backoff_factor
+        self.bytes_downloaded = 0
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._pacing_locks: dict[str, asyncio.Lock] = {}
+        self._next_request_at: dict[str, float] = {}
+        self._client = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(timeout),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            follow_redirects=True,
+        )
+
+    def host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        if host not in self._host_semaphores:
+            limit = self.host_limits.get(host, self.default_host_limit)
+            self._host_semaphores[host] = asyncio.Semaphore(limit)
+        return self._host_semaphores[host]
+
+    async def pace(self, url: str):
+        """Wait until the host interval since the previous request has passed"""
+        host = urlsplit(url).hostname or ""
+        if host not in self.host_intervals:
+            return
+        lock = self._pacing_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            delay = self._next_request_at.get(host, 0.0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            interval = random.uniform(*self.host_intervals[host])
+            self._next_request_at[host] = time.monotonic() + interval
+
+    def retry_delay(self, attempt: int, response: httpx.Response | None) -> float:
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        jitter = random.uniform(0, self.backoff_factor)
+        return self.backoff_factor * 2**attempt + jitter
+
+    def record(self, url: str, status: int | str, n_bytes: int = 0):
+        """Count a request and the bytes it downloaded"""
+        host = urlsplit(url).hostname or ""
+        self.bytes_downloaded += n_bytes
+        metrics = get_metrics()
+        metrics.counter("http_requests_total", "HTTP requests by answer").inc(
+            host=host, status=status
+        )
+        if n_bytes:
+            metrics.counter(
+                "http_bytes_downloaded_total", "Bytes of HTTP response bodies"
+            ).inc(n_bytes, host=host)
+
+    def record_retry(self, url: str):
+        get_metrics().counter("http_retries_total", "Retried HTTP requests").inc(
+            host=urlsplit(url).hostname or ""
+        )
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """
+        Send request, retrying transport errors and 429/5xx answers
+
+        The host slot is released while waiting before a retry.
+        Raises httpx.HTTPError if the last attempt failed with a transport error.
+        """
+        semaphore = self.host_semaphore(url)
+        for attempt in range(self.n_retries + 1):
+            response = None
+            try:
+                async with acquire_timed(semaphore, f"http:{urlsplit(url).hostname}"):
+                    await self.pace(url)
+                    response = await self._client.request(method, url, **kwargs)
+                self.record(url, response.status_code, len(response.content))
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+            except httpx.TransportError as e:
+                self.record(url, "transport_error")
+                if attempt == self.n_retries:
+                    raise
+                logger.info(f"Request to {url} failed: {e}")
+
+            if attempt == self.n_retries:
+                return response
+            self.record_retry(url)
+            delay = self.retry_delay(attempt, response)
+            logger.info(f"Will retry {url} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def download(
+        self, url: str, path: Path, chunk_size: int = 1024 * 1024, **kwargs: Any
+    ) -> int:
+        """
+        Stream response body to a file, returns HTTP status code
+
+        The file is written to a temporary path and renamed when complete.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".part")
+        semaphore = self.host_semaphore(url)
+        for attempt in range(self.n_retries + 1):
+            status_code = None
+            n_bytes = 0
+            try:
+                async with acquire_timed(semaphore, f"http:{urlsplit(url).hostname}"):
+                    await self.pace(url)
+                    async with self._client.stream("GET", url, **kwargs) as response:
+                        status_code = response.status_code
+                        if status_code == 200:
+                            async with aiofiles.open(tmp_path, "wb") as f:
+                                async for chunk in response.aiter_bytes(chunk_size):
+                                    n_bytes += len(chunk)
+                                    await f.write(chunk)
+                            tmp_path.replace(path)
+                self.record(url, status_code, n_bytes)
+                if status_code == 200 or status_code not in RETRY_STATUSES:
+                    return status_code
+            except httpx.TransportError as e:
+                self.record(url, "transport_error", n_bytes)
+                tmp_path.unlink(missing_ok=True)
+                if attempt == self.n_retries:
+                    raise
+                logger.info(f"Download of {url} failed: {e}")
+
+            if attempt == self.n_retries:
+                return status_code
+            self.record_retry(url)
+            await asyncio.sleep(self.retry_delay(attempt, None))
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+_client: AsyncHttpClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_http_client() -> AsyncHttpClient:
+    """Shared client of the running event loop, created on first use"""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = AsyncHttpClient()
+        _client_loop = loop
+    return _client
+
+
+async def close_http_client():
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client, _client_loop = None, None
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """Run a coroutine using the shared client from synchronous code, e.g. scripts"""
+
+    async def run() -> T:
+        try:
+            return await coro
+        finally:
+            await close_http_client()
+
+    return asyncio.run(run())
@@ -0,0 +1,142 @@
+import functools
+import logging
+import re
+
+from pathlib import Path
+
+import pandas as pd
+
+from config import (
+    LOCAL_COMPOUND_TSV,
+    LOCAL_COMPOUND_NAME_COLUMNS,
+    LOCAL_COMPOUND_SYNONYM_SEPARATOR,
+    LOCAL_COMPOUND_ID_COLUMN,
+    LOCAL_COMPOUND_ID_PREFIX,
+)
+
+logger = logging.getLogger(__name__)
+
+DASHES = re.compile("[‐‑‒–—−]")
+WHITESPACE_AND_QUOTES = re.compile(r"[\s\"'`]+")
+
+
+def normalize_compound_name(name: str) -> str:
+    """Case, whitespace, quote and dash insensitive compound name"""
+    name = DASHES.sub("-", str(name))
+    return WHITESPACE_AND_QUOTES.sub("", name).casefold()
+
+
+def normalize_patent_number(patent_number: str) -> str:
+    """US-2015123456-A1 and US2015123456A1 are the same patent"""
+    return str(patent_number).replace("-", "").upper()
+
+
+class LocalCompoundIndex:
+    """
+    In-memory name -> SMILES index of SureChEMBL compounds linked to patents
+
+    Every name, synonym and identifier column from config, and the SureChEMBL
+    id of every compound, are indexed both globally and per patent, so
+    compounds of the patent being processed win. SureChEMBL has no in-patent
+    labels such as "Example 3", those are left to the network lookup.
+    """
+
+    def __init__(self):
+        self.by_name: dict[str, str] = {}
+        self.by_patent: dict[str, dict[str, str]] = {}
+        self.n_compounds = 0
+
+    def add(self, names: list[str], smiles: str, patent_number: str | None = None):
+        patent_names = None
+        if patent_number:
+            patent_names = self.by_patent.setdefault(
+                normalize_patent_number(patent_number), {}
+            )
+        for name in names:
+            key = normalize_compound_name(name)
+            if not key:
+                continue
+            # Keep the first seen structure for ambiguous names
+            self.by_name.setdefault(key, smiles)
+            if patent_names is not None:
+                patent_names.setdefault(key, smiles)
+        self.n_compounds += 1
+
+    def resolve(self, name: str, patent_name: str | None = None) -> str | None:
+        """
+        Find SMILES by compound name
+
+        Args:
+            name: Compound name, synonym or identifier
+            patent_name: Patent being processed, its compounds are checked first
+
+        Returns:
+            SMILES or None if name is unknown
+        """
+        key = normalize_compound_name(name)
+        if patent_name:
+            patent_names = self.by_patent.get(normalize_patent_number(patent_name))
+            if patent_names and key in patent_names:
+                return patent_names[key]
+        return self.by_name.get(key)
+
+    @classmethod
+    def from_tsv(
+        cls,
+        path: Path = LOCAL_COMPOUND_TSV,
+        name_columns: list[str] = LOCAL_COMPOUND_NAME_COLUMNS,
+        synonym_separator: str = LOCAL_COMPOUND_SYNONYM_SEPARATOR,
+        id_column: str = LOCAL_COMPOUND_ID_COLUMN,
+        id_prefix: str = LOCAL_COMPOUND_ID_PREFIX,
+    ) -> "LocalCompoundIndex":
+        """Build index from comp_with_patent_info.tsv made by preprocessing"""
+        index = cls()
+        path = Path(path)
+        if not path.exists():
+            logger.warning(f"No local compounds found at {path}, index is empty")
+            return index
+
+        header = pd.read_csv(path, sep="\t", nrows=0).columns
+        present_columns = [c for c in name_columns if c in header]
+        id_column = id_column if id_column in header else None
+        if not present_columns:
+            content = f"holds only {id_prefix} ids" if id_column else "is empty"
+            logger.warning(
+                f"None of the name columns {name_columns} are in {path}, "
+                + f"local compound index {content}"
+            )
+            if id_column is None:
+                return index
+        name_columns = present_columns
+        usecols = ["smiles", *name_columns]
+        if id_column:
+            usecols.append(id_column)
+        if "patent_number" in header:
+            usecols.append("patent_number")
+
+        for df in pd.read_csv(
+            path, sep="\t", usecols=usecols, dtype=str, chunksize=100_000
+        ):
+            df = df.dropna(subset=["smiles"])
+            for row in df.itertuples(index=False):
+                row = row._asdict()
+                names = []
+                for column in name_columns:
+                    value = row[column]
+                    if isinstance(value, str):
+                        names.extend(value.split(synonym_separator))
+                if id_column and isinstance(row[id_column], str):
+                    names.append(id_prefix + row[id_column].removeprefix(id_prefix))
+                index.add(names, row["smiles"], row.get("patent_number"))
+
+        logger.info(
+            f"Indexed {index.n_compounds} compounds, {len(index.by_name)} names "
+            + f"from {len(index.by_patent)} patents"
+        )
+        return index
+
+
+@functools.lru_cache(maxsize=None)
+def get_compound_index() -> LocalCompoundIndex:
+    """Shared compound index, built on first use"""
+    return LocalCompoundIndex.from_tsv()
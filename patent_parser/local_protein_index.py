@@ -0,0 +1,268 @@
+import functools
+import gzip
+import logging
+import mmap
+import re
+import sqlite3
+import threading
+
+from pathlib import Path
+from typing import IO, Iterator
+
+from config import (
+    UNIPROT_SPROT_FASTA,
+    UNIPROT_SPROT_DAT,
+    UNIPROT_INDEX_FOLDER,
+)
+
+logger = logging.getLogger(__name__)
+
+DASHES = re.compile("[‐‑‒–—−]")
+EVIDENCE = re.compile(r"\{[^}]*\}")
+HEADER_FIELDS = re.compile(r" (OS|OX|GN|PE|SV)=")
+
+# Lower value wins when a name matches several kinds
+NAME_KIND_PRIORITY = {
+    "accession": 0,
+    "gene": 1,
+    "protein": 2,
+    "entry": 3,
+    "synonym": 4,
+}
+
+
+def normalize_protein_name(name: str) -> str:
+    """Case, whitespace and dash insensitive protein name"""
+    name = DASHES.sub("-", str(name))
+    return " ".join(name.split()).casefold()
+
+
+def open_text(path: Path) -> IO[str]:
+    if Path(path).suffix == ".gz":
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def parse_fasta_header(header: str) -> dict[str, str]:
+    """
+    Parse UniProt FASTA header like
+    sp|P00533|EGFR_HUMAN Epidermal growth factor receptor OS=Homo sapiens OX=9606 GN=EGFR
+    """
+    ids, _, description = header.partition(" ")
+    parts = ids.split("|")
+    accession = parts[1] if len(parts) > 2 else parts[0]
+    entry_name = parts[2] if len(parts) > 2 else ""
+
+    fields = HEADER_FIELDS.split(" " + description)
+    info = {
+        "accession": accession,
+        "entry_name": entry_name,
+        "protein_name": fields[0].strip(),
+        "organism": "",
+        "gene": "",
+    }
+    for key, value in zip(fields[1::2], fields[2::2]):
+        if key == "OS":
+            info["organism"] = value.strip()
+        elif key == "GN":
+            info["gene"] = value.strip()
+    return info
+
+
+def iter_fasta(path: Path) -> Iterator[tuple[str, str]]:
+    """Yield (header, sequence) from a FASTA file"""
+    header, sequence = None, []
+    with open_text(path) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(sequence)
+                header, sequence = line[1:], []
+            elif line:
+                sequence.append(line)
+    if header is not None:
+        yield header, "".join(sequence)
+
+
+def iter_dat_synonyms(path: Path) -> Iterator[tuple[str, list[str]]]:
+    """Yield (accession, names) from DE and GN lines of a UniProt DAT file"""
+    accession, names = None, []
+    with open_text(path) as f:
+        for line in f:
+            code, content = line[:2], line[5:].rstrip()
+            if code == "AC" and accession is None:
+                accession = content.split(";")[0].strip()
+            elif code == "DE":
+                for key in ("Full=", "Short="):
+                    if key in content:
+                        value = content.split(key, 1)[1].split(";")[0]
+                        names.append(EVIDENCE.sub("", value).strip())
+            elif code == "GN":
+                for item in content.split(";"):
+                    key, _, value = item.strip().partition("=")
+                    if key in ("Name", "Synonyms", "ORFNames", "OrderedLocusNames"):
+                        names.extend(
+                            EVIDENCE.sub("", v).strip() for v in value.split(",")
+                        )
+            elif code == "//":
+                if accession is not None:
+                    yield accession, [n for n in names if n]
+                accession, names = None, []
+
+
+def build_protein_index(
+    fasta_path: Path = UNIPROT_SPROT_FASTA,
+    index_folder: Path = UNIPROT_INDEX_FOLDER,
+    dat_path: Path | None = UNIPROT_SPROT_DAT,
+):
+    """
+    Build offline protein index from a Swiss-Prot FASTA dump
+
+    Sequences are concatenated into `sequences.bin`, names and offsets are
+    stored in `index.sqlite`. If a DAT dump is available, its protein and
+    gene synonyms are indexed too.
+    """
+    index_folder = Path(index_folder)
+    index_folder.mkdir(parents=True, exist_ok=True)
+    sequences_path = Path(index_folder, "sequences.bin")
+    db_path = Path(index_folder, "index.sqlite")
+    tmp_db_path = db_path.with_suffix(".sqlite.tmp")
+    tmp_db_path.unlink(missing_ok=True)
+
+    logger.info(f"Building protein index from {fasta_path}")
+    conn = sqlite3.connect(tmp_db_path)
+    conn.executescript(
+        """
+        CREATE TABLE entries (
+            accession TEXT PRIMARY KEY,
+            header TEXT NOT NULL,
+            organism TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE TABLE names (
+            name TEXT NOT NULL,
+            accession TEXT NOT NULL,
+            kind INTEGER NOT NULL
+        );
+        """
+    )
+
+    n_entries = 0
+    offset = 0
+    with open(sequences_path.with_suffix(".bin.tmp"), "wb") as seq_file:
+        for header, sequence in iter_fasta(fasta_path):
+            info = parse_fasta_header(header)
+            data = sequence.encode("ascii")
+            seq_file.write(data)
+            conn.execute(
+                "INSERT OR IGNORE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (info["accession"], header, info["organism"], offset, len(data)),
+            )
+            conn.executemany(
+                "INSERT INTO names VALUES (?, ?, ?)",
+                [
+                    (normalize_protein_name(name), info["accession"], kind)
+                    for name, kind in (
+                        (info["accession"], NAME_KIND_PRIORITY["accession"]),
+                        (info["entry_name"], NAME_KIND_PRIORITY["entry"]),
+                        (info["protein_name"], NAME_KIND_PRIORITY["protein"]),
+                        (info["gene"], NAME_KIND_PRIORITY["gene"]),
+                    )
+                    if name
+                ],
+            )
+            offset += len(data)
+            n_entries += 1
+
+    if dat_path is not None and Path(dat_path).exists():
+        logger.info(f"Adding protein synonyms from {dat_path}")
+        kind = NAME_KIND_PRIORITY["synonym"]
+        for accession, names in iter_dat_synonyms(dat_path):
+            conn.executemany(
+                "INSERT INTO names VALUES (?, ?, ?)",
+                [(normalize_protein_name(name), accession, kind) for name in set(names)],
+            )
+
+    conn.execute("CREATE INDEX names_name ON names (name)")
+    conn.commit()
+    conn.close()
+
+    sequences_path.with_suffix(".bin.tmp").replace(sequences_path)
+    tmp_db_path.replace(db_path)
+    logger.info(f"Indexed {n_entries} proteins to {index_folder}")
+
+
+class LocalProteinIndex:
+    """
+    Offline protein name -> FASTA lookup
+
+    Names are looked up in an SQLite index, sequences are read from
+    a memory-mapped file, so nothing is loaded into RAM up front.
+    """
+
+    def __init__(self, index_folder: Path = UNIPROT_INDEX_FOLDER):
+        index_folder = Path(index_folder)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            f"file:{Path(index_folder, 'index.sqlite')}?mode=ro",
+            uri=True,
+            check_same_thread=False,
+        )
+        self._sequences_file = open(Path(index_folder, "sequences.bin"), "rb")
+        self._sequences = mmap.mmap(
+            self._sequences_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+
+    def resolve(
+        self, protein_name: str, organism: str = "Homo sapiens"
+    ) -> dict[str, str] | None:
+        """
+        Find protein by accession, gene, protein name or synonym
+
+        Entries of the given organism are preferred.
+
+        Returns:
+            dict with header and sequence as from get_uniprot_fasta_by_gene,
+            or None if the name is unknown
+        """
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT e.header, e.offset, e.length
+                FROM names n JOIN entries e ON n.accession = e.accession
+                WHERE n.name = ?
+                ORDER BY e.organism = ? DESC, n.kind
+                LIMIT 1
+                """,
+                (normalize_protein_name(protein_name), organism),
+            ).fetchone()
+        if row is None:
+            return None
+
+        header, offset, length = row
+        sequence = self._sequences[offset : offset + length].decode("ascii")
+        return {"header": header, "sequence": sequence}
+
+
+@functools.lru_cache(maxsize=None)
+def get_protein_index() -> LocalProteinIndex | None:
+    """Shared protein index, built from the FASTA dump on first use if needed"""
+    index_folder = Path(UNIPROT_INDEX_FOLDER)
+    if not Path(index_folder, "index.sqlite").exists():
+        if not Path(UNIPROT_SPROT_FASTA).exists():
+            logger.warning(
+                f"No local protein index and no {UNIPROT_SPROT_FASTA}, "
+                + "proteins will be looked up online only"
+            )
+            return None
+        build_protein_index()
+    return LocalProteinIndex(index_folder)
+
+
+if __name__ == "__main__":
+    from config_logging import setup_logging
+
+    setup_logging()
+    build_protein_index()
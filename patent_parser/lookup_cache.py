@@ -0,0 +1,184 @@
+import asyncio
+import atexit
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+from config import (
+    LOOKUP_CACHE_PATH,
+    LOOKUP_CACHE_TTL,
+    LOOKUP_CACHE_NEGATIVE_TTL,
+    LOOKUP_CACHE_COMMIT_BATCH,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_key(key: str) -> str:
+    """Case and whitespace insensitive lookup key"""
+    return " ".join(str(key).split()).casefold()
+
+
+def is_not_found(result: Any) -> bool:
+    """
+    Lookup errors that mean the name is unknown, resolvers flag them with
+    "not_found", network errors are not cached
+    """
+    return isinstance(result, dict) and result.get("not_found") is True
+
+
+class LookupCache:
+    """
+    On-disk cache for external name lookups (name -> SMILES, name -> FASTA)
+
+    Successful lookups are kept for `ttl` seconds, "not found" answers for
+    `negative_ttl` seconds. Concurrent lookups of the same key share one
+    in-flight request.
+
+    New entries are buffered and written `commit_batch` at a time, call
+    `flush` when lookups are done. Async lookups read and write the
+    database off the event loop.
+    """
+
+    def __init__(
+        self,
+        path: Path = LOOKUP_CACHE_PATH,
+        ttl: float = LOOKUP_CACHE_TTL,
+        negative_ttl: float = LOOKUP_CACHE_NEGATIVE_TTL,
+        commit_batch: int = LOOKUP_CACHE_COMMIT_BATCH,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.commit_batch = commit_batch
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._in_flight: dict[tuple[str, str], asyncio.Task] = {}
+        # (namespace, key) -> (value json, is_negative, expires_at) not yet written
+        self._pending: dict[tuple[str, str], tuple[str, int, float]] = {}
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS lookups (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    is_negative INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+
+    def get(self, namespace: str, key: str) -> tuple[bool, Any]:
+        """Returns (found, value) for a not expired entry"""
+        entry_key = (namespace, normalize_key(key))
+        with self._lock:
+            pending = self._pending.get(entry_key)
+            if pending is not None:
+                row = (pending[0], pending[2])
+            else:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM lookups "
+                    + "WHERE namespace = ? AND key = ?",
+                    entry_key,
+                ).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any) -> bool:
+        """
+        Buffer lookup result, errors other than "not found" are not stored
+
+        Returns:
+            True if the buffer is full and should be flushed
+        """
+        is_negative = is_not_found(value)
+        if isinstance(value, dict) and "error" in value and not is_negative:
+            return False
+
+        ttl = self.negative_ttl if is_negative else self.ttl
+        with self._lock:
+            self._pending[(namespace, normalize_key(key))] = (
+                json.dumps(value, default=str),
+                int(is_negative),
+                time.time() + ttl,
+            )
+            return len(self._pending) >= self.commit_batch
+
+    def flush(self):
+        """Write buffered entries in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return
+            rows = [
+                (namespace, key, *entry)
+                for (namespace, key), entry in self._pending.items()
+            ]
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?, ?)", rows
+                )
+            self._pending.clear()
+
+    async def get_or_fetch(
+        self, namespace: str, key: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Return cached value or fetch it
+
+        Args:
+            namespace: Kind of lookup, e.g. "smiles" or "fasta"
+            key: Looked up name
+            fetch: Coroutine function doing the actual lookup
+
+        Returns:
+            Lookup result
+        """
+        found, value = await asyncio.to_thread(self.get, namespace, key)
+        if found:
+            self.hits += 1
+            return value
+
+        flight_key = (namespace, normalize_key(key))
+        task = self._in_flight.get(flight_key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch_and_store(namespace, key, fetch))
+            self._in_flight[flight_key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(flight_key, None))
+        else:
+            self.hits += 1
+
+        # Shield so that a cancelled caller does not cancel the shared lookup
+        return await asyncio.shield(task)
+
+    async def _fetch_and_store(
+        self, namespace: str, key: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        value = await fetch()
+        if self.set(namespace, key, value):
+            await asyncio.to_thread(self.flush)
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_lookup_cache() -> LookupCache:
+    """Shared lookup cache, opened on first use"""
+    cache = LookupCache()
+    # Entries of lookups after the last flush, e.g. by agent tools
+    atexit.register(cache.flush)
+    logger.info(f"Using lookup cache {cache.path}")
+    return cache
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import time
+
+from metrics import get_metrics
+
+from config import (
+    EVENT_LOOP_LAG_INTERVAL,
+    EVENT_LOOP_STALL_THRESHOLD,
+    METRICS_LOOP_LAG_BUCKETS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopLagMonitor:
+    """
+    Measure how late the event loop wakes up a task sleeping for `interval`
+
+    Lag above `stall_threshold` seconds means something blocked the loop,
+    e.g. CPU-heavy work that belongs in a worker pool, and is logged as a stall.
+    """
+
+    def __init__(
+        self,
+        interval: float = EVENT_LOOP_LAG_INTERVAL,
+        stall_threshold: float = EVENT_LOOP_STALL_THRESHOLD,
+    ):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.n_samples = 0
+        self.n_stalls = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.stalled_time = 0.0
+        self._task: asyncio.Task | None = None
+        self._lag = get_metrics().histogram(
+            "event_loop_lag_seconds", "Event loop wake-up lag", METRICS_LOOP_LAG_BUCKETS
+        )
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.log_summary()
+
+    def record(self, lag: float):
+        self.n_samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+        self._lag.observe(lag)
+        if lag >= self.stall_threshold:
+            self.n_stalls += 1
+            self.stalled_time += lag
+            logger.warning(f"Event loop stalled for {lag:.3f} s")
+
+    def log_summary(self):
+        mean_lag = self.total_lag / self.n_samples if self.n_samples else 0.0
+        logger.info(
+            f"Event loop lag: mean {mean_lag * 1000:.1f} ms, "
+            + f"max {self.max_lag * 1000:.1f} ms, {self.n_stalls} stalls "
+            + f"({self.stalled_time:.2f} s)"
+        )
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, time.perf_counter() - started - self.interval))
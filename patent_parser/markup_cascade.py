@@ -0,0 +1,176 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from dataclasses import dataclass, field
+from typing import Any
+
+from dotenv import load_dotenv
+
+from run_binding_markup_async import ask_markup_verdict
+from config import MARKUP_CASCADE_TIERS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+@dataclass
+class TierStats:
+    """
+    Dataclass to store traffic statistics of a cascade tier
+    """
+
+    calls: int = 0
+    errors: int = 0
+    accepted_positive: int = 0
+    accepted_negative: int = 0
+    escalated: int = 0
+    total_latency: float = 0.0
+
+
+@dataclass
+class CascadeTier:
+    """
+    Dataclass to store a single model tier of markup cascade
+    """
+
+    name: str
+    base_url: str
+    api_key: str
+    model: str
+    max_concurrent: int
+    output_mode: str
+    negative_below: float
+    positive_above: float | None = None
+    semaphore: asyncio.Semaphore = field(init=False, repr=False)
+    stats: TierStats = field(default_factory=TierStats)
+
+    def __post_init__(self):
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+
+
+@functools.lru_cache(maxsize=None)
+def get_cascade_tiers() -> tuple[CascadeTier, ...]:
+    """Build cascade tiers from config, endpoints are read from env"""
+    tiers = []
+    for tier_config in MARKUP_CASCADE_TIERS:
+        prefix = tier_config["env_prefix"]
+        tiers.append(
+            CascadeTier(
+                name=tier_config["name"],
+                base_url=os.getenv(f"{prefix}LLM_BASE_URL"),
+                api_key=os.getenv(f"{prefix}LLM_API_KEY"),
+                model=os.getenv(f"{prefix}MODEL"),
+                max_concurrent=tier_config["max_concurrent"],
+                output_mode=tier_config["output_mode"],
+                negative_below=tier_config["negative_below"],
+                positive_above=tier_config.get("positive_above"),
+            )
+        )
+    return tuple(tiers)
+
+
+async def ask_cascade_verdict(
+    text: str, tiers: tuple[CascadeTier, ...] | None = None
+) -> dict[str, Any]:
+    """
+    Ask tiers one by one if a fragment of patent text has binding info
+
+    A tier decides the chunk only if its verdict is confident enough, otherwise
+    the chunk is escalated. The last tier always decides.
+
+    Returns:
+        Verdict dict as from ask_markup_verdict with the deciding tier name
+    """
+    tiers = tiers or get_cascade_tiers()
+
+    for indx, tier in enumerate(tiers):
+        is_last = indx == len(tiers) - 1
+
+        start = time.perf_counter()
+        res = await ask_markup_verdict(
+            text,
+            output_mode=tier.output_mode,
+            base_url=tier.base_url,
+            api_key=tier.api_key,
+            model=tier.model,
+            semaphore=tier.semaphore,
+            api=f"markup_{tier.name}",
+        )
+        tier.stats.calls += 1
+        tier.stats.total_latency += time.perf_counter() - start
+
+        if "error" in res:
+            tier.stats.errors += 1
+            if is_last:
+                return res
+            tier.stats.escalated += 1
+            continue
+
+        confidence = res["confidence"]
+        if confidence is None:
+            # Without a confidence the thresholds cannot be applied, only the
+            # last tier decides on the verdict alone
+            if not is_last:
+                tier.stats.escalated += 1
+                continue
+            confidence = 1.0 if res["has_binding_info"] else 0.0
+
+        if is_last:
+            is_positive = res["has_binding_info"]
+        elif confidence < tier.negative_below:
+            is_positive = False
+        elif tier.positive_above is not None and confidence >= tier.positive_above:
+            is_positive = True
+        else:
+            tier.stats.escalated += 1
+            continue
+
+        if is_positive:
+            tier.stats.accepted_positive += 1
+        else:
+            tier.stats.accepted_negative += 1
+        return {
+            "has_binding_info": is_positive,
+            "confidence": confidence,
+            "tier": tier.name,
+        }
+
+    return {"error": "No cascade tiers configured"}
+
+
+def get_cascade_stats(
+    tiers: tuple[CascadeTier, ...] | None = None,
+) -> list[dict[str, Any]]:
+    """Per-tier traffic summary"""
+    tiers = tiers or get_cascade_tiers()
+    total_chunks = tiers[0].stats.calls if tiers else 0
+
+    summary = []
+    for tier in tiers:
+        stats = tier.stats
+        decided = stats.accepted_positive + stats.accepted_negative
+        summary.append(
+            {
+                "tier": tier.name,
+                "model": tier.model,
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "accepted_positive": stats.accepted_positive,
+                "accepted_negative": stats.accepted_negative,
+                "escalated": stats.escalated,
+                "share_decided": decided / total_chunks if total_chunks else 0.0,
+                "mean_latency": (
+                    stats.total_latency / stats.calls if stats.calls else 0.0
+                ),
+            }
+        )
+    return summary
+
+
+def log_cascade_stats(tiers: tuple[CascadeTier, ...] | None = None):
+    for tier_summary in get_cascade_stats(tiers):
+        logger.info(f"Markup cascade tier stats: {tier_summary}")
@@ -0,0 +1,387 @@
+import functools
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+
+from pathlib import Path
+from typing import Iterator
+
+from parse_pdfs import Chunk, Patent
+from serialization import read_json, read_json_files
+from config import (
+    CORPUS_STORE_PATH,
+    CORPUS_TEXT_BLOCK_SIZE,
+    CORPUS_COMPRESSION_LEVEL,
+    CORPUS_COMMIT_BATCH_SIZE,
+    INITIAL_PDF_CHUNK_SIZE,
+    CHUNK_OVERLAPS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def covering_blocks(start: int, end: int, block_size: int) -> range:
+    """Indices of text blocks holding symbols start:end"""
+    return range(start // block_size, (end - 1) // block_size + 1)
+
+
+class CorpusStore:
+    """
+    Single-file store of marked up patents
+
+    Each patent text is stored once, compressed in blocks of `block_size` symbols,
+    next to per-patent metadata and offsets and verdicts of all chunks. Listing
+    patents does not touch any text and loading positive chunks decompresses
+    only the blocks they cover.
+
+    Added patents are buffered and committed in one transaction every
+    `commit_batch_size` patents, a patent is either stored whole or not at all.
+    """
+
+    def __init__(
+        self,
+        path: Path = CORPUS_STORE_PATH,
+        block_size: int = CORPUS_TEXT_BLOCK_SIZE,
+        compression_level: int = CORPUS_COMPRESSION_LEVEL,
+        commit_batch_size: int = CORPUS_COMMIT_BATCH_SIZE,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.block_size = block_size
+        self.compression_level = compression_level
+        self.commit_batch_size = commit_batch_size
+
+        self._lock = threading.Lock()
+        self._pending: list[tuple] = []
+        # Sharded workers of one host commit to the same file
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS patents (
+                    name TEXT PRIMARY KEY,
+                    country TEXT NOT NULL,
+                    local_path TEXT NOT NULL,
+                    has_binding_info INTEGER NOT NULL,
+                    is_too_short INTEGER NOT NULL,
+                    full_text_len INTEGER NOT NULL,
+                    n_pages INTEGER NOT NULL,
+                    chunk_size INTEGER NOT NULL,
+                    chunk_overlaps INTEGER NOT NULL,
+                    text_block_size INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS text_blocks (
+                    patent TEXT NOT NULL,
+                    block_index INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (patent, block_index)
+                )
+                """
+            )
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chunks (
+                    patent TEXT NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    start INTEGER NOT NULL,
+                    end INTEGER NOT NULL,
+                    has_binding_info INTEGER NOT NULL,
+                    binding_confidence REAL,
+                    PRIMARY KEY (patent, chunk_index)
+                )
+                """
+            )
+
+    def add_patent(self, patent: Patent) -> list[str]:
+        """
+        Add a marked up patent, replacing its previous version on commit
+
+        The text is compressed by the caller's thread, the batch is committed
+        once it is full.
+
+        Returns:
+            Names of patents committed by this call, empty while the batch fills
+        """
+        if len(patent.full_text) != patent.full_text_len:
+            raise ValueError(f"{patent.name} was loaded without its full text")
+
+        positive = set(patent.chunks_with_binding_info)
+        chunks = [
+            (
+                patent.name,
+                indx,
+                chunk.start,
+                chunk.end,
+                int(chunk.has_binding_info or indx in positive),
+                chunk.binding_confidence,
+            )
+            for indx, chunk in enumerate(patent.chunks)
+        ]
+        blocks = [
+            (
+                patent.name,
+                indx,
+                zlib.compress(
+                    patent.full_text[start : start + self.block_size].encode("utf-8"),
+                    self.compression_level,
+                ),
+            )
+            for indx, start in enumerate(
+                range(0, len(patent.full_text), self.block_size)
+            )
+        ]
+        row = (
+            patent.name,
+            patent.country,
+            str(patent.local_path),
+            int(patent.has_binding_info),
+            int(patent.is_too_short),
+            len(patent.full_text),
+            patent.n_pages,
+            patent.chunk_size,
+            patent.chunk_overlaps,
+            self.block_size,
+        )
+
+        with self._lock:
+            self._pending.append((row, blocks, chunks))
+            if len(self._pending) < self.commit_batch_size:
+                return []
+            return self._commit_pending()
+
+    def commit(self) -> list[str]:
+        """Commit buffered patents, returns their names"""
+        with self._lock:
+            return self._commit_pending()
+
+    def _commit_pending(self) -> list[str]:
+        if not self._pending:
+            return []
+        updated_at = time.time()
+        with self._conn:
+            for row, blocks, chunks in self._pending:
+                name = row[0]
+                for table, column in (
+                    ("patents", "name"),
+                    ("text_blocks", "patent"),
+                    ("chunks", "patent"),
+                ):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE {column} = ?", (name,)
+                    )
+                self._conn.execute(
+                    "INSERT INTO patents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*row, updated_at),
+                )
+                self._conn.executemany(
+                    "INSERT INTO text_blocks VALUES (?, ?, ?)", blocks
+                )
+                self._conn.executemany(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?)", chunks
+                )
+        logger.info(f"Committed {len(self._pending)} patents to {self.path}")
+        names = [row[0] for row, _, _ in self._pending]
+        self._pending = []
+        return names
+
+    def has_patent(self, name: str) -> bool:
+        """Whether the patent is committed"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM patents WHERE name = ?", (name,)
+            ).fetchone()
+        return row is not None
+
+    def updated_at(self) -> dict[str, float]:
+        """Time each committed patent was last updated"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT name, updated_at FROM patents"))
+
+    def patent_names(self, with_binding_info: bool = True) -> list[str]:
+        """Names of patents with binding info, or of all committed patents"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM patents WHERE has_binding_info >= ? ORDER BY name",
+                (int(with_binding_info),),
+            ).fetchall()
+        return [name for (name,) in rows]
+
+    def _read_blocks(self, name: str, block_indices: list[int]) -> dict[int, str]:
+        rows = self._conn.execute(
+            f"""
+            SELECT block_index, data FROM text_blocks
+            WHERE patent = ? AND block_index IN ({",".join("?" * len(block_indices))})
+            """,
+            (name, *block_indices),
+        ).fetchall()
+        return {indx: zlib.decompress(data).decode("utf-8") for indx, data in rows}
+
+    def load_patent(self, name: str, positive_only: bool = True) -> Patent | None:
+        """
+        Patent with chunk offsets and verdicts
+
+        Args:
+            name: Patent name
+            positive_only: Read only texts of positive chunks and no full text,
+                other chunks have empty texts
+
+        Returns:
+            Patent or None if it is not in the store
+        """
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT country, local_path, has_binding_info, is_too_short,
+                    full_text_len, n_pages, chunk_size, chunk_overlaps, text_block_size
+                FROM patents WHERE name = ?
+                """,
+                (name,),
+            ).fetchone()
+            if row is None:
+                return None
+            chunk_rows = self._conn.execute(
+                """
+                SELECT start, end, has_binding_info, binding_confidence
+                FROM chunks WHERE patent = ? ORDER BY chunk_index
+                """,
+                (name,),
+            ).fetchall()
+
+            block_size = row[-1]
+            if positive_only:
+                block_indices = sorted(
+                    {
+                        block
+                        for start, end, has_binding_info, _ in chunk_rows
+                        if has_binding_info and end > start
+                        for block in covering_blocks(start, end, block_size)
+                    }
+                )
+            else:
+                block_indices = list(covering_blocks(0, row[4], block_size))
+            blocks = self._read_blocks(name, block_indices) if block_indices else {}
+
+        (
+            country,
+            local_path,
+            has_binding_info,
+            is_too_short,
+            full_text_len,
+            n_pages,
+            chunk_size,
+            chunk_overlaps,
+            _,
+        ) = row
+
+        def read_range(start: int, end: int) -> str:
+            indices = covering_blocks(start, end, block_size)
+            text = "".join(blocks[indx] for indx in indices)
+            offset = indices.start * block_size
+            return text[start - offset : end - offset]
+
+        patent = Patent(
+            name=name,
+            country=country,
+            local_path=Path(local_path),
+            has_binding_info=bool(has_binding_info),
+            n_pages=n_pages,
+            chunk_size=chunk_size,
+            chunk_overlaps=chunk_overlaps,
+        )
+        # Chunks come from the store rather than from chunking the full text
+        patent.full_text = "" if positive_only else read_range(0, full_text_len)
+        patent.full_text_len = full_text_len
+        patent.is_too_short = bool(is_too_short)
+        patent.chunks = []
+        for indx, (start, end, chunk_has_binding_info, confidence) in enumerate(
+            chunk_rows
+        ):
+            has_text = (not positive_only or chunk_has_binding_info) and end > start
+            patent.chunks.append(
+                Chunk(
+                    start,
+                    end,
+                    read_range(start, end) if has_text else "",
+                    has_binding_info=bool(chunk_has_binding_info),
+                    binding_confidence=confidence,
+                )
+            )
+            if chunk_has_binding_info:
+                patent.chunks_with_binding_info.append(indx)
+        return patent
+
+    def iter_patents(
+        self, with_binding_info: bool = True, positive_only: bool = True
+    ) -> Iterator[Patent]:
+        for name in self.patent_names(with_binding_info):
+            patent = self.load_patent(name, positive_only)
+            if patent is not None:
+                yield patent
+
+    def index_json_checkpoints(self, folder: Path) -> int:
+        """
+        Add JSON markup checkpoints that are new or changed since they were stored
+
+        Returns:
+            Number of added checkpoints
+        """
+        updated_at = self.updated_at()
+        json_files = [
+            json_file
+            for json_file in sorted(Path(folder).glob("*.json"))
+            if json_file.stat().st_mtime > updated_at.get(json_file.stem, 0.0)
+        ]
+        n_added = 0
+        for json_file, data in read_json_files(json_files):
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                self.add_patent(load_checkpoint_patent(json_file, data))
+                n_added += 1
+            except Exception as e:
+                logger.warning(f"Failed to add {json_file}: {e}")
+        self.commit()
+        logger.info(f"Added {n_added} JSON markup checkpoints from {folder}")
+        return n_added
+
+
+def load_checkpoint_patent(json_file_path: Path, data: dict | None = None) -> Patent:
+    """Patent of a JSON markup checkpoint with its chunk verdicts"""
+    if data is None:
+        data = read_json(json_file_path)
+
+    patent = Patent(
+        name=data.get("name", json_file_path.stem),
+        country=data.get("country", ""),
+        local_path=Path(data.get("local_path") or json_file_path),
+        full_text=data.get("full_text", ""),
+        n_pages=data.get("n_pages", 0),
+        chunk_size=data.get("chunk_size", INITIAL_PDF_CHUNK_SIZE),
+        chunk_overlaps=data.get("chunk_overlaps", CHUNK_OVERLAPS),
+        has_binding_info=data.get("has_binding_info", False),
+    )
+    patent.chunks_with_binding_info = [
+        indx
+        for indx in data.get("chunks_with_binding_info", [])
+        if 0 <= indx < len(patent.chunks)
+    ]
+    for chunk, chunk_data in zip(patent.chunks, data.get("chunks", [])):
+        chunk.has_binding_info = bool(chunk_data.get("has_binding_info"))
+        chunk.binding_confidence = chunk_data.get("binding_confidence")
+    return patent
+
+
+@functools.lru_cache(maxsize=None)
+def get_corpus_store() -> CorpusStore:
+    """Shared corpus store, opened on first use"""
+    store = CorpusStore()
+    logger.info(f"Using corpus store {store.path}")
+    return store
@@ -0,0 +1,306 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import math
+import os
+import threading
+import time
+
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterator
+
+from config import METRICS_TEXTFILE_PATH, METRICS_LATENCY_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "patent_parser_"
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def to_labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels: Labels, extra: dict[str, str] | None = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = (
+        (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, lock: threading.Lock):
+        self.name = PREFIX + name
+        self.help = help
+        self._lock = lock
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    """Monotonically increasing value, e.g. number of requests"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, lock: threading.Lock):
+        super().__init__(name, help, lock)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, value: float = 1, **labels: Any):
+        key = to_labels(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self.values)
+        return super().render() + [
+            f"{self.name}{format_labels(key)} {format_value(value)}"
+            for key, value in sorted(values.items())
+        ]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, e.g. queue depth"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: Any):
+        with self._lock:
+            self.values[to_labels(labels)] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, e.g. latencies"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        lock: threading.Lock,
+        buckets: tuple[float, ...] = METRICS_LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, lock)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labels -> [bucket counts..., count, sum]
+        self.values: dict[Labels, list[float]] = {}
+        # labels -> largest observed value, bounds quantile estimates
+        self.max_values: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: Any):
+        key = to_labels(labels)
+        with self._lock:
+            series = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for indx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[indx] += 1
+                    break
+            series[-2] += 1
+            series[-1] += value
+            self.max_values[key] = max(self.max_values.get(key, value), value)
+
+    @contextlib.contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        """Observe duration of the block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q: float, labels: Labels) -> float:
+        """
+        Estimate of a quantile, interpolated linearly inside its bucket
+
+        Estimates are capped by the largest observed value, so a few fast
+        observations in a wide bucket are not reported as slow.
+        """
+        with self._lock:
+            series = list(self.values[labels])
+            max_value = self.max_values[labels]
+        return min(self._quantile(q, series), max_value)
+
+    def _quantile(self, q: float, series: list[float]) -> float:
+        count = series[-2]
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for indx, bound in enumerate(self.buckets):
+            in_bucket = series[indx]
+            if in_bucket and cumulative + in_bucket >= rank:
+                # Above the last bound only the largest value is known
+                if math.isinf(bound):
+                    return bound
+                return lower + (bound - lower) * (rank - cumulative) / in_bucket
+            cumulative += in_bucket
+            lower = bound
+        return lower
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = {key: list(series) for key, series in self.values.items()}
+        lines = super().render()
+        for key, series in sorted(values.items()):
+            cumulative = 0
+            for indx, bound in enumerate(self.buckets):
+                cumulative += series[indx]
+                le = {"le": format_value(bound)}
+                lines.append(
+                    f"{self.name}_bucket{format_labels(key, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_count{format_labels(key)} {series[-2]}")
+            lines.append(
+                f"{self.name}_sum{format_labels(key)} {format_value(series[-1])}"
+            )
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of a pipeline run
+
+    Metrics are created on first use by name and are safe to update from
+    the event loop and from worker threads.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._metrics: dict[str, Metric] = {}
+
+    def _get(self, cls, name: str, help: str, **kwargs: Any):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, threading.Lock(), **kwargs)
+                self._metrics[name] = metric
+        if type(metric) is not cls:
+            raise ValueError(f"Metric {name} is a {metric.kind}")
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(
+        self, name: str, help: str, buckets: tuple[float, ...] = METRICS_LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self) -> str:
+        """Metrics in Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "".join(line + "\n" for metric in metrics for line in metric.render())
+
+    def write_textfile(self, path: Path = METRICS_TEXTFILE_PATH):
+        """Write metrics atomically, so collectors never read a partial file"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(self.render())
+        tmp_path.replace(path)
+
+    def summary(self) -> list[str]:
+        """Human readable summary: totals and rates, latency percentiles"""
+        elapsed = max(time.time() - self.started_at, 1e-9)
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = [f"Metrics after {elapsed:.1f} s:"]
+        for metric in metrics:
+            name = metric.name.removeprefix(PREFIX)
+            with metric._lock:
+                keys = sorted(metric.values)
+            for key in keys:
+                series = f"{name}{format_labels(key)}"
+                if isinstance(metric, Histogram):
+                    count, total = metric.values[key][-2], metric.values[key][-1]
+                    if not count:
+                        continue
+                    lines.append(
+                        f"  {series}: n={count:g}, mean={total / count:.3f}, "
+                        + f"p50={metric.quantile(0.5, key):.3f}, "
+                        + f"p95={metric.quantile(0.95, key):.3f}, "
+                        + f"p99={metric.quantile(0.99, key):.3f}"
+                    )
+                elif isinstance(metric, Gauge):
+                    lines.append(f"  {series}: {metric.values[key]:g}")
+                else:
+                    value = metric.values[key]
+                    lines.append(f"  {series}: {value:g} ({value / elapsed:.2f}/s)")
+        return lines
+
+    def log_summary(self):
+        for line in self.summary():
+            logger.info(line)
+
+    def export(self, path: Path = METRICS_TEXTFILE_PATH):
+        """End of run export: Prometheus textfile and summary in the log"""
+        try:
+            self.write_textfile(path)
+            logger.info(f"Saved metrics to {path}")
+        except OSError as e:
+            logger.warning(f"Failed to save metrics to {path}: {e}")
+        self.log_summary()
+
+
+@functools.lru_cache(maxsize=None)
+def get_metrics() -> MetricsRegistry:
+    """Metrics registry of the process"""
+    return MetricsRegistry()
+
+
+@contextlib.asynccontextmanager
+async def acquire_timed(
+    semaphore: asyncio.Semaphore, name: str
+) -> AsyncIterator[None]:
+    """Hold the semaphore, recording how long it took to get a slot"""
+    started = time.perf_counter()
+    async with semaphore:
+        get_metrics().histogram(
+            "semaphore_wait_seconds", "Time waited for a concurrency slot"
+        ).observe(time.perf_counter() - started, semaphore=name)
+        yield
+
+
+def record_llm_call(api: str, started: float, status: str, usage: Any = None):
+    """
+    Record latency, status and token usage of an LLM request
+
+    Args:
+        api: Kind of request, e.g. "markup" or "extraction"
+        started: time.perf_counter() before the request
+        status: "ok" or error kind
+        usage: `usage` of an OpenAI-compatible response, if any
+    """
+    metrics = get_metrics()
+    metrics.histogram(
+        "llm_request_seconds", "Latency of LLM requests, including failed ones"
+    ).observe(time.perf_counter() - started, api=api, status=status)
+    if usage is None:
+        return
+    tokens = metrics.counter("llm_tokens_total", "Tokens used by LLM requests")
+    for kind in ("prompt_tokens", "completion_tokens"):
+        n_tokens = getattr(usage, kind, None)
+        if n_tokens:
+            tokens.inc(n_tokens, api=api, kind=kind.removesuffix("_tokens"))
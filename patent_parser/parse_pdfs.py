@@ -2,9 +2,7 @@ import logging
 
 from pathlib import Path
 from dataclasses import dataclass, field
-from typing import Any
-
-import pdftotext
+from typing import Any, Iterator
 
 from config import INITIAL_PDF_CHUNK_SIZE, CHUNK_OVERLAPS, MIN_PDF_TEXT_LENGTH
 
@@ -26,6 +24,7 @@ class Chunk:
     end: int
     text: str = field(repr=False)
     has_binding_info: bool = False
+    binding_confidence: float | None = None
     tags: list[str] = field(default_factory=list)
     compounds: list[str] = field(default_factory=list)
     connected_objs: list[Any] = field(default_factory=list)
@@ -53,13 +52,7 @@ class Patent:
     def __post_init__(self):
         text_len = len(self.full_text)
         self.full_text_len = text_len
-        size = self.chunk_size
-        overlaps = max(1, self.chunk_overlaps)
-        step = size // overlaps
-        if step <= 0:
-            raise ValueError(
-                f"chunk_size ({size}) must be >= chunk_overlaps ({overlaps})"
-            )
+        offsets = chunk_offsets(text_len, self.chunk_size, self.chunk_overlaps)
 
         if text_len < MIN_PDF_TEXT_LENGTH:
             self.is_too_short = True
@@ -67,20 +60,150 @@ class Patent:
             self.chunks = []
             return
 
-        chunks: list[Chunk] = []
-        for start in range(0, text_len, step):
-            end = start + size
-            if end >= text_len:
-                end = text_len
-                chunks.append(Chunk(start, end, self.full_text[start:end]))
-                break
-            chunks.append(Chunk(start, end, self.full_text[start:end]))
+        self.chunks = [
+            Chunk(start, end, self.full_text[start:end]) for start, end in offsets
+        ]
+
+
+def chunk_offsets(text_len: int, size: int, overlaps: int) -> list[tuple[int, int]]:
+    """(start, end) of the overlapping chunks of a text of text_len symbols"""
+    overlaps = max(1, overlaps)
+    step = size // overlaps
+    if step <= 0:
+        raise ValueError(f"chunk_size ({size}) must be >= chunk_overlaps ({overlaps})")
+
+    offsets = []
+    for start in range(0, text_len, step):
+        end = start + size
+        if end >= text_len:
+            offsets.append((start, text_len))
+            break
+        offsets.append((start, end))
+    return offsets
+
+
+def get_coarse_windows(patent: Patent) -> list[Chunk]:
+    """Split patent text into non-overlapping windows of patent chunk size"""
+    size = patent.chunk_size
+    text_len = len(patent.full_text)
+    return [
+        Chunk(start, min(start + size, text_len), patent.full_text[start : start + size])
+        for start in range(0, text_len, size)
+    ]
+
+
+def get_chunks_near_windows(
+    patent: Patent,
+    windows: list[Chunk],
+    positive_windows: list[int],
+    n_neighbors: int = 1,
+) -> list[int]:
+    """
+    Find indices of patent chunks that intersect positive windows
+
+    Args:
+        patent: Patent with overlapping chunks
+        windows: Non-overlapping windows from get_coarse_windows
+        positive_windows: Indices of windows marked as having binding info
+        n_neighbors: Number of neighbouring windows on each side to include
+
+    Returns:
+        Sorted list of patent chunk indices
+    """
+    selected = set()
+    for indx in positive_windows:
+        for neighbor in range(indx - n_neighbors, indx + n_neighbors + 1):
+            if 0 <= neighbor < len(windows):
+                selected.add(neighbor)
+
+    # Merge selected windows into contiguous character ranges
+    ranges: list[list[int]] = []
+    for indx in sorted(selected):
+        window = windows[indx]
+        if ranges and ranges[-1][1] >= window.start:
+            ranges[-1][1] = max(ranges[-1][1], window.end)
+        else:
+            ranges.append([window.start, window.end])
+
+    chunk_indices = []
+    range_indx = 0
+    for indx, chunk in enumerate(patent.chunks):
+        # Chunks are sorted by start, so ranges ending before the chunk are done
+        while range_indx < len(ranges) and ranges[range_indx][1] <= chunk.start:
+            range_indx += 1
+        if range_indx == len(ranges):
+            break
+        if chunk.end > ranges[range_indx][0]:
+            chunk_indices.append(indx)
 
-        self.chunks = chunks
+    return chunk_indices
+
+
+def split_span(span: Chunk, max_size: int) -> list[Chunk]:
+    """Split span into non-overlapping pieces, cutting at line ends where possible"""
+    pieces = []
+    offset = 0
+    while len(span.text) - offset > max_size:
+        cut = span.text.rfind("\n", offset + max_size * 9 // 10, offset + max_size)
+        cut = cut + 1 if cut != -1 else offset + max_size
+        pieces.append(
+            Chunk(span.start + offset, span.start + cut, span.text[offset:cut])
+        )
+        offset = cut
+    pieces.append(Chunk(span.start + offset, span.end, span.text[offset:]))
+    return pieces
+
+
+def merge_positive_chunks(patent: Patent, max_span_size: int) -> list[tuple[int, Chunk]]:
+    """
+    Merge overlapping or adjacent positive chunks into non-overlapping spans
+
+    Span text is assembled from chunk texts, so the patent full text is not needed.
+    Spans longer than max_span_size are split.
+
+    Args:
+        patent: Patent with marked up chunks
+        max_span_size: Max span length in symbols
+
+    Returns:
+        List of (index of the chunk the span starts in, span)
+    """
+    positive_chunks = sorted(
+        (
+            (indx, chunk)
+            for indx, chunk in enumerate(patent.chunks)
+            if chunk.has_binding_info
+        ),
+        key=lambda item: item[1].start,
+    )
+
+    merged: list[tuple[list[int], Chunk]] = []
+    for indx, chunk in positive_chunks:
+        if merged and merged[-1][1].end >= chunk.start:
+            indices, span = merged[-1]
+            if chunk.end > span.end:
+                span.text += chunk.text[span.end - chunk.start :]
+                span.end = chunk.end
+            indices.append(indx)
+        else:
+            merged.append(([indx], Chunk(chunk.start, chunk.end, chunk.text)))
+
+    spans = []
+    for indices, span in merged:
+        for piece in split_span(span, max_span_size):
+            # Last merged chunk starting at or before the piece
+            start_indx = indices[0]
+            for indx in indices:
+                if patent.chunks[indx].start <= piece.start:
+                    start_indx = indx
+            spans.append((start_indx, piece))
+    return spans
 
 
 def convert_pdf_to_text(path_to_pdf: Path | str):
     """Converts binary pdf into text"""
+    # Poppler bindings are only needed for parsing, not for loading stored patents
+    import pdftotext
 
     with open(path_to_pdf, "rb") as f:
         try:
@@ -139,3 +262,9 @@ def parse_pdfs(pdf_paths: list[Path]) -> list[Patent]:
         patent = parse_pdf_to_patent(pdf_path)
         patent_list.append(patent)
     return patent_list
+
+
+def iter_parse_pdfs(pdf_paths: list[Path]) -> Iterator[Patent]:
+    """Lazily parse PDF files into Patent objects one at a time"""
+    for pdf_path in pdf_paths:
+        yield parse_pdf_to_patent(pdf_path)
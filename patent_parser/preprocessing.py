@@ -5,10 +5,13 @@ from pathlib import Path
 
 import pandas as pd
 import pyarrow.parquet as pq
-import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 
+from http_client import get_http_client, run_sync
+from utils import map_bounded
+
+from config import DOWNLOAD_WORKERS
 
 logger = logging.getLogger(__name__)
 
@@ -18,23 +21,29 @@ class ChunksUsageError(Exception):
 
 
 def download_ftp_files(ftp_index_url: str, output_dir: Path, include_exts=None):
-    """Download all files from ftp recursively"""
+    """Synchronous download_ftp_files_async, for scripts"""
+    return run_sync(download_ftp_files_async(ftp_index_url, output_dir, include_exts))
+
+
+async def download_ftp_files_async(
+    ftp_index_url: str, output_dir: Path, include_exts=None
+):
+    """Download all files from ftp index with a worker pool, host limits apply"""
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
     logger.info(f"Fetching index: {ftp_index_url}")
-    resp = requests.get(ftp_index_url)
+    client = get_http_client()
+    resp = await client.get(ftp_index_url)
     resp.raise_for_status()
 
     soup = BeautifulSoup(resp.text, "html.parser")
 
-    # Collect candidate file links
-    anchors = soup.find_all("a")
-    downloaded = []
+    to_download = []
     skipped_existing = []
     skipped_filtered = []
 
-    for a in anchors:
+    for a in soup.find_all("a"):
         href = a.get("href")
         if not href:
             continue
@@ -43,15 +52,10 @@ def download_ftp_files(ftp_index_url: str, output_dir: Path, include_exts=None):
         if href.startswith("?") or href.endswith("/"):
             continue
 
-        # Full URL to the file
-        file_url = urljoin(ftp_index_url, href)
-
-        # Derive a clean filename from the last path component
-        filename = Path(href).name  # handles cases like "subdir/file.txt"
+        filename = Path(href).name
         if not filename:
             continue
 
-        # Extension filter (if provided)
         if include_exts is not None:
             ext = Path(filename).suffix.lower()
             if ext not in include_exts:
@@ -59,25 +63,27 @@ def download_ftp_files(ftp_index_url: str, output_dir: Path, include_exts=None):
                 continue
 
         dest_path = output_dir / filename
-
         if dest_path.exists():
             logger.info(f"Skipping existing file: {filename}")
             skipped_existing.append(filename)
             continue
 
-        logger.info(f"Downloading: {filename}")
-        with requests.get(file_url, stream=True) as r:
-            r.raise_for_status()
-            with dest_path.open("wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        to_download.append((urljoin(ftp_index_url, href), dest_path))
 
+    async def download(file_url: str, dest_path: Path):
+        logger.info(f"Downloading: {dest_path.name}")
+        status_code = await client.download(file_url, dest_path)
+        if status_code != 200:
+            raise RuntimeError(f"Failed to download {file_url}: {status_code}")
         logger.info(f"Saved to: {dest_path}")
-        downloaded.append(filename)
+        return dest_path.name
+
+    downloaded = await map_bounded(
+        lambda args: download(*args), to_download, DOWNLOAD_WORKERS
+    )
 
     return {
-        "downloaded": downloaded,
+        "downloaded": list(downloaded),
         "skipped_existing": skipped_existing,
         "skipped_filtered": skipped_filtered,
     }
@@ -1,6 +1,8 @@
-import requests
+import httpx
 import logging
 
+from http_client import get_http_client, run_sync
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,34 +16,55 @@ def parse_fasta(fasta_string: str) -> tuple[str, str]:
 def get_uniprot_fasta_by_gene(
     protein_name: str, organism: str = "Homo sapiens"
 ) -> dict[str, str]:
+    """Synchronous get_uniprot_fasta_by_gene_async, for scripts"""
+    return run_sync(get_uniprot_fasta_by_gene_async(protein_name, organism))
+
+
+async def get_uniprot_fasta_by_gene_async(
+    protein_name: str, organism: str = "Homo sapiens"
+) -> dict[str, str]:
+    """
+    Fetch FASTA of a reviewed UniProt entry by protein name and organism
+
+    Returns:
+        dict with header and sequence, or dict with error, "not_found" is True
+        if UniProt has no entry for the name
+    """
     query_url = "https://rest.uniprot.org/uniprotkb/search"
     query = f'(protein_name:"{protein_name}") AND (organism_name:"{organism}") AND reviewed:true'
     params = {"query": query, "format": "json", "size": 1, "fields": "accession"}
 
     try:
         logger.info(f"Fetching protein {protein_name}")
-        r = requests.get(query_url, params=params)
+        client = get_http_client()
+        r = await client.get(query_url, params=params)
 
-        if not r.ok or not r.json()["results"]:
+        if r.is_success and not r.json()["results"]:
+            logger.warning(f"Accession not found for gene {protein_name}")
+            return {
+                "error": f"Accession not found for gene {protein_name}",
+                "not_found": True,
+            }
+        if not r.is_success:
             raise RuntimeError(
-                f"Accession not found for gene {protein_name}, status_code: {r.status_code}"
+                f"Failed to search accession for gene {protein_name}, status_code: {r.status_code}"
             )
 
         accession = r.json()["results"][0]["primaryAccession"]
 
         fasta_url = f"https://rest.uniprot.org/uniprotkb/{accession}.fasta"
-        fasta_r = requests.get(fasta_url)
+        fasta_r = await client.get(fasta_url)
 
-        if not fasta_r.ok:
+        if not fasta_r.is_success:
             raise RuntimeError(
-                f"Failed to fetch FASTA for accession {accession}, status_code: {r.status_code}"
+                f"Failed to fetch FASTA for accession {accession}, status_code: {fasta_r.status_code}"
             )
 
         logger.info(f"success: {protein_name}")
         header, sequence = parse_fasta(fasta_r.text)
         return {"header": header, "sequence": sequence}
 
-    except RuntimeError as e:
+    except (RuntimeError, httpx.HTTPError, ValueError, KeyError) as e:
         logger.warning(f"Failed to fetch: {protein_name}")
         logger.warning(e)
-        return {"error": e}
+        return {"error": str(e)}
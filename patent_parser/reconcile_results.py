@@ -0,0 +1,156 @@
+import logging
+
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+
+from affinity_normalization import normalize_affinity
+from lookup_cache import normalize_key
+from local_compound_index import normalize_compound_name
+from serialization import read_json_files, write_json
+
+from config import CHECKPOINTS_FOLDER
+
+logger = logging.getLogger(__name__)
+
+CONSTANT_COLUMNS = ["Ki (nM)", "IC50 (nM)", "Kd (nM)", "EC50 (nM)"]
+PROVENANCE_FIELDS = ["chunk_index", "char_start", "char_end"]
+
+
+def normalize_values(values: list[Any]) -> list[str | None]:
+    """
+    Comparable form of binding constants, "<0.01 µM" and "< 10 nM" are the same value
+
+    Values that cannot be parsed are compared as written.
+    """
+    normalized = normalize_affinity(pd.Series(values, dtype=object))
+    keys = []
+    for value, nM, qualifier in zip(
+        values, normalized["value_nM"], normalized["qualifier"]
+    ):
+        if not pd.isna(qualifier):
+            keys.append(f"{qualifier}{nM:.6g}")
+        elif value is None or not str(value).strip():
+            keys.append(None)
+        elif str(value).strip().casefold() in ("null", "none", "n/a"):
+            keys.append(None)
+        else:
+            keys.append("".join(str(value).split()).casefold())
+    return keys
+
+
+def get_ligand_key(record: dict[str, Any]) -> str:
+    """Resolved structure if there is one, otherwise normalized name"""
+    if record.get("ligand_SMILES"):
+        return "smiles:" + record["ligand_SMILES"]
+    return "name:" + normalize_compound_name(record.get("ligand_name") or "")
+
+
+def get_protein_key(record: dict[str, Any]) -> str:
+    """Resolved sequence if there is one, otherwise normalized name"""
+    if record.get("protein_FASTA"):
+        return "sequence:" + record["protein_FASTA"]
+    return "name:" + normalize_key(record.get("protein_name") or "")
+
+
+def reconcile_records(
+    records: list[dict[str, Any]],
+) -> tuple[list[dict[str, Any]], dict[str, int]]:
+    """
+    Merge duplicate records and flag conflicting values
+
+    Records are duplicates if ligand, protein and all binding constants match.
+    Merged records keep the provenance of every mention in "mentions".
+    Records of the same ligand and protein with different values of a constant
+    list that constant in "conflicts". Records without constants are dropped.
+    Constants are compared after normalization to nM with their qualifiers.
+    Runs in a single pass over records plus a pass over merged records.
+
+    Returns:
+        Reconciled records and counts of input, empty, merged and conflicting records
+    """
+    merged: dict[tuple, dict[str, Any]] = {}
+    values_by_pair: dict[tuple[str, str, str], set[str]] = {}
+    n_empty = 0
+
+    # Constants of all records are normalized at once, column by column
+    normalized = {
+        column: normalize_values([record.get(column) for record in records])
+        for column in CONSTANT_COLUMNS
+    }
+
+    for indx, record in enumerate(records):
+        values = tuple(
+            (column, normalized[column][indx]) for column in CONSTANT_COLUMNS
+        )
+        if all(value is None for _, value in values):
+            n_empty += 1
+            continue
+
+        pair = (get_ligand_key(record), get_protein_key(record))
+        # Already reconciled records carry their mentions
+        mentions = record.get("mentions") or [
+            {field: record.get(field) for field in PROVENANCE_FIELDS}
+        ]
+        key = (*pair, values)
+
+        if key in merged:
+            existing = merged[key]
+            existing["mentions"].extend(mentions)
+            for field, value in record.items():
+                if existing.get(field) is None and value is not None:
+                    existing[field] = value
+            continue
+
+        merged[key] = {**record, "mentions": list(mentions), "conflicts": []}
+        for column, value in values:
+            if value is not None:
+                values_by_pair.setdefault((*pair, column), set()).add(value)
+
+    n_conflicting = 0
+    for (ligand_key, protein_key, _), record in merged.items():
+        record["conflicts"] = [
+            column
+            for column in CONSTANT_COLUMNS
+            if len(values_by_pair.get((ligand_key, protein_key, column), ())) > 1
+        ]
+        n_conflicting += bool(record["conflicts"])
+
+    reconciled = list(merged.values())
+    stats = {
+        "records": len(records),
+        "empty": n_empty,
+        "reconciled": len(reconciled),
+        "conflicting": n_conflicting,
+    }
+    return reconciled, stats
+
+
+def reconcile_patent_results(output_dir: str = "patent_results") -> dict[str, int]:
+    """
+    Reconcile saved per-patent results in place
+
+    Records are reconciled within a patent, as provenance offsets
+    refer to the patent text.
+
+    Returns:
+        Reconciliation counts summed over patents
+    """
+    output_path = Path(CHECKPOINTS_FOLDER) / output_dir
+
+    totals: dict[str, int] = {}
+    for results_file, records in read_json_files(sorted(output_path.glob("*.json"))):
+        if isinstance(records, Exception):
+            logger.warning(f"Failed to read {results_file}: {records}")
+            continue
+
+        reconciled, stats = reconcile_records(records)
+        for name, count in stats.items():
+            totals[name] = totals.get(name, 0) + count
+
+        if reconciled != records:
+            write_json(results_file, reconciled)
+
+    logger.info(f"Reconciliation stats: {totals}")
+    return totals
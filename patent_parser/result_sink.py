@@ -0,0 +1,232 @@
+import logging
+import os
+import shutil
+
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from affinity_normalization import normalize_affinity
+from serialization import dumps, read_json_files
+from config import (
+    CHECKPOINTS_FOLDER,
+    RESULTS_DATASET_FOLDER,
+    RESULTS_DATASET_FORMAT,
+    RESULTS_DATASET_MAX_FILE_SIZE,
+    RESULTS_DATASET_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+CONSTANT_COLUMNS = ["Ki (nM)", "IC50 (nM)", "Kd (nM)", "EC50 (nM)"]
+
+
+def qualifier_column(column: str) -> str:
+    """Column of a constant's relation qualifier, Ki (nM) -> Ki qualifier"""
+    return column.split(" ")[0] + " qualifier"
+
+
+# Column names follow BindingDB, so the dataset loads into check_bdb_upd.py as is
+RESULT_SCHEMA = pa.schema(
+    [
+        ("patent", pa.string()),
+        ("Ligand Name", pa.string()),
+        ("Ligand SMILES", pa.string()),
+        ("Ligand InChI Key", pa.string()),
+        ("Target Name", pa.string()),
+        ("Sequence", pa.string()),
+        *[(column, pa.float64()) for column in CONSTANT_COLUMNS],
+        *[(qualifier_column(column), pa.string()) for column in CONSTANT_COLUMNS],
+        ("assay", pa.string()),
+        ("chunk_index", pa.int64()),
+        ("char_start", pa.int64()),
+        ("char_end", pa.int64()),
+        ("evidence", pa.string()),
+        ("n_mentions", pa.int64()),
+        ("conflicts", pa.string()),
+    ]
+)
+
+
+def records_to_frame(patent_name: str, records: list[dict[str, Any]]) -> pd.DataFrame:
+    """
+    Convert extracted records of a patent to rows of the result schema
+
+    Binding constants are kept as written, see normalize_constants.
+    """
+    df = pd.DataFrame.from_records(records)
+    rows = pd.DataFrame(index=df.index)
+
+    def column(name: str) -> pd.Series:
+        if name in df:
+            return df[name]
+        return pd.Series(None, index=df.index, dtype=object)
+
+    rows["patent"] = patent_name
+    rows["Ligand Name"] = column("ligand_name")
+    rows["Ligand SMILES"] = column("ligand_SMILES")
+    rows["Ligand InChI Key"] = None
+    rows["Target Name"] = column("protein_name")
+    rows["Sequence"] = column("protein_FASTA")
+    for name in CONSTANT_COLUMNS:
+        rows[name] = column(name)
+    rows["assay"] = column("assay")
+    for name in ("chunk_index", "char_start", "char_end"):
+        rows[name] = pd.to_numeric(column(name), errors="coerce").astype("Int64")
+    rows["evidence"] = column("evidence")
+    rows["n_mentions"] = (
+        column("mentions").map(lambda m: len(m) if isinstance(m, list) else 1)
+    ).astype("Int64")
+    rows["conflicts"] = column("conflicts").map(
+        lambda c: ",".join(c) if isinstance(c, list) and c else None
+    )
+    for name in ("Ligand Name", "Ligand SMILES", "Target Name", "Sequence", "assay"):
+        rows[name] = rows[name].map(lambda v: None if v is None else str(v))
+    return rows
+
+
+def normalize_constants(rows: pd.DataFrame) -> pd.DataFrame:
+    """Replace constants as written with nM floats and their qualifiers"""
+    for name in CONSTANT_COLUMNS:
+        normalized = normalize_affinity(rows[name])
+        rows[name] = normalized["value_nM"]
+        rows[qualifier_column(name)] = normalized["qualifier"]
+    return rows
+
+
+class ResultSink:
+    """
+    Streaming writer of extracted records to a dataset of rolling files
+
+    Rows are buffered and written in batches of `batch_size`, as parquet row
+    groups or jsonl lines. A new part file is started once the current one
+    reaches `max_file_size` bytes, so memory stays flat for any number of records.
+
+    Parts are written to a staging folder next to `folder`, which replaces the
+    dataset only on a clean close, so a failed export keeps the previous one.
+    """
+
+    def __init__(
+        self,
+        folder: Path = RESULTS_DATASET_FOLDER,
+        file_format: str = RESULTS_DATASET_FORMAT,
+        max_file_size: int = RESULTS_DATASET_MAX_FILE_SIZE,
+        batch_size: int = RESULTS_DATASET_BATCH_SIZE,
+    ):
+        if file_format not in ("parquet", "jsonl"):
+            raise ValueError(f"Unknown results dataset format: {file_format}")
+        self.folder = Path(folder)
+        self.file_format = file_format
+        self.max_file_size = max_file_size
+        self.batch_size = batch_size
+        self.n_records = 0
+        self.n_files = 0
+
+        self._buffer: list[pd.DataFrame] = []
+        self._buffered = 0
+        self._path: Path | None = None
+        self._parquet_writer: pq.ParquetWriter | None = None
+
+        # The dataset is rewritten as a whole, leftovers of a failed run are dropped
+        self._staging = self.folder.with_name(self.folder.name + ".tmp")
+        shutil.rmtree(self._staging, ignore_errors=True)
+        self._staging.mkdir(parents=True)
+
+    def write(self, patent_name: str, records: list[dict[str, Any]]):
+        if not records:
+            return
+        self._buffer.append(records_to_frame(patent_name, records))
+        self._buffered += len(records)
+        if self._buffered >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        table = pa.Table.from_pandas(
+            normalize_constants(pd.concat(self._buffer, ignore_index=True)),
+            schema=RESULT_SCHEMA,
+            preserve_index=False,
+        )
+        self._buffer, self._buffered = [], 0
+
+        if self._path is None:
+            self._open_part()
+        if self.file_format == "parquet":
+            self._parquet_writer.write_table(table)
+        else:
+            with open(self._path, "ab") as f:
+                for row in table.to_pylist():
+                    f.write(dumps(row) + b"\n")
+        self.n_records += table.num_rows
+
+        if self._path.stat().st_size >= self.max_file_size:
+            self._close_part()
+
+    def close(self):
+        self.flush()
+        self._close_part()
+        self._publish()
+        logger.info(
+            f"Wrote {self.n_records} records to {self.n_files} files in {self.folder}"
+        )
+
+    def _open_part(self):
+        self._path = Path(self._staging, f"part-{self.n_files:05d}.{self.file_format}")
+        self.n_files += 1
+        if self.file_format == "parquet":
+            self._parquet_writer = pq.ParquetWriter(self._path, RESULT_SCHEMA)
+
+    def _close_part(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        self._path = None
+
+    def _publish(self):
+        """Swap the staging folder in place of the dataset"""
+        previous = self.folder.with_name(self.folder.name + ".old")
+        shutil.rmtree(previous, ignore_errors=True)
+        if self.folder.exists():
+            os.replace(self.folder, previous)
+        os.replace(self._staging, self.folder)
+        shutil.rmtree(previous, ignore_errors=True)
+
+    def abort(self):
+        """Discard written parts and keep the previous dataset"""
+        self._buffer, self._buffered = [], 0
+        self._close_part()
+        shutil.rmtree(self._staging, ignore_errors=True)
+
+    def __enter__(self) -> "ResultSink":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def export_patent_results(
+    output_dir: str = "patent_results", sink: ResultSink | None = None
+) -> int:
+    """
+    Stream saved per-patent results into the results dataset
+
+    Returns:
+        Number of written records
+    """
+    output_path = Path(CHECKPOINTS_FOLDER) / output_dir
+    with sink or ResultSink() as sink:
+        for results_file, records in read_json_files(
+            sorted(output_path.glob("*.json"))
+        ):
+            if isinstance(records, Exception):
+                logger.warning(f"Failed to read {results_file}: {records}")
+                continue
+            sink.write(results_file.stem, records)
+    return sink.n_records
@@ -0,0 +1,47 @@
+import argparse
+import logging
+from pathlib import Path
+from config_logging import setup_logging
+
+from parse_pdfs import iter_parse_pdfs
+from run_binding_markup_batch import (
+    prepare_markup_batch,
+    submit_markup_batch,
+    ingest_markup_batch,
+)
+from config import CHECKPOINTS_FOLDER, CONTINUE_MARKUP
+
+
+def main(action: str):
+    setup_logging()
+    logger = logging.getLogger(__name__)
+
+    if action in ("prepare", "all"):
+        logger.info("Preparing batch markup requests...")
+        pdf_files = list(Path(CHECKPOINTS_FOLDER, "patent_pdfs").glob("*.pdf"))
+        prepare_markup_batch(
+            patents=iter_parse_pdfs(pdf_files),
+            checkpoints_folder=CHECKPOINTS_FOLDER,
+            continue_markup=CONTINUE_MARKUP,
+        )
+
+    if action in ("submit", "all"):
+        logger.info("Running batch markup requests...")
+        submit_markup_batch(CHECKPOINTS_FOLDER)
+
+    if action in ("ingest", "all"):
+        logger.info("Ingesting batch markup results...")
+        ingest_markup_batch(CHECKPOINTS_FOLDER)
+
+    logger.info("Finished batch markup!")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run markup as offline batch job.")
+    parser.add_argument(
+        "action",
+        choices=["prepare", "submit", "ingest", "all"],
+        help="Batch markup stage to run.",
+    )
+    args = parser.parse_args()
+    main(args.action)
@@ -11,7 +11,9 @@ from pathlib import Path
 from typing import Any
 
 from parse_pdfs import Patent
-from config import CHECKPOINTS_FOLDER
+from markup_store import get_corpus_store
+from serialization import write_json
+from config import CHECKPOINTS_FOLDER, USE_CORPUS_STORE, EXPORT_MARKUP_JSON
 
 logger = logging.getLogger(__name__)
 
@@ -92,8 +94,15 @@ content_template = (
 
 def run_markup(
     patents: list[Patent], checkpoints_folder: Path = CHECKPOINTS_FOLDER, limit=None
-):  # TODO
+) -> list[str]:  # TODO
+    """
+    Mark up patents one chunk at a time
+
+    Returns:
+        Names of saved patents
+    """
     results = []
+    saved = []
     CHECKPOINTS_FOLDER_BINDING = Path(checkpoints_folder, "json_binding_data")
     CHECKPOINTS_FOLDER_BINDING.mkdir(exist_ok=True, parents=True)
 
@@ -124,14 +133,22 @@ def run_markup(
                 "has_binding_info": patent.has_binding_info,
             }
         )
-        patent_out = patent
-        patent_out.local_path = str(patent_out.local_path)
-        d = dataclasses.asdict(patent_out)
-        filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
-        with open(filename, "w") as f:
-            json.dump(d, f, indent=4)
+        if EXPORT_MARKUP_JSON or not USE_CORPUS_STORE:
+            patent_out = patent
+            patent_out.local_path = str(patent_out.local_path)
+            d = dataclasses.asdict(patent_out)
+            filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
+            write_json(filename, d)
+        if USE_CORPUS_STORE:
+            saved.extend(get_corpus_store().add_patent(patent))
+        else:
+            saved.append(patent.name)
+
+    if USE_CORPUS_STORE:
+        saved.extend(get_corpus_store().commit())
 
     json_binding_summary_path = Path(CHECKPOINTS_FOLDER_SUMMARY, "binding_summary.json")
     logger.info(f"Recording initial markup resulst to: {json_binding_summary_path}")
     with open(json_binding_summary_path, "w") as f:
         json.dump(results, f, indent=4)
+    return saved
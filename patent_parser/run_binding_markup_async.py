@@ -1,18 +1,40 @@
 import dataclasses
+import functools
 import json
 import logging
+import math
 import os
 import random
+import time
 import asyncio
 
 from dotenv import load_dotenv
 from pathlib import Path
-from typing import Any
-from openai import AsyncOpenAI
-import aiofiles
+from typing import Any, Awaitable, Callable, Iterable
+from openai import AsyncOpenAI, BadRequestError
 
-from parse_pdfs import Patent
-from config import CHECKPOINTS_FOLDER, MAX_CONCURRENT_REQUESTS, MIN_PDF_TEXT_LENGTH
+from parse_pdfs import (
+    Chunk,
+    Patent,
+    get_coarse_windows,
+    get_chunks_near_windows,
+)
+from markup_store import get_corpus_store
+from serialization import write_json_async
+from metrics import acquire_timed, get_metrics, record_llm_call
+from config import (
+    CHECKPOINTS_FOLDER,
+    MAX_CONCURRENT_REQUESTS,
+    MIN_PDF_TEXT_LENGTH,
+    MARKUP_WORKERS,
+    MAX_PATENTS_IN_FLIGHT,
+    USE_COARSE_TO_FINE,
+    COARSE_TO_FINE_NEIGHBORS,
+    MARKUP_OUTPUT_MODE,
+    MARKUP_CONFIDENCE_THRESHOLD,
+    USE_CORPUS_STORE,
+    EXPORT_MARKUP_JSON,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,61 +47,264 @@ api_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 file_semaphore = asyncio.Semaphore(100)
 
 
-async def ask_llm_async(
-    content,
-    system_prompt,
-    data_model: Any | None = None,
+def parse_json_response(response_message: str) -> Any:
+    """Parse json from LLM response, returns dict with error if it is not a json"""
+    try:
+        cleaned = response_message.strip().replace("json", "", 1).strip()
+        parsed = json.loads(cleaned)
+        return parsed
+    except json.JSONDecodeError as e:
+        logger.info(f"JSON decode error: {e}")
+        return {"error": str(e)}
+
+
+system_prompt = "You are an expert in structural biology, chemoinformatics and patents"
+content_template = (
+    "Here is a fragment of a patent. It was autorecognized, so it might have some typos. "
+    + "Your task is to define if this fragment has any data on molecule binding with protein. "
+    + "Pay special attention to values like: Ki (nM), IC50 (nM), Kd (nM), EC50 (nM)"
+    + "You have to return your verdict as a valid json string has_binding_info: true|false. Only json, not other data! Do not use markdown formatting!"
+)
+
+
+logprob_content_template = (
+    "Here is a fragment of a patent. It was autorecognized, so it might have some typos. "
+    + "Does this fragment have any data on molecule binding with protein, "
+    + "like Ki (nM), IC50 (nM), Kd (nM), EC50 (nM)? Answer with a single word: yes or no."
+)
+
+MARKUP_SCHEMA = {
+    "type": "object",
+    "properties": {"has_binding_info": {"type": "boolean"}},
+    "required": ["has_binding_info"],
+    "additionalProperties": False,
+}
+
+# Mode to use when a backend rejects the requested one
+MARKUP_OUTPUT_FALLBACK = {"schema": "logprob", "logprob": "json"}
+unsupported_output_modes: set[tuple[str, str]] = set()
+# Request parameters of output modes, a rejection naming one is about the mode
+OUTPUT_MODE_PARAMS = {
+    "schema": ("response_format", "json_schema", "guided_json"),
+    "logprob": ("logprobs", "top_logprobs"),
+}
+
+
+def rejects_output_mode(error: BadRequestError, output_mode: str) -> bool:
+    """
+    Whether a backend rejected the output mode itself
+
+    Other bad requests, e.g. a prompt over the context length, must not turn
+    the mode off for the whole run.
+    """
+    params = OUTPUT_MODE_PARAMS.get(output_mode, ())
+    if getattr(error, "param", None):
+        return error.param in params
+    message = str(error).lower()
+    return any(param in message for param in params)
+
+
+def build_markup_request(
+    text: str, model: str = MODEL, output_mode: str = MARKUP_OUTPUT_MODE
+) -> dict[str, Any]:
+    """Build chat completion request body to mark up a fragment of patent text"""
+    if output_mode == "logprob":
+        return {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": logprob_content_template
+                    + f"Here is a fragment of a patent: {text}",
+                },
+            ],
+            "max_tokens": 1,
+            "temperature": 0.0,
+            "logprobs": True,
+            "top_logprobs": 10,
+        }
+
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {
+                "role": "user",
+                "content": content_template + f"Here is a fragment of a patent: {text}",
+            },
+        ],
+        "max_tokens": 75,
+        "temperature": 0.5,
+    }
+    if output_mode == "schema":
+        request.update(
+            {
+                "max_tokens": 16,
+                "temperature": 0.0,
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": "binding_verdict",
+                        "schema": MARKUP_SCHEMA,
+                        "strict": True,
+                    },
+                },
+                "logprobs": True,
+                "top_logprobs": 5,
+            }
+        )
+    return request
+
+
+def get_token_logprobs(logprobs: Any) -> list[dict[str, Any]]:
+    """Normalize choice logprobs from API objects or batch output dicts"""
+    if logprobs is None:
+        return []
+    if hasattr(logprobs, "model_dump"):
+        logprobs = logprobs.model_dump()
+    return logprobs.get("content") or []
+
+
+def get_positive_probability(
+    token_logprobs: list[dict[str, Any]], positive: str, negative: str
+) -> float | None:
+    """
+    Probability of the positive answer at the first token that is positive or negative
+
+    Only top logprobs of that token are used, so the probability is renormalized
+    over positive and negative answers.
+    """
+    for token in token_logprobs:
+        if token.get("token", "").strip().lower() not in (positive, negative):
+            continue
+        probs = {positive: 0.0, negative: 0.0}
+        for top in token.get("top_logprobs") or [token]:
+            answer = top.get("token", "").strip().lower()
+            if answer in probs:
+                probs[answer] += math.exp(top["logprob"])
+        total = probs[positive] + probs[negative]
+        if total > 0:
+            return probs[positive] / total
+    return None
+
+
+def parse_markup_response(
+    response_message: str | None,
+    logprobs: Any = None,
+    output_mode: str = MARKUP_OUTPUT_MODE,
+    threshold: float = MARKUP_CONFIDENCE_THRESHOLD,
+) -> dict[str, Any]:
+    """
+    Parse markup verdict from LLM response
+
+    Returns:
+        dict with has_binding_info and confidence (probability of binding info,
+        None if the backend gave no logprobs), or dict with error
+    """
+    token_logprobs = get_token_logprobs(logprobs)
+
+    if output_mode == "logprob":
+        confidence = get_positive_probability(token_logprobs, "yes", "no")
+        if confidence is None:
+            answer = (response_message or "").strip().lower()
+            if answer not in ("yes", "no"):
+                return {"error": f"Unexpected answer: {response_message}"}
+            confidence = 1.0 if answer == "yes" else 0.0
+        return {"has_binding_info": confidence >= threshold, "confidence": confidence}
+
+    res = parse_json_response(response_message or "")
+    if not isinstance(res, dict) or "error" in res:
+        return res if isinstance(res, dict) else {"error": f"Unexpected answer: {res}"}
+    if "has_binding_info" not in res:
+        return {"error": f"Some strange output: {list(res.keys())}"}
+
+    confidence = get_positive_probability(token_logprobs, "true", "false")
+    if confidence is None:
+        return {"has_binding_info": bool(res["has_binding_info"]), "confidence": None}
+    return {"has_binding_info": confidence >= threshold, "confidence": confidence}
+
+
+@functools.lru_cache(maxsize=None)
+def get_async_client(
+    base_url: str = BASE_URL, api_key: str = API_KEY
+) -> AsyncOpenAI:
+    """Shared client, so connections are reused between requests"""
+    return AsyncOpenAI(base_url=base_url, api_key=api_key)
+
+
+async def ask_markup_verdict(
+    text: str,
+    output_mode: str = MARKUP_OUTPUT_MODE,
     base_url: str = BASE_URL,
     api_key: str = API_KEY,
     model: str = MODEL,
+    semaphore: asyncio.Semaphore = api_semaphore,
+    threshold: float = MARKUP_CONFIDENCE_THRESHOLD,
     n_retries_response: int = 3,
-):
-    client = AsyncOpenAI(base_url=base_url, api_key=api_key)
+    api: str = "markup",
+) -> dict[str, Any]:
+    """
+    Ask LLM if a fragment of patent text has binding info
 
-    async with api_semaphore:  # Limit concurrent API requests
-        for attempt in range(n_retries_response + 1):
+    Falls back to a simpler output mode if the backend rejects the requested one.
+    Requests are recorded in metrics under `api`.
+    """
+    client = get_async_client(base_url, api_key)
+    while (base_url, output_mode) in unsupported_output_modes:
+        output_mode = MARKUP_OUTPUT_FALLBACK[output_mode]
+
+    attempt = 0
+    async with acquire_timed(semaphore, api):  # Limit concurrent API requests
+        while True:
+            started = time.perf_counter()
             try:
                 response = await client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": content},
-                    ],
-                    max_tokens=75,
-                    temperature=0.5,
+                    **build_markup_request(text, model=model, output_mode=output_mode)
                 )
+                record_llm_call(api, started, "ok", response.usage)
                 break  # Success
+            except BadRequestError as e:
+                record_llm_call(api, started, "bad_request")
+                if output_mode not in MARKUP_OUTPUT_FALLBACK or not rejects_output_mode(
+                    e, output_mode
+                ):
+                    logger.warning(f"Markup request rejected by {base_url}: {e}")
+                    return {"error": str(e)}
+                logger.warning(
+                    f"Output mode {output_mode} rejected by {base_url}, "
+                    + f"falling back to {MARKUP_OUTPUT_FALLBACK[output_mode]}: {e}"
+                )
+                unsupported_output_modes.add((base_url, output_mode))
+                output_mode = MARKUP_OUTPUT_FALLBACK[output_mode]
             except Exception as e:
-                logger.info(f"Attempt {attempt + 1} failed: {e}")
-                if attempt < n_retries_response:
-                    await asyncio.sleep(random.uniform(2, 3))
-                else:
+                record_llm_call(api, started, "error")
+                attempt += 1
+                logger.info(f"Attempt {attempt} failed: {e}")
+                if attempt > n_retries_response:
                     return {"error": str(e)}
+                get_metrics().counter("llm_retries_total", "Retried LLM requests").inc(
+                    api=api
+                )
+                await asyncio.sleep(random.uniform(2, 3))
 
-    response_message = response.choices[0].message.content
-
-    if not data_model:
-        return response_message
-    else:
-        try:
-            cleaned = response_message.strip().replace("json", "", 1).strip()
-            parsed = json.loads(cleaned)
-            return parsed
-        except json.JSONDecodeError as e:
-            logger.info(f"JSON decode error: {e}")
-            return {"error": str(e)}
+    choice = response.choices[0]
+    return parse_markup_response(
+        choice.message.content, choice.logprobs, output_mode, threshold
+    )
 
 
-system_prompt = "You are an expert in structural biology, chemoinformatics and patents"
-content_template = (
-    "Here is a fragment of a patent. It was autorecognized, so it might have some typos. "
-    + "Your task is to define if this fragment has any data on molecule binding with protein. "
-    + "Pay special attention to values like: Ki (nM), IC50 (nM), Kd (nM), EC50 (nM)"
-    + "You have to return your verdict as a valid json string has_binding_info: true|false. Only json, not other data! Do not use markdown formatting!"
-)
+def record_markup_verdict(markup_pass: str, res: dict[str, Any]):
+    if "error" in res:
+        verdict = "error"
+    else:
+        verdict = "positive" if res["has_binding_info"] else "negative"
+    get_metrics().counter("markup_chunks_total", "Marked up chunks").inc(
+        markup_pass=markup_pass, verdict=verdict
+    )
 
 
-async def process_chunk(patent, chunk, indx):
+async def process_chunk(patent, chunk, indx, ask_verdict=ask_markup_verdict):
     if patent.is_too_short:
         logger.warning(
             f"Skipping processing chunk {indx} for short patent {patent.name}"
@@ -87,33 +312,93 @@ async def process_chunk(patent, chunk, indx):
         return {"error": "Patent marked as too short"}
 
     logger.info(f"patent={patent.name}, chunk={indx}, pos={chunk.start, chunk.end}")
-    content = content_template + f"Here is a fragment of a patent: {chunk.text}"
-    res = await ask_llm_async(content, system_prompt, data_model=True)
+    res = await ask_verdict(chunk.text)
+    record_markup_verdict("fine", res)
     if "error" not in res:
-        if "has_binding_info" in res:
-            chunk.has_binding_info = res["has_binding_info"]
-            if chunk.has_binding_info:
-                patent.has_binding_info = True
-                chunk.has_binding_info = True
-                patent.chunks_with_binding_info.append(indx)
-        else:
-            logger.info(f"Some strange output in {patent.name}: {res.keys()}")
+        chunk.binding_confidence = res["confidence"]
+        if res["has_binding_info"]:
+            patent.has_binding_info = True
+            chunk.has_binding_info = True
+            patent.chunks_with_binding_info.append(indx)
+    else:
+        logger.info(f"Markup failed for {patent.name}, chunk {indx}: {res['error']}")
     logger.info(res)
     return res
 
 
+async def process_window(
+    patent, window, indx, ask_verdict=ask_markup_verdict
+) -> bool:
+    """Coarse markup of a non-overlapping window, errors are treated as positive"""
+    logger.info(f"patent={patent.name}, window={indx}, pos={window.start, window.end}")
+    res = await ask_verdict(window.text)
+    record_markup_verdict("coarse", res)
+    logger.info(res)
+    if "error" in res:
+        return True
+    return res["has_binding_info"]
+
+
+@dataclasses.dataclass
+class MarkupJob:
+    """State of a single patent going through the markup pool"""
+
+    patent: Patent
+    pending: int = 0
+    stage: str = "fine"
+    windows: list[Chunk] = dataclasses.field(default_factory=list)
+    positive_windows: list[int] = dataclasses.field(default_factory=list)
+    failed: bool = False
+
+
 async def save_patent_json(filename, data):
-    """Async function to save patent data with file descriptor limiting using aiofiles"""
+    """Save patent data off the event loop with file descriptor limiting"""
     async with file_semaphore:
-        async with aiofiles.open(filename, "w") as f:
-            await f.write(json.dumps(data, indent=4))
+        await write_json_async(filename, data)
+
+
+async def save_patent_checkpoint(filename, patent: Patent) -> list[str]:
+    """
+    Add marked up patent to the corpus store and/or save its JSON checkpoint
+
+    Returns:
+        Names of patents saved for good by this call: the patent itself with
+        JSON checkpoints only, else the patents of a committed store batch
+    """
+    if EXPORT_MARKUP_JSON or not USE_CORPUS_STORE:
+        data = await asyncio.to_thread(patent_to_dict, patent)
+        await save_patent_json(filename, data)
+    if USE_CORPUS_STORE:
+        return await asyncio.to_thread(get_corpus_store().add_patent, patent)
+    return [patent.name]
+
+
+def is_marked_up(checkpoints_folder_binding: Path, name: str) -> bool:
+    """Whether the patent has a JSON checkpoint or is committed to the corpus store"""
+    if Path(checkpoints_folder_binding, f"{name}.json").exists():
+        return True
+    return USE_CORPUS_STORE and get_corpus_store().has_patent(name)
+
+
+def patent_to_dict(patent: Patent) -> dict[str, Any]:
+    """Convert patent to a json serializable dict for checkpoints"""
+    patent_out = dataclasses.replace(patent)
+    patent_out.local_path = str(patent_out.local_path)
+    return dataclasses.asdict(patent_out)
 
 
 async def run_markup_async(
     patents: list[Patent],
     checkpoints_folder: Path = CHECKPOINTS_FOLDER,
     continue_markup: bool = False,  # Added continue_markup parameter
-):
+) -> list[str]:
+    """
+    Mark up a batch of patents, all chunks at once
+
+    Returns:
+        Names of saved patents, patents in the corpus store count as saved
+        once their batch is committed
+    """
     CHECKPOINTS_FOLDER_BINDING = Path(checkpoints_folder, "json_binding_data")
     CHECKPOINTS_FOLDER_BINDING.mkdir(exist_ok=True, parents=True)
     CHECKPOINTS_FOLDER_SUMMARY = Path(checkpoints_folder, "json_binding_summary")
@@ -123,9 +408,8 @@ async def run_markup_async(
     if continue_markup:
         filtered_patents = []
         for patent in patents:
-            filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
-            if filename.exists():
-                logger.info(f"Skipping {patent.name}, JSON file already exists.")
+            if is_marked_up(CHECKPOINTS_FOLDER_BINDING, patent.name):
+                logger.info(f"Skipping {patent.name}, already marked up.")
                 continue
             filtered_patents.append(patent)
         patents = filtered_patents
@@ -141,18 +425,27 @@ async def run_markup_async(
     )
     logger.info(f"Processing {len(normal_patents)} normal patents.")
 
+    saved: list[str] = []
+
+    async def save(patent: Patent):
+        try:
+            filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
+            saved.extend(await save_patent_checkpoint(filename, patent))
+        except Exception as e:
+            logger.warning(f"Failed to save {patent.name}: {e}")
+
+    async def mark_up_chunk(patent: Patent, chunk, indx: int):
+        try:
+            await process_chunk(patent, chunk, indx)
+        except Exception as e:
+            logger.warning(f"Failed chunk {indx} of {patent.name}: {e}")
+
     save_short_tasks = []
     if short_patents:
         logger.info("Saving data for short patents directly...")
         for patent in short_patents:
             logger.info(f"{patent.name} too short to process")
-            patent_out = dataclasses.replace(patent)
-            patent_out.local_path = str(patent_out.local_path)
-            d = dataclasses.asdict(patent_out)
-
-            filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
-            save_task = save_patent_json(filename, d)
-            save_short_tasks.append(save_task)
+            save_short_tasks.append(save(patent))
 
     if save_short_tasks:
         await asyncio.gather(*save_short_tasks)
@@ -160,7 +453,7 @@ async def run_markup_async(
     tasks = []
     for patent in normal_patents:
         patent_tasks = [
-            process_chunk(patent, chunk, indx)
+            mark_up_chunk(patent, chunk, indx)
             for indx, chunk in enumerate(patent.chunks)
         ]
         tasks.extend(patent_tasks)
@@ -168,14 +461,181 @@ async def run_markup_async(
     if tasks:
         await asyncio.gather(*tasks)
 
-    save_normal_tasks = []
-    for patent in normal_patents:
-        patent_out = dataclasses.replace(patent)
-        patent_out.local_path = str(patent_out.local_path)
-        d = dataclasses.asdict(patent_out)
-        filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
-        save_task = save_patent_json(filename, d)
-        save_normal_tasks.append(save_task)
-
+    save_normal_tasks = [save(patent) for patent in normal_patents]
     if save_normal_tasks:
         await asyncio.gather(*save_normal_tasks)
+    if USE_CORPUS_STORE:
+        saved.extend(await asyncio.to_thread(get_corpus_store().commit))
+    return saved
+
+
+async def run_markup_pool(
+    patents: Iterable[Patent],
+    checkpoints_folder: Path = CHECKPOINTS_FOLDER,
+    continue_markup: bool = False,
+    n_workers: int = MARKUP_WORKERS,
+    max_patents_in_flight: int = MAX_PATENTS_IN_FLIGHT,
+    coarse_to_fine: bool = USE_COARSE_TO_FINE,
+    n_neighbors: int = COARSE_TO_FINE_NEIGHBORS,
+    ask_verdict: Callable[[str], Awaitable[dict[str, Any]]] = ask_markup_verdict,
+) -> list[str]:
+    """
+    Mark up patents with a fixed pool of workers fed from a shared queue
+
+    Patents are pulled lazily from `patents` (parsing happens off the event loop),
+    so at most `max_patents_in_flight` patents are held in memory at once.
+    Every patent is saved as soon as its last chunk is marked up, patents in
+    the corpus store count as saved once their batch is committed.
+
+    With `coarse_to_fine` each patent is first split into non-overlapping windows.
+    Only overlapping chunks around positive windows are marked up afterwards, so
+    `chunks_with_binding_info` keeps the usual chunk indices.
+
+    Args:
+        patents: Iterable of Patent objects, e.g. a lazy parsing generator
+        checkpoints_folder: Folder to store checkpoints
+        continue_markup: Skip patents that are already marked up
+        n_workers: Number of concurrent markup workers
+        max_patents_in_flight: Max number of patents being marked up at once
+        coarse_to_fine: Use two-pass coarse-to-fine markup
+        n_neighbors: Number of neighbouring windows re-checked around positive ones
+        ask_verdict: Coroutine function returning markup verdict for a text,
+            e.g. ask_cascade_verdict
+
+    Returns:
+        Names of saved patents
+    """
+    CHECKPOINTS_FOLDER_BINDING = Path(checkpoints_folder, "json_binding_data")
+    CHECKPOINTS_FOLDER_BINDING.mkdir(exist_ok=True, parents=True)
+    CHECKPOINTS_FOLDER_SUMMARY = Path(checkpoints_folder, "json_binding_summary")
+    CHECKPOINTS_FOLDER_SUMMARY.mkdir(exist_ok=True, parents=True)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    patent_slots = asyncio.Semaphore(max_patents_in_flight)
+    saved: list[str] = []
+
+    async def finalize(patent: Patent):
+        try:
+            patent.chunks_with_binding_info.sort()
+            filename = Path(CHECKPOINTS_FOLDER_BINDING, f"{patent.name}.json")
+            saved.extend(await save_patent_checkpoint(filename, patent))
+            logger.info(
+                f"Marked up {patent.name}, "
+                + f"has_binding_info={patent.has_binding_info}"
+            )
+        except Exception as e:
+            logger.warning(f"Failed to save {patent.name}: {e}")
+        finally:
+            patent_slots.release()
+
+    def enqueue_fine(job: MarkupJob, chunk_indices: list[int]):
+        job.stage = "fine"
+        job.pending = len(chunk_indices)
+        for indx in chunk_indices:
+            queue.put_nowait((job, job.patent.chunks[indx], indx))
+
+    async def on_job_step_done(job: MarkupJob):
+        job.pending -= 1
+        if job.pending > 0:
+            return
+
+        if job.stage == "coarse":
+            chunk_indices = get_chunks_near_windows(
+                job.patent, job.windows, job.positive_windows, n_neighbors
+            )
+            logger.info(
+                f"{job.patent.name}: {len(job.positive_windows)}/{len(job.windows)} "
+                + f"positive windows, {len(chunk_indices)}/{len(job.patent.chunks)} "
+                + "chunks for fine markup"
+            )
+            job.windows = []
+            if chunk_indices:
+                enqueue_fine(job, chunk_indices)
+                return
+
+        await finalize(job.patent)
+
+    def fail_job(job: MarkupJob, e: Exception):
+        """Drop a patent whose markup broke, it is not saved and not done"""
+        logger.warning(f"Markup of {job.patent.name} failed at {job.stage}: {e}")
+        job.failed = True
+        patent_slots.release()
+
+    queue_depth = get_metrics().gauge("queue_depth", "Items waiting in a queue")
+
+    async def worker():
+        while True:
+            job, chunk, indx = await queue.get()
+            queue_depth.set(queue.qsize(), queue="markup")
+            try:
+                if job.failed:
+                    continue
+                try:
+                    if job.stage == "coarse":
+                        if await process_window(
+                            job.patent, chunk, indx, ask_verdict
+                        ):
+                            job.positive_windows.append(indx)
+                    else:
+                        await process_chunk(job.patent, chunk, indx, ask_verdict)
+                except Exception as e:
+                    logger.warning(
+                        f"Failed {job.stage} chunk {indx} of {job.patent.name}: {e}"
+                    )
+                    if job.stage == "coarse":
+                        job.positive_windows.append(indx)
+
+                # A broken job must not take its worker down with it
+                try:
+                    await on_job_step_done(job)
+                except Exception as e:
+                    fail_job(job, e)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(n_workers)]
+    patents_iter = iter(patents)
+    n_patents = 0
+
+    try:
+        while True:
+            await patent_slots.acquire()
+            patent = await asyncio.to_thread(next, patents_iter, None)
+            if patent is None:
+                patent_slots.release()
+                break
+
+            if continue_markup and await asyncio.to_thread(
+                is_marked_up, CHECKPOINTS_FOLDER_BINDING, patent.name
+            ):
+                logger.info(f"Skipping {patent.name}, already marked up.")
+                patent_slots.release()
+                continue
+
+            n_patents += 1
+            if patent.is_too_short or not patent.chunks:
+                logger.info(f"{patent.name} too short to process")
+                await finalize(patent)
+                continue
+
+            job = MarkupJob(patent=patent)
+            if coarse_to_fine:
+                job.stage = "coarse"
+                job.windows = get_coarse_windows(patent)
+                job.pending = len(job.windows)
+                for indx, window in enumerate(job.windows):
+                    queue.put_nowait((job, window, indx))
+            else:
+                enqueue_fine(job, list(range(len(patent.chunks))))
+
+        await queue.join()
+    finally:
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        # Patents are added whole on finalize, so they are safe to commit on errors too
+        if USE_CORPUS_STORE:
+            saved.extend(await asyncio.to_thread(get_corpus_store().commit))
+
+    logger.info(f"Markup finished for {n_patents} patents, {len(saved)} saved")
+    return saved
@@ -0,0 +1,425 @@
+import json
+import logging
+import os
+import subprocess
+import time
+
+from dotenv import load_dotenv
+from pathlib import Path
+from typing import Any, Iterable
+from openai import OpenAI
+
+from parse_pdfs import Patent, parse_pdf_to_patent
+from serialization import read_json, write_json
+from markup_store import get_corpus_store
+from run_binding_markup_async import (
+    build_markup_request,
+    parse_markup_response,
+    patent_to_dict,
+    is_marked_up,
+)
+from config import (
+    CHECKPOINTS_FOLDER,
+    BATCH_MAX_REQUESTS_PER_FILE,
+    BATCH_COMPLETION_WINDOW,
+    BATCH_POLL_INTERVAL,
+    BATCH_LOCAL_RUNNER,
+    MARKUP_OUTPUT_MODE,
+    USE_CORPUS_STORE,
+    EXPORT_MARKUP_JSON,
+)
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+API_KEY = os.getenv("LLM_API_KEY")
+BASE_URL = os.getenv("LLM_BASE_URL")
+MODEL = os.getenv("MODEL")
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+CUSTOM_ID_SEP = "::"
+TERMINAL_BATCH_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_batch_folders(checkpoints_folder: Path) -> dict[str, Path]:
+    """Create and return folders used by batch markup"""
+    batch_folder = Path(checkpoints_folder, "batch_markup")
+    folders = {
+        "root": batch_folder,
+        "requests": Path(batch_folder, "requests"),
+        "results": Path(batch_folder, "results"),
+        "pending": Path(batch_folder, "pending"),
+        "binding": Path(checkpoints_folder, "json_binding_data"),
+    }
+    for folder in folders.values():
+        folder.mkdir(exist_ok=True, parents=True)
+    return folders
+
+
+def save_json(filename: Path, data: Any):
+    write_json(filename, data)
+
+
+def load_batch_state(folders: dict[str, Path]) -> tuple[dict[str, str], Path]:
+    """Batch ids of submitted request files and the file they are kept in"""
+    state_file = Path(folders["root"], "batches.json")
+    state = json.loads(state_file.read_text()) if state_file.exists() else {}
+    return state, state_file
+
+
+def next_request_index(folders: dict[str, Path]) -> int:
+    """Number of the next request file, ingested files leave gaps"""
+    indices = [
+        int(path.stem.rsplit("_", 1)[-1])
+        for path in folders["requests"].glob("requests_*.jsonl")
+    ]
+    return max(indices, default=-1) + 1
+
+
+def save_marked_up(filename: Path, patent: Patent):
+    """Add marked up patent to the corpus store and/or save its JSON checkpoint"""
+    if EXPORT_MARKUP_JSON or not USE_CORPUS_STORE:
+        save_json(filename, patent_to_dict(patent))
+    if USE_CORPUS_STORE:
+        get_corpus_store().add_patent(patent)
+
+
+def prepare_markup_batch(
+    patents: Iterable[Patent],
+    checkpoints_folder: Path = CHECKPOINTS_FOLDER,
+    continue_markup: bool = False,
+    max_requests_per_file: int = BATCH_MAX_REQUESTS_PER_FILE,
+    model: str = MODEL,
+    output_mode: str = MARKUP_OUTPUT_MODE,
+) -> list[Path]:
+    """
+    Write markup prompts for every chunk to JSONL request files in OpenAI batch format
+
+    Patents waiting for results are stored in `batch_markup/pending` by their
+    PDF path, chunk offsets, request files and the output mode of their
+    requests, the text is parsed again at ingest. Short patents are saved to
+    `json_binding_data` directly. Pending patents are never queued again.
+
+    Args:
+        patents: Iterable of Patent objects
+        checkpoints_folder: Folder to store checkpoints
+        continue_markup: Skip patents that already have a JSON checkpoint
+        max_requests_per_file: Max number of requests in a single JSONL file
+        model: Model name written to every request
+        output_mode: Markup output mode the requests are built with
+
+    Returns:
+        List of written request files
+    """
+    folders = get_batch_folders(checkpoints_folder)
+    first_index = next_request_index(folders)
+
+    request_files = []
+    f = None
+    n_requests = max_requests_per_file
+
+    try:
+        for patent in patents:
+            binding_file = Path(folders["binding"], f"{patent.name}.json")
+            pending_file = Path(folders["pending"], f"{patent.name}.json")
+            if pending_file.exists():
+                logger.info(f"Skipping {patent.name}, already pending.")
+                continue
+            if continue_markup and is_marked_up(folders["binding"], patent.name):
+                logger.info(f"Skipping {patent.name}, already marked up.")
+                continue
+
+            if patent.is_too_short or not patent.chunks:
+                logger.info(f"{patent.name} too short to process")
+                save_marked_up(binding_file, patent)
+                continue
+
+            patent_request_files = []
+            for indx, chunk in enumerate(patent.chunks):
+                if n_requests >= max_requests_per_file:
+                    if f is not None:
+                        f.close()
+                    request_file = Path(
+                        folders["requests"],
+                        f"requests_{first_index + len(request_files):05d}.jsonl",
+                    )
+                    request_files.append(request_file)
+                    f = open(request_file, "w")
+                    n_requests = 0
+                if request_files[-1].name not in patent_request_files:
+                    patent_request_files.append(request_files[-1].name)
+
+                request = {
+                    "custom_id": f"{patent.name}{CUSTOM_ID_SEP}{indx}",
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": build_markup_request(
+                        chunk.text, model=model, output_mode=output_mode
+                    ),
+                }
+                f.write(json.dumps(request) + "\n")
+                n_requests += 1
+
+            save_json(
+                pending_file,
+                {
+                    "name": patent.name,
+                    "local_path": str(patent.local_path),
+                    "chunks": [[chunk.start, chunk.end] for chunk in patent.chunks],
+                    "request_files": patent_request_files,
+                    "markup_output_mode": output_mode,
+                },
+            )
+    finally:
+        if f is not None:
+            f.close()
+        if USE_CORPUS_STORE:
+            get_corpus_store().commit()
+
+    logger.info(f"Prepared {len(request_files)} batch request files")
+    return request_files
+
+
+def run_local_batch(
+    request_file: Path, result_file: Path, runner: list[str], model: str = MODEL
+):
+    """Run a local offline runner that consumes a JSONL request file"""
+    cmd = [
+        arg.format(input=request_file, output=result_file, model=model)
+        for arg in runner
+    ]
+    logger.info(f"Running local batch: {' '.join(cmd)}")
+    subprocess.run(cmd, check=True)
+
+
+def run_remote_batch(
+    client: OpenAI,
+    request_file: Path,
+    result_file: Path,
+    state: dict[str, str],
+    state_file: Path,
+    poll_interval: int = BATCH_POLL_INTERVAL,
+    completion_window: str = BATCH_COMPLETION_WINDOW,
+):
+    """Submit request file to a batch endpoint, wait for it and download results"""
+    batch_id = state.get(request_file.name)
+    if batch_id is None:
+        with open(request_file, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=completion_window,
+        )
+        batch_id = batch.id
+        # Persist batch id so an interrupted run can resume polling
+        state[request_file.name] = batch_id
+        save_json(state_file, state)
+        logger.info(f"Submitted {request_file.name} as batch {batch_id}")
+
+    batch = client.batches.retrieve(batch_id)
+    while batch.status not in TERMINAL_BATCH_STATUSES:
+        logger.info(f"Batch {batch_id} status: {batch.status}")
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch_id)
+
+    # Expired batches keep the results finished in time, missing ones are
+    # queued again by the next prepare_markup_batch after ingest
+    if batch.status != "completed":
+        logger.warning(
+            f"Batch {batch_id} finished with status {batch.status}, "
+            + "ingesting its partial results"
+        )
+
+    lines = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            lines.append(client.files.content(file_id).text.rstrip("\n"))
+    with open(result_file, "w") as f:
+        f.write("\n".join(line for line in lines if line) + "\n")
+    logger.info(f"Downloaded results of batch {batch_id} to {result_file}")
+
+
+def submit_markup_batch(
+    checkpoints_folder: Path = CHECKPOINTS_FOLDER,
+    runner: list[str] | None = BATCH_LOCAL_RUNNER,
+    base_url: str = BASE_URL,
+    api_key: str = API_KEY,
+    model: str = MODEL,
+) -> list[Path]:
+    """
+    Run all request files that have no results yet
+
+    Uses local offline runner if provided, otherwise OpenAI-compatible batch API.
+
+    Returns:
+        List of result files
+    """
+    folders = get_batch_folders(checkpoints_folder)
+    state, state_file = load_batch_state(folders)
+    client = None if runner else OpenAI(base_url=base_url, api_key=api_key)
+
+    result_files = []
+    for request_file in sorted(folders["requests"].glob("*.jsonl")):
+        result_file = Path(folders["results"], request_file.name)
+        if result_file.exists():
+            logger.info(f"Skipping {request_file.name}, results already exist.")
+            result_files.append(result_file)
+            continue
+
+        try:
+            if runner:
+                run_local_batch(request_file, result_file, runner, model=model)
+            else:
+                run_remote_batch(client, request_file, result_file, state, state_file)
+        except Exception as e:
+            logger.warning(f"Failed to run batch {request_file.name}: {e}")
+            continue
+
+        if result_file.exists():
+            result_files.append(result_file)
+
+    return result_files
+
+
+def parse_batch_result(
+    line: dict[str, Any], output_mode: str = MARKUP_OUTPUT_MODE
+) -> Any:
+    """Get markup verdict from a single line of batch output"""
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        return {"error": str(line.get("error") or response.get("status_code"))}
+    try:
+        choice = response["body"]["choices"][0]
+        message = choice["message"]["content"]
+    except (KeyError, IndexError, TypeError) as e:
+        return {"error": f"Malformed batch response: {e}"}
+    return parse_markup_response(message, choice.get("logprobs"), output_mode)
+
+
+def drop_ingested_batches(folders: dict[str, Path], result_names: dict[Path, set]):
+    """
+    Delete result files, with their request files and batch ids, once none of
+    their patents is pending
+    """
+    state, state_file = load_batch_state(folders)
+    n_dropped = 0
+    for result_file, names in result_names.items():
+        if any(Path(folders["pending"], f"{name}.json").exists() for name in names):
+            continue
+        Path(folders["requests"], result_file.name).unlink(missing_ok=True)
+        result_file.unlink()
+        state.pop(result_file.name, None)
+        n_dropped += 1
+    if n_dropped:
+        save_json(state_file, state)
+        logger.info(f"Dropped {n_dropped} fully ingested batch files")
+
+
+def awaits_results(folders: dict[str, Path], request_files: list[str]) -> bool:
+    """Whether some of the request files are still waiting for their batch"""
+    return any(
+        Path(folders["requests"], name).exists()
+        and not Path(folders["results"], name).exists()
+        for name in request_files
+    )
+
+
+def load_pending_patent(data: dict[str, Any]) -> Patent | None:
+    """Parse the PDF of a pending patent again, None if it is gone or changed"""
+    try:
+        patent = parse_pdf_to_patent(Path(data["local_path"]))
+    except OSError as e:
+        logger.warning(f"Failed to read PDF of {data['name']}: {e}")
+        return None
+    offsets = [[chunk.start, chunk.end] for chunk in patent.chunks]
+    if offsets != data.get("chunks"):
+        return None
+    patent.chunks_with_binding_info = []
+    return patent
+
+
+def ingest_markup_batch(checkpoints_folder: Path = CHECKPOINTS_FOLDER) -> list[str]:
+    """
+    Apply batch results to pending patents and save them to json_binding_data
+
+    Patents are left pending until results for all their chunks are available.
+    Patents that will not get them, as their batches failed or expired, or
+    whose PDF no longer gives the same chunks, are dropped from pending, so
+    the next prepare_markup_batch queues them again. Result files are deleted
+    once none of their patents is pending.
+
+    Returns:
+        Names of saved patents
+    """
+    folders = get_batch_folders(checkpoints_folder)
+
+    # Raw lines, verdicts are parsed with the output mode of each pending patent
+    results: dict[str, dict[int, dict[str, Any]]] = {}
+    result_names: dict[Path, set[str]] = {}
+    for result_file in sorted(folders["results"].glob("*.jsonl")):
+        names = result_names.setdefault(result_file, set())
+        with open(result_file, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                name, indx = result["custom_id"].rsplit(CUSTOM_ID_SEP, 1)
+                results.setdefault(name, {})[int(indx)] = result
+                names.add(name)
+
+    saved_files = []
+    n_requeued = 0
+    for pending_file in sorted(folders["pending"].glob("*.json")):
+        data = read_json(pending_file)
+        name = data["name"]
+        patent_results = results.pop(name, {})
+        n_chunks = len(data.get("chunks", []))
+        if len(patent_results) < n_chunks:
+            if awaits_results(folders, data.get("request_files", [])):
+                logger.info(
+                    f"{name}: {len(patent_results)}/{n_chunks} results, still pending"
+                )
+                continue
+            logger.warning(
+                f"{name}: {len(patent_results)}/{n_chunks} results and no batch "
+                + "left to wait for, queueing it again"
+            )
+            pending_file.unlink()
+            n_requeued += 1
+            continue
+
+        patent = load_pending_patent(data)
+        if patent is None:
+            logger.warning(f"PDF of {name} changed since prepare, queueing it again")
+            pending_file.unlink()
+            n_requeued += 1
+            continue
+
+        output_mode = data.get("markup_output_mode", MARKUP_OUTPUT_MODE)
+        for indx, chunk in enumerate(patent.chunks):
+            res = parse_batch_result(patent_results[indx], output_mode)
+            if "error" not in res:
+                chunk.binding_confidence = res["confidence"]
+                if res["has_binding_info"]:
+                    patent.has_binding_info = True
+                    chunk.has_binding_info = True
+                    patent.chunks_with_binding_info.append(indx)
+            else:
+                logger.info(f"Markup failed for {patent.name}, chunk {indx}: {res}")
+
+        save_marked_up(Path(folders["binding"], f"{patent.name}.json"), patent)
+        saved_files.append((patent.name, pending_file))
+
+    # Pending patents are dropped only once they are committed
+    if USE_CORPUS_STORE:
+        get_corpus_store().commit()
+    for _, pending_file in saved_files:
+        pending_file.unlink()
+    drop_ingested_batches(folders, result_names)
+
+    logger.info(
+        f"Ingested batch results for {len(saved_files)} patents, "
+        + f"{n_requeued} to be queued again"
+    )
+    return [name for name, _ in saved_files]
@@ -1,17 +1,17 @@
 import asyncio
 import logging
 import argparse
+import os
 from pathlib import Path
 
+from dotenv import load_dotenv
+
 from config_logging import setup_logging
-from preprocessing import run_preprocessing, download_ftp_files
-from collect_patents import collect_pdf_links, download_patent_data
-from parse_pdfs import parse_pdfs
-from run_binding_markup import run_markup
-from run_binding_markup_async import run_markup_async
-from binding_data_processing import extract_patents_with_binding_data
-from agent_async import process_all_patents
+from loop_monitor import EventLoopLagMonitor
+from metrics import get_metrics
+from step_runner import FileHasher, Step, StepContext, StepRunner
 from utils import batch_list
+from work_queue import check_sharding_config, get_work_queue
 
 from config import (
     CHECKPOINTS_FOLDER,
@@ -30,129 +30,456 @@ from config import (
     N_RANDOM_PATENTS,
     CHUNKS,
     USE_PARALLEL,
+    USE_WORKER_POOL,
+    USE_BATCH_MARKUP,
+    USE_MARKUP_CASCADE,
+    USE_EXTRACTION_POOL,
+    EXTRACTION_MODE,
+    MULTI_RECORD_EXTRACTION,
+    RECONCILE_RESULTS,
+    USE_CORPUS_STORE,
     BATCH_SIZE,
     CONTINUE_MARKUP,
+    STEPS,
+    MANIFESTS_FOLDER,
+    INITIAL_PDF_CHUNK_SIZE,
+    CHUNK_OVERLAPS,
+    MIN_PDF_TEXT_LENGTH,
+    USE_COARSE_TO_FINE,
+    COARSE_TO_FINE_NEIGHBORS,
+    MARKUP_OUTPUT_MODE,
+    MARKUP_CONFIDENCE_THRESHOLD,
+    MARKUP_CASCADE_TIERS,
+    MERGE_POSITIVE_CHUNKS,
+    EXTRACTION_SPAN_SIZE,
+    USE_LOCAL_COMPOUND_INDEX,
+    SMILES_NETWORK_FALLBACK,
+    USE_LOCAL_PROTEIN_INDEX,
+    FASTA_NETWORK_FALLBACK,
+    RESULTS_DATASET_FOLDER,
+    RESULTS_DATASET_FORMAT,
+    RESULTS_DATASET_MAX_FILE_SIZE,
+    USE_WORK_QUEUE,
 )
 
+logger = logging.getLogger(__name__)
 
-async def main(start_from=None):
-    setup_logging()
-    logger = logging.getLogger(__name__)
-
-    def should_run(step_name):
-        if not start_from:
-            return True
-        return STEPS.index(step_name) >= STEPS.index(start_from)
-
-    # Step 1: Download ChEMBL
-    if should_run("download_chembl"):
-        if DOWNLOAD_CHEMBL:
-            logger.info("Downloading ChEMBL...")
-            download_res_ChEMBL = download_ftp_files(CHEMBL_URL, CHEMBL_FOLDER)
-            logger.info(download_res_ChEMBL)
-        else:
-            logger.info("Skipping ChEMBL download...")
-
-    # Step 2: Download SureChEMBL
-    if should_run("download_surechembl"):
-        if DOWNLOAD_SURE_CHEMBL:
-            logger.info("Downloading SureChEMBL...")
-            download_res_SureChEMBL = download_ftp_files(
-                SURE_CHEMBL_URL, SURE_CHEMBL_FOLDER
-            )
-            logger.info(download_res_SureChEMBL)
-        else:
-            logger.info("Skipping SureChEMBL download...")
-
-    # Step 3: Preprocessing
-    if should_run("preprocessing"):
-        logger.info("Starting preprocessing...")
-        run_preprocessing(
-            chunks=CHUNKS,
-            patent_compound_map_pq_file=PC_MAP_PQ,
-            compounds_pq_file=COMPOUNDS_PQ,
-            checkpoints=CHECKPOINTS_FOLDER,
-            patents_pq_file=PATENTS_PQ,
-            seed=SEED,
-            use_random_chunks=USE_RANDOM_CHUNKS,
-            n_random_chuncks=N_RANDOM_CHUNKS,
-            n_random_patents=N_RANDOM_PATENTS,
+load_dotenv()
+MODEL = os.getenv("MODEL")
+
+PREPROCESSED_TSV = Path(
+    CHECKPOINTS_FOLDER, "preprocessing", "comp_with_patent_info.tsv"
+)
+LINKS_TSV = Path(CHECKPOINTS_FOLDER, "pdf_links", "links_to_pdf.tsv")
+PDF_FOLDER = Path(CHECKPOINTS_FOLDER, "patent_pdfs")
+BINDING_FOLDER = Path(CHECKPOINTS_FOLDER, "json_binding_data")
+RESULTS_FOLDER = Path(CHECKPOINTS_FOLDER, "patent_results")
+
+
+# Modules of a step are imported when it runs, so the CLI starts fast and steps
+# that are skipped do not need their dependencies (LLM clients, pdftotext, ...)
+
+
+async def download_chembl(context: StepContext):
+    from preprocessing import download_ftp_files_async
+
+    if DOWNLOAD_CHEMBL:
+        logger.info("Downloading ChEMBL...")
+        download_res_ChEMBL = await download_ftp_files_async(CHEMBL_URL, CHEMBL_FOLDER)
+        logger.info(download_res_ChEMBL)
+    else:
+        logger.info("Skipping ChEMBL download...")
+
+
+async def download_surechembl(context: StepContext):
+    from preprocessing import download_ftp_files_async
+
+    if DOWNLOAD_SURE_CHEMBL:
+        logger.info("Downloading SureChEMBL...")
+        download_res_SureChEMBL = await download_ftp_files_async(
+            SURE_CHEMBL_URL, SURE_CHEMBL_FOLDER
         )
+        logger.info(download_res_SureChEMBL)
     else:
-        logger.info(
-            "Skipping downloading and preprocessing based on config or start_from..."
+        logger.info("Skipping SureChEMBL download...")
+
+
+async def preprocessing(context: StepContext):
+    from preprocessing import run_preprocessing
+
+    logger.info("Starting preprocessing...")
+    await asyncio.to_thread(
+        run_preprocessing,
+        chunks=CHUNKS,
+        patent_compound_map_pq_file=PC_MAP_PQ,
+        compounds_pq_file=COMPOUNDS_PQ,
+        checkpoints=CHECKPOINTS_FOLDER,
+        patents_pq_file=PATENTS_PQ,
+        seed=SEED,
+        use_random_chunks=USE_RANDOM_CHUNKS,
+        n_random_chuncks=N_RANDOM_CHUNKS,
+        n_random_patents=N_RANDOM_PATENTS,
+    )
+
+
+def is_found(link) -> bool:
+    return isinstance(link, str) and "error" not in link
+
+
+def preprocessed_patent_numbers(hasher: FileHasher) -> dict[str, str]:
+    """Patents of the preprocessing subset, a patent number is its own fingerprint"""
+    import pandas as pd
+
+    if not PREPROCESSED_TSV.exists():
+        return {}
+    df = pd.read_csv(PREPROCESSED_TSV, sep="\t", usecols=["patent_number"])
+    return {str(n): str(n) for n in df["patent_number"].unique()}
+
+
+async def collect_pdf_links(context: StepContext) -> list[str]:
+    from collect_patents import collect_pdf_links_async
+
+    logger.info("Collecting pdf links...")
+    links_to_pdf = await collect_pdf_links_async(
+        CHECKPOINTS_FOLDER,
+        patent_numbers=None if context.rerun_all else list(context.changed_items),
+    )
+    # Patents without a link are looked up again next time
+    return [
+        str(row.patent_number)
+        for row in links_to_pdf.itertuples()
+        if is_found(row.pdf_link)
+    ]
+
+
+def pdf_links(hasher: FileHasher) -> dict[str, str]:
+    """Patents with found PDF links, fingerprinted by the link"""
+    import pandas as pd
+
+    if not LINKS_TSV.exists():
+        return {}
+    df = pd.read_csv(LINKS_TSV, sep="\t")
+    return {
+        str(row.patent_number): row.pdf_link
+        for row in df.itertuples()
+        if is_found(row.pdf_link)
+    }
+
+
+async def download_patents(context: StepContext) -> list[str]:
+    import pandas as pd
+    from collect_patents import download_patent_data_async
+
+    logger.info("Downloading patents pdfs...")
+    links_to_pdf = pd.DataFrame(
+        list(context.changed_items.items()), columns=["patent_number", "pdf_link"]
+    )
+    statuses = await download_patent_data_async(links_to_pdf, CHECKPOINTS_FOLDER)
+    return [
+        str(row.patent_number)
+        for row in statuses.itertuples()
+        if row.download_status == "success"
+    ]
+
+
+def patent_pdfs(hasher: FileHasher) -> dict[str, str]:
+    """Downloaded PDFs by patent name, fingerprinted by content"""
+    return {path.stem: hasher.file_digest(path) for path in PDF_FOLDER.glob("*.pdf")}
+
+
+def pdfs_to_mark_up(context: StepContext) -> list[Path]:
+    from run_binding_markup_async import is_marked_up
+
+    pdf_files = []
+    for name in context.changed_items:
+        is_new = not context.rerun_all and name not in context.previous_items
+        # Patents marked up before their PDF was fingerprinted
+        if is_new and CONTINUE_MARKUP and is_marked_up(BINDING_FOLDER, name):
+            continue
+        pdf_files.append(Path(PDF_FOLDER, f"{name}.pdf"))
+    return pdf_files
+
+
+async def parse_and_markup(context: StepContext) -> list[str]:
+    from parse_pdfs import parse_pdfs, iter_parse_pdfs
+
+    logger.info("Processing pdfs and marking regions of interest...")
+    all_pdf_files = await asyncio.to_thread(pdfs_to_mark_up, context)
+
+    if USE_BATCH_MARKUP:
+        from run_binding_markup_batch import (
+            prepare_markup_batch,
+            submit_markup_batch,
+            ingest_markup_batch,
         )
 
-    # Step 4: Collect PDF links
-    if should_run("collect_pdf_links"):
-        logger.info("Collecting pdf links...")
-        links_to_pdf = collect_pdf_links(CHECKPOINTS_FOLDER)
-    else:
-        logger.info(
-            "Skipping patent PDF link collection based on config or start_from..."
+        logger.info(f"Preparing batch markup for {len(all_pdf_files)} PDFs")
+        # Already marked up new patents were left out by pdfs_to_mark_up
+        await asyncio.to_thread(
+            prepare_markup_batch,
+            patents=iter_parse_pdfs(all_pdf_files),
+            checkpoints_folder=CHECKPOINTS_FOLDER,
+            continue_markup=False,
         )
-        links_to_pdf = []
+        pending_folder = Path(CHECKPOINTS_FOLDER, "batch_markup", "pending")
+        was_pending = {path.stem for path in pending_folder.glob("*.json")}
+        await asyncio.to_thread(submit_markup_batch, CHECKPOINTS_FOLDER)
+        ingested = set(await asyncio.to_thread(ingest_markup_batch, CHECKPOINTS_FOLDER))
+        # Short patents are saved by prepare, patents still pending or dropped
+        # from pending to be queued again are not done
+        return [
+            name
+            for name in context.changed_items
+            if name in ingested or name not in was_pending
+        ]
+    elif USE_PARALLEL and USE_WORKER_POOL:
+        from run_binding_markup_async import run_markup_pool, ask_markup_verdict
+        from markup_cascade import ask_cascade_verdict, log_cascade_stats
 
-    # Step 5: Download patents
-    if should_run("download_patents"):
-        logger.info("Downloading patents pdfs...")
-        download_patent_data(links_to_pdf, CHECKPOINTS_FOLDER)
+        logger.info(f"Streaming {len(all_pdf_files)} PDFs through markup pool")
+        saved = await run_markup_pool(
+            patents=iter_parse_pdfs(all_pdf_files),
+            checkpoints_folder=CHECKPOINTS_FOLDER,
+            ask_verdict=(
+                ask_cascade_verdict if USE_MARKUP_CASCADE else ask_markup_verdict
+            ),
+        )
+        if USE_MARKUP_CASCADE:
+            log_cascade_stats()
+        return saved
     else:
-        logger.info("Skipping patent PDF downloading based on config or start_from...")
-
-    # Step 6: Parse and markup
-    if should_run("parse_and_markup"):
-        logger.info("Processing pdfs and marking regions of interest...")
-
-        pdf_dir = Path(CHECKPOINTS_FOLDER, "patent_pdfs")
-        all_pdf_files = list(pdf_dir.glob("*.pdf"))
+        from run_binding_markup import run_markup
+        from run_binding_markup_async import run_markup_async
 
         pdf_batches = list(batch_list(all_pdf_files, BATCH_SIZE))
         total_batches = len(pdf_batches)
+        saved = []
 
-        if USE_PARALLEL:
-            loop = asyncio.get_event_loop()
-
-        try:
-            for idx, batch in enumerate(pdf_batches, start=1):
-                logger.info(
-                    f"Processing batch {idx}/{total_batches} ({len(batch)} PDFs)"
-                )
+        for idx, batch in enumerate(pdf_batches, start=1):
+            logger.info(f"Processing batch {idx}/{total_batches} ({len(batch)} PDFs)")
 
-                patents_batch = parse_pdfs(batch)
-                logger.info(f"  Parsed {len(patents_batch)} patents")
+            patents_batch = parse_pdfs(batch)
+            logger.info(f"  Parsed {len(patents_batch)} patents")
 
-                logger.info(f"  Marking regions of interest for batch {idx}")
-                if not USE_PARALLEL:
-                    run_markup(
-                        patents=patents_batch, CHECKPOINTS_FOLDER=CHECKPOINTS_FOLDER
-                    )
-                else:
-                    await run_markup_async(
+            logger.info(f"  Marking regions of interest for batch {idx}")
+            if not USE_PARALLEL:
+                saved.extend(
+                    await asyncio.to_thread(
+                        run_markup,
                         patents=patents_batch,
                         checkpoints_folder=CHECKPOINTS_FOLDER,
-                        continue_markup=CONTINUE_MARKUP,
                     )
-        finally:
-            if USE_PARALLEL and loop.is_running():
-                pass  # Don't close the loop if it's still being used
-
-    if should_run("extract_patents_with_binding"):
-        logger.info("Extracting patents with binding data from jsons...")
-        patents_with_binding = extract_patents_with_binding_data(
-            Path(CHECKPOINTS_FOLDER, "json_binding_data")
+                )
+            else:
+                saved.extend(
+                    await run_markup_async(
+                        patents=patents_batch, checkpoints_folder=CHECKPOINTS_FOLDER
+                    )
+                )
+        return saved
+
+
+def marked_up_patents(hasher: FileHasher) -> dict[str, str]:
+    """Marked up patents, fingerprinted by the time of their markup or checkpoint"""
+    from markup_store import get_corpus_store
+
+    if USE_CORPUS_STORE:
+        store = get_corpus_store()
+        # Checkpoints written without the store are added once
+        store.index_json_checkpoints(BINDING_FOLDER)
+        return {name: str(time) for name, time in store.updated_at().items()}
+    return {
+        path.stem: hasher.file_digest(path) for path in BINDING_FOLDER.glob("*.json")
+    }
+
+
+def load_patents_with_binding(names: set[str]) -> list:
+    from markup_store import get_corpus_store
+    from binding_data_processing import extract_patents_with_binding_data
+
+    if USE_CORPUS_STORE:
+        store = get_corpus_store()
+        patents = [store.load_patent(name) for name in sorted(names)]
+        return [p for p in patents if p is not None and p.has_binding_info]
+    patents = extract_patents_with_binding_data(BINDING_FOLDER)
+    return [p for p in patents if p.name in names]
+
+
+async def extract_patents_with_binding(context: StepContext) -> list[str]:
+    from agent_async import (
+        process_all_patents,
+        process_all_patents_pool,
+        process_patent_chunk,
+    )
+    from structured_extraction import extract_chunk_structured, extract_chunk_records
+
+    logger.info("Loading positive chunks of marked up patents...")
+    names = set(context.changed_items)
+    patents_with_binding = await asyncio.to_thread(load_patents_with_binding, names)
+    logger.info(f"{len(patents_with_binding)} patents with binding data")
+
+    # Results of re-marked up patents without binding data now are dropped,
+    # the others are replaced once their new results are saved
+    without_binding = names - {patent.name for patent in patents_with_binding}
+    for name in without_binding:
+        Path(RESULTS_FOLDER, f"{name}.json").unlink(missing_ok=True)
+
+    if EXTRACTION_MODE != "structured":
+        extract_chunk = process_patent_chunk
+    elif MULTI_RECORD_EXTRACTION:
+        extract_chunk = extract_chunk_records
+    else:
+        extract_chunk = extract_chunk_structured
+    if USE_EXTRACTION_POOL:
+        extracted = await process_all_patents_pool(
+            patents_with_binding, extract_chunk=extract_chunk
+        )
+    else:
+        extracted = await process_all_patents(
+            patents_with_binding, extract_chunk=extract_chunk
         )
+    return [*without_binding, *extracted]
+
+
+async def finalize_results(context: StepContext):
+    from bulk_resolution import resolve_patent_results
+    from reconcile_results import reconcile_patent_results
+    from result_sink import export_patent_results
+
+    if EXTRACTION_MODE == "structured":
+        logger.info("Resolving ligand and protein names in bulk...")
+        await resolve_patent_results()
+    if RECONCILE_RESULTS:
+        logger.info("Reconciling extracted records...")
+        await asyncio.to_thread(reconcile_patent_results)
+
+    logger.info("Writing results dataset...")
+    n_records = await asyncio.to_thread(export_patent_results)
+    logger.info(f"Saved {n_records} records to results dataset")
+
 
-        logger.info(len(patents_with_binding))
-        results = await process_all_patents(patents_with_binding)  # This is now async
-        logger.warning(results)
+def build_steps() -> list[Step]:
+    """Pipeline steps in the order of STEPS"""
+    steps = [
+        Step(
+            name="download_chembl",
+            run=download_chembl,
+            outputs=[CHEMBL_FOLDER],
+            params={"enabled": DOWNLOAD_CHEMBL, "url": CHEMBL_URL},
+        ),
+        Step(
+            name="download_surechembl",
+            run=download_surechembl,
+            outputs=[SURE_CHEMBL_FOLDER],
+            params={"enabled": DOWNLOAD_SURE_CHEMBL, "url": SURE_CHEMBL_URL},
+        ),
+        Step(
+            name="preprocessing",
+            run=preprocessing,
+            inputs=[PC_MAP_PQ, COMPOUNDS_PQ, PATENTS_PQ],
+            outputs=[PREPROCESSED_TSV],
+            params={
+                "chunks": CHUNKS,
+                "seed": SEED,
+                "use_random_chunks": USE_RANDOM_CHUNKS,
+                "n_random_chunks": N_RANDOM_CHUNKS,
+                "n_random_patents": N_RANDOM_PATENTS,
+            },
+        ),
+        Step(
+            name="collect_pdf_links",
+            run=collect_pdf_links,
+            inputs=[PREPROCESSED_TSV],
+            outputs=[LINKS_TSV],
+            items=preprocessed_patent_numbers,
+        ),
+        Step(
+            name="download_patents",
+            run=download_patents,
+            inputs=[LINKS_TSV],
+            outputs=[PDF_FOLDER],
+            items=pdf_links,
+            sharded=True,
+        ),
+        Step(
+            name="parse_and_markup",
+            run=parse_and_markup,
+            inputs=[PDF_FOLDER],
+            outputs=[BINDING_FOLDER],
+            params={
+                "model": MODEL,
+                "chunk_size": INITIAL_PDF_CHUNK_SIZE,
+                "chunk_overlaps": CHUNK_OVERLAPS,
+                "min_text_length": MIN_PDF_TEXT_LENGTH,
+                "output_mode": MARKUP_OUTPUT_MODE,
+                "confidence_threshold": MARKUP_CONFIDENCE_THRESHOLD,
+                "coarse_to_fine": USE_COARSE_TO_FINE,
+                "coarse_to_fine_neighbors": COARSE_TO_FINE_NEIGHBORS,
+                "cascade_tiers": MARKUP_CASCADE_TIERS if USE_MARKUP_CASCADE else None,
+            },
+            items=patent_pdfs,
+            sharded=True,
+        ),
+        Step(
+            name="extract_patents_with_binding",
+            run=extract_patents_with_binding,
+            inputs=[BINDING_FOLDER],
+            outputs=[RESULTS_FOLDER],
+            params={
+                "model": MODEL,
+                "mode": EXTRACTION_MODE,
+                "multi_record": MULTI_RECORD_EXTRACTION,
+                "merge_positive_chunks": MERGE_POSITIVE_CHUNKS,
+                "span_size": EXTRACTION_SPAN_SIZE,
+            },
+            items=marked_up_patents,
+            sharded=True,
+        ),
+        Step(
+            name="finalize_results",
+            run=finalize_results,
+            inputs=[RESULTS_FOLDER],
+            outputs=[RESULTS_DATASET_FOLDER],
+            params={
+                "reconcile": RECONCILE_RESULTS,
+                "local_compound_index": USE_LOCAL_COMPOUND_INDEX,
+                "smiles_network_fallback": SMILES_NETWORK_FALLBACK,
+                "local_protein_index": USE_LOCAL_PROTEIN_INDEX,
+                "fasta_network_fallback": FASTA_NETWORK_FALLBACK,
+                "dataset_format": RESULTS_DATASET_FORMAT,
+                "dataset_max_file_size": RESULTS_DATASET_MAX_FILE_SIZE,
+            },
+        ),
+    ]
+    assert [step.name for step in steps] == STEPS, "Steps must match config STEPS"
+    return steps
 
+
+async def main(start_from=None, force=False):
+    setup_logging()
+    if USE_WORK_QUEUE:
+        check_sharding_config()
+
+    lag_monitor = EventLoopLagMonitor()
+    lag_monitor.start()
+
+    runner = StepRunner(
+        build_steps(),
+        MANIFESTS_FOLDER,
+        force=force,
+        work_queue=get_work_queue() if USE_WORK_QUEUE else None,
+    )
+    await runner.run(start_from=start_from)
+
+    from http_client import close_http_client
+
+    await close_http_client()
+    await lag_monitor.stop()
+    await asyncio.to_thread(get_metrics().export)
     logger.info("Finished parsing!")
 
 
 if __name__ == "__main__":
-    from config import STEPS
-
     parser = argparse.ArgumentParser(
         description="Run pipeline with optional start step."
     )
@@ -162,7 +489,13 @@ if __name__ == "__main__":
         choices=STEPS,
         help="Start execution from this step.",
     )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Rerun steps even if their inputs and parameters did not change.",
+    )
     args = parser.parse_args()
 
     # Run the async main function
-    asyncio.run(main(start_from=args.start_from))
+    asyncio.run(main(start_from=args.start_from, force=args.force))
@@ -0,0 +1,331 @@
+import asyncio
+import dataclasses
+import logging
+import argparse
+import shutil
+import signal
+import time
+from pathlib import Path
+from typing import Any
+
+from config_logging import setup_logging
+from loop_monitor import EventLoopLagMonitor
+from metrics import get_metrics
+from run_parser import PDF_FOLDER, build_steps
+from serialization import dumps, write_json
+from step_runner import Step, StepContext, StepRunner
+from work_queue import check_sharding_config, get_work_queue
+
+from config import (
+    MANIFESTS_FOLDER,
+    USE_WORK_QUEUE,
+    SERVICE_STEPS,
+    SERVICE_POLL_INTERVAL,
+    SERVICE_DROP_FOLDER,
+    SERVICE_HOST,
+    SERVICE_PORT,
+    SERVICE_STATUS_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+HTTP_REASONS = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class DropFolder:
+    """
+    Folder new PDFs are dropped into
+
+    A PDF is moved to patent_pdfs once its size did not change between two
+    polls, so files that are still being copied are left alone.
+    """
+
+    def __init__(self, folder: Path, pdf_folder: Path = PDF_FOLDER):
+        self.folder = Path(folder)
+        self.pdf_folder = pdf_folder
+        self._sizes: dict[Path, int] = {}
+
+    def collect(self) -> list[Path]:
+        """Move PDFs that are completely written, returns their new paths"""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.pdf_folder.mkdir(parents=True, exist_ok=True)
+        sizes = {path: path.stat().st_size for path in self.folder.glob("*.pdf")}
+        moved = []
+        for path, size in sizes.items():
+            if self._sizes.get(path) != size:
+                continue
+            target = Path(self.pdf_folder, path.name)
+            shutil.move(path, target)
+            moved.append(target)
+        self._sizes = {path: size for path, size in sizes.items() if path.exists()}
+        if moved:
+            logger.info(f"Collected {len(moved)} PDFs from {self.folder}")
+        return moved
+
+
+@dataclasses.dataclass
+class StepProgress:
+    """Last run of a step in the service"""
+
+    n_runs: int = 0
+    n_items: int = 0
+    n_done: int | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+
+
+class PatentService:
+    """
+    Long-running pipeline pushing new patents through parse, markup and extraction
+
+    Every `poll_interval` seconds dropped PDFs are collected and the service
+    steps run on one StepRunner. Steps are incremental, so only new or changed
+    patents are processed. LLM and HTTP clients, the corpus store, lookup
+    caches and local indexes are created once and stay warm between polls.
+    """
+
+    def __init__(
+        self,
+        step_names: list[str] = SERVICE_STEPS,
+        poll_interval: float = SERVICE_POLL_INTERVAL,
+        drop_folder: Path | None = SERVICE_DROP_FOLDER,
+        host: str = SERVICE_HOST,
+        port: int = SERVICE_PORT,
+        status_path: Path = SERVICE_STATUS_PATH,
+    ):
+        if USE_WORK_QUEUE:
+            check_sharding_config()
+        steps = [step for step in build_steps() if step.name in step_names]
+        self.runner = StepRunner(
+            [dataclasses.replace(step, run=self.tracked(step)) for step in steps],
+            MANIFESTS_FOLDER,
+            work_queue=get_work_queue() if USE_WORK_QUEUE else None,
+        )
+        self.poll_interval = poll_interval
+        self.drop_folder = None if drop_folder is None else DropFolder(drop_folder)
+        self.host = host
+        self.port = port
+        self.status_path = Path(status_path)
+        self.status_path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.started_at = time.time()
+        self.state = "starting"
+        self.current_step: str | None = None
+        self.n_polls = 0
+        self.n_collected = 0
+        self.last_poll_at: float | None = None
+        self.last_error: str | None = None
+        self.progress = {step.name: StepProgress() for step in steps}
+        self.lag_monitor = EventLoopLagMonitor()
+        self._stop = asyncio.Event()
+        self._wake = asyncio.Event()
+
+    def tracked(self, step: Step):
+        """Step run recording its progress"""
+
+        async def run(context: StepContext):
+            progress = self.progress[step.name]
+            progress.n_runs += 1
+            progress.n_items = len(context.changed_items)
+            progress.n_done = None
+            progress.started_at = time.time()
+            progress.error = None
+            self.current_step = step.name
+            try:
+                done = await step.run(context)
+                done = None if done is None else list(done)
+            except Exception as e:
+                progress.error = str(e)
+                raise
+            finally:
+                progress.finished_at = time.time()
+                self.current_step = None
+            progress.n_done = progress.n_items if done is None else len(done)
+            return done
+
+        return run
+
+    def status(self) -> dict[str, Any]:
+        lag = self.lag_monitor
+        return {
+            "state": self.state,
+            "current_step": self.current_step,
+            "started_at": self.started_at,
+            "uptime": time.time() - self.started_at,
+            "n_polls": self.n_polls,
+            "last_poll_at": self.last_poll_at,
+            "last_error": self.last_error,
+            "n_collected_pdfs": self.n_collected,
+            "steps": {
+                name: dataclasses.asdict(progress)
+                for name, progress in self.progress.items()
+            },
+            "event_loop": {
+                "max_lag": lag.max_lag,
+                "mean_lag": lag.total_lag / lag.n_samples if lag.n_samples else 0.0,
+                "n_stalls": lag.n_stalls,
+            },
+        }
+
+    def is_healthy(self) -> bool:
+        return self.state != "stopped" and self.last_error is None
+
+    async def write_status(self):
+        await asyncio.to_thread(write_json, self.status_path, self.status())
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        """Minimal HTTP endpoint: GET /health, GET /status and GET /metrics"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else "/"
+
+            content_type = "application/json"
+            body: str | dict[str, Any]
+            if path == "/metrics":
+                code, body = 200, get_metrics().render()
+                content_type = PROMETHEUS_CONTENT_TYPE
+            elif path == "/health":
+                healthy = self.is_healthy()
+                code = 200 if healthy else 503
+                body = {
+                    "status": "ok" if healthy else "error",
+                    "state": self.state,
+                    "last_error": self.last_error,
+                }
+            elif path in ("/", "/status"):
+                code, body = 200, self.status()
+            else:
+                code, body = 404, {"error": f"unknown path {path}"}
+
+            payload = body.encode() if isinstance(body, str) else dumps(body)
+            writer.write(
+                f"HTTP/1.1 {code} {HTTP_REASONS[code]}\r\n".encode("latin-1")
+                + f"Content-Type: {content_type}\r\n".encode("latin-1")
+                + f"Content-Length: {len(payload)}\r\n".encode("latin-1")
+                + b"Connection: close\r\n\r\n"
+                + payload
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Status request failed: {e}")
+        finally:
+            writer.close()
+
+    async def poll(self):
+        self.state = "running"
+        try:
+            if self.drop_folder is not None:
+                moved = await asyncio.to_thread(self.drop_folder.collect)
+                self.n_collected += len(moved)
+            await self.runner.run()
+            self.last_error = None
+        except Exception as e:
+            logger.exception(f"Service poll failed: {e}")
+            self.last_error = str(e)
+        finally:
+            self.n_polls += 1
+            self.last_poll_at = time.time()
+            self.state = "idle"
+        await self.write_status()
+        await asyncio.to_thread(self.write_metrics)
+
+    def write_metrics(self):
+        try:
+            get_metrics().write_textfile()
+        except OSError as e:
+            logger.warning(f"Failed to save metrics: {e}")
+
+    def stop(self):
+        logger.info("Stopping service...")
+        self._stop.set()
+
+    def wake(self):
+        """Poll right away, e.g. after PDFs were copied"""
+        self._wake.set()
+
+    async def run(self):
+        self.lag_monitor.start()
+        server = await asyncio.start_server(self.handle_request, self.host, self.port)
+        logger.info(f"Serving health and progress on http://{self.host}:{self.port}")
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        loop.add_signal_handler(signal.SIGHUP, self.wake)
+
+        try:
+            while not self._stop.is_set():
+                await self.poll()
+                self._wake.clear()
+                stop = asyncio.create_task(self._stop.wait())
+                wake = asyncio.create_task(self._wake.wait())
+                await asyncio.wait(
+                    [stop, wake],
+                    timeout=self.poll_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                stop.cancel()
+                wake.cancel()
+        finally:
+            server.close()
+            await server.wait_closed()
+            self.state = "stopped"
+            await self.write_status()
+
+            from http_client import close_http_client
+
+            await close_http_client()
+            await self.lag_monitor.stop()
+            await asyncio.to_thread(get_metrics().export)
+            logger.info(f"Service stopped after {self.n_polls} polls")
+
+
+async def main(poll_interval: float, drop_folder: Path | None, port: int):
+    setup_logging()
+    service = PatentService(
+        poll_interval=poll_interval, drop_folder=drop_folder, port=port
+    )
+    await service.run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Watch for new patent PDFs and process them continuously."
+    )
+    parser.add_argument(
+        "-i",
+        "--poll_interval",
+        type=float,
+        default=SERVICE_POLL_INTERVAL,
+        help="Seconds between polls, SIGHUP polls right away.",
+    )
+    parser.add_argument(
+        "-d",
+        "--drop_folder",
+        type=Path,
+        default=SERVICE_DROP_FOLDER,
+        help="Folder new PDFs are dropped into.",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=SERVICE_PORT,
+        help="Port of the /health and /status endpoint.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(
+        main(
+            poll_interval=args.poll_interval,
+            drop_folder=args.drop_folder,
+            port=args.port,
+        )
+    )
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+
+from config_logging import setup_logging
+from metrics import get_metrics
+from run_parser import (
+    PDF_FOLDER,
+    BINDING_FOLDER,
+    build_steps,
+    download_patents,
+)
+from step_runner import (
+    FileHasher,
+    Step,
+    StepContext,
+    task_fingerprint,
+    task_payload,
+)
+from utils import map_bounded
+from work_queue import (
+    WorkQueue,
+    check_sharding_config,
+    default_worker_id,
+    get_work_queue,
+)
+
+from config import (
+    DOWNLOAD_WORKERS,
+    MANIFESTS_FOLDER,
+    USE_CORPUS_STORE,
+    WORK_CLAIM_BATCH_SIZE,
+    WORK_POLL_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def download_links(context: StepContext) -> list[str]:
+    """
+    Download PDFs of the given patents
+
+    Unlike the download_patents step it does not rewrite the shared status file,
+    the work queue keeps statuses of sharded downloads.
+    """
+    from collect_patents import download_pdf_async
+
+    PDF_FOLDER.mkdir(exist_ok=True, parents=True)
+    numbers = list(context.changed_items)
+    statuses = await map_bounded(
+        lambda number: download_pdf_async(context.changed_items[number], PDF_FOLDER),
+        numbers,
+        DOWNLOAD_WORKERS,
+    )
+    return [number for number, status in zip(numbers, statuses) if status == "success"]
+
+
+def marked_up_fingerprints(names: list[str], hasher: FileHasher) -> dict[str, str]:
+    """Fingerprints of marked up patents, as in the extraction step items"""
+    from markup_store import get_corpus_store
+
+    if USE_CORPUS_STORE:
+        updated_at = get_corpus_store().updated_at()
+        return {name: str(updated_at[name]) for name in names if name in updated_at}
+    json_files = {name: Path(BINDING_FOLDER, f"{name}.json") for name in names}
+    return {
+        name: hasher.file_digest(json_file)
+        for name, json_file in json_files.items()
+        if json_file.exists()
+    }
+
+
+class ShardWorker:
+    """
+    Worker processing patents of sharded steps claimed from the work queue
+
+    Any number of workers, on one or several hosts, can run at once. Later
+    steps are claimed first, so patents flow through download, markup and
+    extraction instead of piling up between them. A finished patent queues
+    its task of the next step. A worker leaves once no task is pending or
+    leased by another worker.
+    """
+
+    def __init__(
+        self,
+        work_queue: WorkQueue,
+        worker_id: str,
+        batch_size: int = WORK_CLAIM_BATCH_SIZE,
+        poll_interval: float = WORK_POLL_INTERVAL,
+    ):
+        self.work_queue = work_queue
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.hasher = FileHasher(
+            Path(MANIFESTS_FOLDER, f"file_hashes_{worker_id}.json")
+        )
+        self.steps = [step for step in build_steps() if step.sharded]
+        self.n_done = 0
+        self.n_failed = 0
+
+    def next_step(self, step: Step) -> Step | None:
+        indx = self.steps.index(step)
+        return self.steps[indx + 1] if indx + 1 < len(self.steps) else None
+
+    def follow_ups(
+        self, step: Step, done: dict[str, str]
+    ) -> dict[str, tuple[str, str, str]]:
+        """Tasks of the next step for finished items"""
+        next_step = self.next_step(step)
+        if next_step is None:
+            return {}
+        if step.name == "download_patents":
+            next_fingerprints = {
+                item: (
+                    Path(link).stem,
+                    self.hasher.file_digest(Path(PDF_FOLDER, Path(link).name)),
+                )
+                for item, link in done.items()
+            }
+        else:
+            next_fingerprints = {
+                item: (item, fingerprint)
+                for item, fingerprint in marked_up_fingerprints(
+                    list(done), self.hasher
+                ).items()
+            }
+        return {
+            item: (next_step.name, next_item, task_payload(next_step, fingerprint))
+            for item, (next_item, fingerprint) in next_fingerprints.items()
+        }
+
+    async def keep_leases(self, step: Step, items: list[str]):
+        while True:
+            await asyncio.sleep(self.work_queue.lease_duration / 3)
+            await asyncio.to_thread(
+                self.work_queue.renew, step.name, items, self.worker_id
+            )
+
+    async def process(self, step: Step, claimed: dict[str, str]):
+        fingerprints = {
+            item: task_fingerprint(payload) for item, payload in claimed.items()
+        }
+        logger.info(f"{self.worker_id}: {step.name} for {len(claimed)} patents")
+        context = StepContext(changed_items=fingerprints, rerun_all=True)
+        run = download_links if step.run is download_patents else step.run
+
+        lease_keeper = asyncio.create_task(self.keep_leases(step, list(claimed)))
+        try:
+            done = await run(context)
+            done = set(fingerprints) if done is None else set(done)
+            error = "step did not finish the item"
+        except Exception as e:
+            logger.warning(f"{step.name} failed for {list(claimed)}: {e}")
+            done = set()
+            error = str(e)
+        finally:
+            lease_keeper.cancel()
+            await asyncio.gather(lease_keeper, return_exceptions=True)
+
+        follow_ups = await asyncio.to_thread(
+            self.follow_ups,
+            step,
+            {item: fingerprints[item] for item in done if item in fingerprints},
+        )
+        for item in fingerprints:
+            if item in done:
+                completed = await asyncio.to_thread(
+                    self.work_queue.complete,
+                    step.name,
+                    item,
+                    self.worker_id,
+                    follow_ups.get(item),
+                )
+                self.n_done += completed
+            else:
+                await asyncio.to_thread(
+                    self.work_queue.fail, step.name, item, self.worker_id, error
+                )
+                self.n_failed += 1
+        self.hasher.save()
+        await self.record_queue()
+
+    async def record_queue(self):
+        counts = await asyncio.to_thread(self.work_queue.counts)
+        tasks = get_metrics().gauge("work_queue_tasks", "Work queue tasks by status")
+        for stage, stage_counts in counts.items():
+            for status, n_tasks in stage_counts.items():
+                tasks.set(n_tasks, stage=stage, status=status)
+
+    async def claim(self) -> tuple[Step, dict[str, str]] | None:
+        for step in reversed(self.steps):
+            claimed = await asyncio.to_thread(
+                self.work_queue.claim, step.name, self.worker_id, self.batch_size
+            )
+            if claimed:
+                return step, claimed
+        return None
+
+    async def run(self):
+        while True:
+            claim = await self.claim()
+            if claim is not None:
+                await self.process(*claim)
+                continue
+            if await asyncio.to_thread(self.work_queue.is_drained):
+                break
+            # Other workers hold leases, their tasks may expire or queue new ones
+            await asyncio.sleep(self.poll_interval)
+        logger.info(
+            f"{self.worker_id}: work queue drained, {self.n_done} tasks done, "
+            + f"{self.n_failed} failed attempts"
+        )
+
+
+async def main(worker_id: str, batch_size: int = WORK_CLAIM_BATCH_SIZE):
+    setup_logging()
+    check_sharding_config()
+
+    work_queue = get_work_queue()
+    await ShardWorker(work_queue, worker_id, batch_size=batch_size).run()
+    for stage, counts in work_queue.counts().items():
+        logger.info(f"{stage}: {counts}")
+
+    from http_client import close_http_client
+
+    await close_http_client()
+    await asyncio.to_thread(get_metrics().export)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Process patents queued by run_parser with USE_WORK_QUEUE."
+    )
+    parser.add_argument(
+        "-w",
+        "--worker_id",
+        default=default_worker_id(),
+        help="Name of the worker holding leases, host:pid by default.",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=WORK_CLAIM_BATCH_SIZE,
+        help="Number of patents claimed at once.",
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(worker_id=args.worker_id, batch_size=args.batch_size))
@@ -0,0 +1,84 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Iterable
+
+from config import SERIALIZATION_WORKERS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(obj: Any) -> bytes:
+    """Compact UTF-8 JSON, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str)
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(",", ":"), default=str
+    ).encode("utf-8")
+
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def write_json(path: Path, obj: Any):
+    """Write JSON through a temporary file, so readers never see a partial file"""
+    tmp_path = Path(path).with_name(Path(path).name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(dumps(obj))
+    os.replace(tmp_path, path)
+
+
+def read_json(path: Path) -> Any:
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+@functools.lru_cache(maxsize=None)
+def get_serialization_pool() -> ThreadPoolExecutor:
+    """Shared worker pool encoding, decoding and writing JSON off the event loop"""
+    return ThreadPoolExecutor(
+        max_workers=SERIALIZATION_WORKERS, thread_name_prefix="serialization"
+    )
+
+
+async def write_json_async(path: Path, obj: Any):
+    """Encode and write JSON in the serialization pool"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_serialization_pool(), write_json, path, obj)
+
+
+async def read_json_async(path: Path) -> Any:
+    """Read and decode JSON in the serialization pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_serialization_pool(), read_json, path)
+
+
+def read_json_files(paths: Iterable[Path]) -> Iterable[tuple[Path, Any]]:
+    """
+    Read and decode JSON files in parallel
+
+    Returns:
+        Lazy iterable of (path, data or the exception raised while reading it),
+        in the order of paths
+    """
+
+    def read(path: Path) -> tuple[Path, Any]:
+        try:
+            return path, read_json(path)
+        except Exception as e:
+            return path, e
+
+    return get_serialization_pool().map(read, paths)
@@ -1,11 +1,18 @@
-import requests
+import httpx
 import logging
 from urllib.parse import quote
 
+from http_client import get_http_client, run_sync
+
 logger = logging.getLogger(__name__)
 
 
 def get_smiles_by_name(compound_name: str) -> str | dict[str, str]:
+    """Synchronous get_smiles_by_name_async, for scripts"""
+    return run_sync(get_smiles_by_name_async(compound_name))
+
+
+async def get_smiles_by_name_async(compound_name: str) -> str | dict[str, str]:
     """
     Fetches the Canonical SMILES string for a given compound name using the PubChem PUG REST API.
 
@@ -14,7 +21,8 @@ def get_smiles_by_name(compound_name: str) -> str | dict[str, str]:
 
     Returns:
         str: The Canonical SMILES string if found.
-        dict[str, str]: A dictionary containing an "error" key with the error message if not found or an error occurs.
+        dict[str, str]: A dictionary containing an "error" key with the error message if not found or an error occurs,
+            "not_found" is True if PubChem does not know the name.
     """
 
     encoded_name = quote(compound_name)
@@ -22,33 +30,31 @@ def get_smiles_by_name(compound_name: str) -> str | dict[str, str]:
 
     try:
         logger.info(f"Fetching SMILES for compound: {compound_name}")
-        r = requests.get(url)
+        r = await get_http_client().get(url)
+
+        if r.status_code == 404 or "NotFound" in r.text:
+            error_msg = f"Compound '{compound_name}' not found in PubChem."
+            logger.warning(error_msg)
+            return {"error": error_msg, "not_found": True}
 
-        if not r.ok:
+        if not r.is_success:
             raise RuntimeError(
                 f"Failed to fetch SMILES for '{compound_name}', HTTP status code: {r.status_code}"
             )
 
-        smiles = r.text.rstrip()
-
-        if "NotFound" in smiles:
-            error_msg = f"Compound '{compound_name}' not found in PubChem."
-            logger.warning(error_msg)
-            return {"error": error_msg}
-
+        # Several lines are returned for ambiguous names, take the best match
+        smiles = r.text.strip().split("\n")[0].strip()
+        if not smiles or not smiles.isascii():
+            raise ValueError(f"Malformed PubChem reply for '{compound_name}'")
         logger.info(f"Successfully fetched SMILES for {compound_name}")
         return smiles
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         error_msg = (
             f"Network error occurred while fetching SMILES for '{compound_name}': {e}"
         )
         logger.error(error_msg)
         return {"error": error_msg}
-    except RuntimeError as e:
-        logger.warning(e)
+    except (RuntimeError, ValueError, KeyError) as e:
+        logger.warning(f"Failed to fetch SMILES for '{compound_name}': {e}")
         return {"error": str(e)}
-    except Exception as e:
-        error_msg = f"An unexpected error occurred while fetching SMILES for '{compound_name}': {e}"
-        logger.error(error_msg)
-        return {"error": error_msg}
@@ -0,0 +1,339 @@
+import asyncio
+import dataclasses
+import hashlib
+import json
+import logging
+import time
+
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterable
+
+from metrics import get_metrics
+from serialization import read_json, write_json
+from work_queue import WorkQueue
+
+from config import METRICS_STEP_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+MISSING = "missing"
+
+
+@dataclasses.dataclass
+class StepContext:
+    """
+    What a step has to redo
+
+    Attributes:
+        changed_items: Items that are new or changed since the last run,
+            with their fingerprints, all items if `rerun_all`
+        previous_items: Fingerprints recorded by the last run
+        rerun_all: Step parameters changed or a rerun was forced,
+            items done before must be redone
+    """
+
+    changed_items: dict[str, str] = dataclasses.field(default_factory=dict)
+    previous_items: dict[str, str] = dataclasses.field(default_factory=dict)
+    rerun_all: bool = True
+
+
+@dataclasses.dataclass
+class Step:
+    """
+    Pipeline step with declared inputs, outputs and parameters
+
+    A step without `items` reruns when its parameters or the content of its
+    inputs changed, or one of its outputs is missing. A step with `items`
+    reruns only for items whose fingerprints changed, and for all items if
+    its parameters changed; its inputs only order it after their producers.
+    `run` returns the items it finished, None for all of them; unfinished
+    items are retried on the next run. Items of a `sharded` step are queued
+    for run_worker processes when the runner has a work queue.
+
+    Attributes:
+        name: Name of the step, one of STEPS
+        run: Coroutine function doing the work
+        inputs: Files and folders the step reads
+        outputs: Files and folders the step writes
+        params: Config values the outputs depend on
+        items: Function returning fingerprints of the step's items,
+            e.g. content hashes of PDFs from the given hasher
+        sharded: Items can be processed by sharded workers
+    """
+
+    name: str
+    run: Callable[[StepContext], Awaitable[Iterable[str] | None]]
+    inputs: list[Path] = dataclasses.field(default_factory=list)
+    outputs: list[Path] = dataclasses.field(default_factory=list)
+    params: dict[str, Any] = dataclasses.field(default_factory=dict)
+    items: Callable[["FileHasher"], dict[str, str]] | None = None
+    sharded: bool = False
+
+
+def params_digest(params: dict[str, Any]) -> str:
+    encoded = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def task_payload(step: Step, fingerprint: str) -> str:
+    """Work queue payload of an item, tasks are redone when parameters change"""
+    return f"{params_digest(step.params)}:{fingerprint}"
+
+
+def task_fingerprint(payload: str) -> str:
+    return payload.split(":", 1)[1]
+
+
+class FileHasher:
+    """
+    Content hashes of files and folders
+
+    Hashes are cached by path, size and modification time,
+    so unchanged files are not read again.
+    """
+
+    def __init__(self, cache_path: Path):
+        self.cache_path = Path(cache_path)
+        self._cache: dict[str, list] = (
+            read_json(self.cache_path) if self.cache_path.exists() else {}
+        )
+
+    def file_digest(self, path: Path) -> str:
+        stat = path.stat()
+        key = str(path.resolve())
+        cached = self._cache.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            while block := f.read(1024 * 1024):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self._cache[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def digest(self, path: Path) -> str:
+        """Hash of a file, of all files of a folder, or MISSING"""
+        path = Path(path)
+        if path.is_file():
+            return self.file_digest(path)
+        if not path.is_dir():
+            return MISSING
+
+        sha = hashlib.sha256()
+        for file_path in sorted(p for p in path.rglob("*") if p.is_file()):
+            sha.update(str(file_path.relative_to(path)).encode("utf-8"))
+            sha.update(self.file_digest(file_path).encode("ascii"))
+        return sha.hexdigest()
+
+    def save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_json(self.cache_path, self._cache)
+
+
+def record_items(step: Step, **results: int):
+    """Count processed items of a step by result, e.g. done=10, failed=2"""
+    items = get_metrics().counter("step_items_total", "Items processed by steps")
+    for result, n_items in results.items():
+        items.inc(n_items, step=step.name, result=result)
+
+
+def order_steps(steps: list[Step]) -> list[Step]:
+    """
+    Order steps so that every step runs after the steps producing its inputs
+
+    Ties keep the given order.
+
+    Raises:
+        ValueError: If steps depend on each other in a cycle
+    """
+    producers = [
+        (Path(output).resolve(), step.name) for step in steps for output in step.outputs
+    ]
+    # An output folder produces the files in it
+    dependencies = {
+        step.name: {
+            producer
+            for path in step.inputs
+            for output, producer in producers
+            if Path(path).resolve().is_relative_to(output)
+        }
+        - {step.name}
+        for step in steps
+    }
+
+    ordered: list[Step] = []
+    done: set[str] = set()
+    pending = list(steps)
+    while pending:
+        ready = next(
+            (step for step in pending if dependencies[step.name] <= done), None
+        )
+        if ready is None:
+            raise ValueError(
+                f"Steps depend on each other: {[step.name for step in pending]}"
+            )
+        ordered.append(ready)
+        done.add(ready.name)
+        pending.remove(ready)
+    return ordered
+
+
+class StepRunner:
+    """
+    Make-style runner of pipeline steps
+
+    Each step records a manifest of its parameters, input hashes and item
+    fingerprints in `manifests_folder`. A step is skipped if nothing it
+    depends on changed since its manifest was written.
+
+    With a `work_queue`, stale items of sharded steps are queued instead of
+    processed, items done by workers are recorded on the next run.
+    """
+
+    def __init__(
+        self,
+        steps: list[Step],
+        manifests_folder: Path,
+        force: bool = False,
+        work_queue: WorkQueue | None = None,
+    ):
+        self.steps = order_steps(steps)
+        self.manifests_folder = Path(manifests_folder)
+        self.manifests_folder.mkdir(parents=True, exist_ok=True)
+        self.force = force
+        self.work_queue = work_queue
+        self.hasher = FileHasher(Path(self.manifests_folder, "file_hashes.json"))
+
+    def manifest_path(self, step: Step) -> Path:
+        return Path(self.manifests_folder, f"{step.name}.json")
+
+    def load_manifest(self, step: Step) -> dict[str, Any] | None:
+        path = self.manifest_path(step)
+        return read_json(path) if path.exists() else None
+
+    def save_manifest(self, step: Step, manifest: dict[str, Any]):
+        write_json(self.manifest_path(step), {**manifest, "completed_at": time.time()})
+        self.hasher.save()
+
+    def hash_inputs(self, step: Step) -> dict[str, str]:
+        return {str(path): self.hasher.digest(path) for path in step.inputs}
+
+    async def run(self, start_from: str | None = None):
+        """Run stale steps, steps before `start_from` are skipped"""
+        names = [step.name for step in self.steps]
+        first = names.index(start_from) if start_from else 0
+        for step in self.steps[:first]:
+            logger.info(f"Skipping {step.name}, starting from {start_from}")
+        step_seconds = get_metrics().histogram(
+            "step_seconds", "Duration of pipeline steps", METRICS_STEP_BUCKETS
+        )
+        for step in self.steps[first:]:
+            with step_seconds.time(step=step.name):
+                if step.items is None:
+                    await self.run_step(step)
+                elif step.sharded and self.work_queue is not None:
+                    await self.queue_item_step(step)
+                else:
+                    await self.run_item_step(step)
+
+    async def run_step(self, step: Step):
+        manifest = self.load_manifest(step)
+        digest = params_digest(step.params)
+        inputs = await asyncio.to_thread(self.hash_inputs, step)
+
+        if (
+            not self.force
+            and manifest is not None
+            and manifest["params"] == digest
+            and manifest["inputs"] == inputs
+            and all(Path(path).exists() for path in step.outputs)
+        ):
+            logger.info(f"Skipping {step.name}, inputs and parameters are unchanged")
+            return
+
+        logger.info(f"Running {step.name}")
+        await step.run(StepContext())
+        # Steps may update their inputs in place, e.g. filling in resolved names
+        inputs = await asyncio.to_thread(self.hash_inputs, step)
+        self.save_manifest(step, {"params": digest, "inputs": inputs, "items": {}})
+
+    async def run_item_step(self, step: Step):
+        manifest = self.load_manifest(step)
+        digest = params_digest(step.params)
+        items = await asyncio.to_thread(step.items, self.hasher)
+        self.hasher.save()
+        if not items:
+            logger.info(f"Skipping {step.name}, no items to process")
+            return
+
+        rerun_all = self.force or (
+            manifest is not None and manifest["params"] != digest
+        )
+        previous = {} if manifest is None else manifest["items"]
+        if rerun_all:
+            changed = dict(items)
+        else:
+            changed = {
+                item: fingerprint
+                for item, fingerprint in items.items()
+                if previous.get(item) != fingerprint
+            }
+
+        if not changed:
+            logger.info(f"Skipping {step.name}, all {len(items)} items are up to date")
+            return
+
+        logger.info(f"Running {step.name} for {len(changed)}/{len(items)} items")
+        context = StepContext(
+            changed_items=changed, previous_items=previous, rerun_all=rerun_all
+        )
+        done = await step.run(context)
+        done = set(changed) if done is None else set(done) & set(changed)
+
+        kept = {} if rerun_all else previous
+        recorded = {
+            item: fingerprint
+            for item, fingerprint in items.items()
+            if item in done or (item not in changed and item in kept)
+        }
+        logger.info(f"{step.name}: {len(done)}/{len(changed)} items done")
+        record_items(step, done=len(done), failed=len(changed) - len(done))
+        self.save_manifest(step, {"params": digest, "inputs": {}, "items": recorded})
+
+    async def queue_item_step(self, step: Step):
+        """Record items done by workers and queue stale items for them"""
+        manifest = self.load_manifest(step)
+        digest = params_digest(step.params)
+        items = await asyncio.to_thread(step.items, self.hasher)
+        self.hasher.save()
+
+        previous = {}
+        if manifest is not None and manifest["params"] == digest:
+            previous = manifest["items"]
+        done = await asyncio.to_thread(self.work_queue.done_items, step.name)
+        recorded = {
+            item: fingerprint
+            for item, fingerprint in items.items()
+            if not self.force
+            and (
+                previous.get(item) == fingerprint
+                or done.get(item) == task_payload(step, fingerprint)
+            )
+        }
+        stale = {
+            item: task_payload(step, fingerprint)
+            for item, fingerprint in items.items()
+            if item not in recorded
+        }
+
+        n_queued = await asyncio.to_thread(
+            self.work_queue.enqueue, step.name, stale, self.force
+        )
+        logger.info(
+            f"{step.name}: {len(recorded)}/{len(items)} items done, "
+            + f"{len(stale)} stale items in the work queue ({n_queued} newly queued)"
+        )
+        record_items(step, queued=n_queued)
+        self.save_manifest(step, {"params": digest, "inputs": {}, "items": recorded})
@@ -0,0 +1,405 @@
+import asyncio
+import json
+import logging
+import random
+import time
+
+from typing import Any
+
+from openai import BadRequestError
+
+from metrics import acquire_timed, get_metrics, record_llm_call
+from run_binding_markup_async import (
+    BASE_URL,
+    API_KEY,
+    MODEL,
+    api_semaphore,
+    get_async_client,
+    parse_json_response,
+    rejects_output_mode,
+    unsupported_output_modes,
+)
+
+from config import EXTRACTION_MIN_SPLIT_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractionError(Exception):
+    """Extraction call of a chunk failed, its patent is retried on the next run"""
+
+
+extraction_system_prompt = "You are an expert cheminformatics and pharmacology data extractor. Your task is to analyze patent text and extract structured binding data."
+
+extraction_prompt = """
+You are given a part of a text from a patent {text}.
+
+INSTRUCTIONS:
+1. Identify ligand mentions (chemical names, references to chemical names (this can be 'example', 'compound', etc.))
+2. Determine the ligand name
+3. Determine protein name
+4. Extract binding constants: Ki, IC50, Kd, EC50 with their units and qualifiers
+5. Extract assay description
+
+RETURN ONLY A VALID JSON OBJECT with these keys:
+
+"Ki": "value with unit as written (e.g. '<10 nM', '1.2 μM') or null",
+"IC50": "value with unit as written or null",
+"Kd": "value with unit as written or null",
+"EC50": "value with unit as written or null",
+"assay_description": "brief description of how binding was measured",
+"ligand_name": "identified ligand name",
+"protein_name": "identified protein name"
+
+CRITICAL RULES:
+- Only extract values that are explicitly stated with units (nM, μM, etc.)
+- Copy values, units, ranges and qualifiers like < or ~ exactly as written, do not convert units
+- Be conservative - only report high confidence data
+- Use ligand and protein names exactly as written in the text
+- Return ONLY the JSON, no other text
+- DO NOT USE MARKDOWN
+"""
+
+records_extraction_prompt = """
+You are given a part of a text from a patent {text}.
+
+INSTRUCTIONS:
+1. Find every measurement of a ligand binding to a protein, tables usually list many of them
+2. For each measurement determine the ligand name (chemical name or reference like 'example 12', 'compound 3a')
+3. Determine protein name
+4. Extract binding constants: Ki, IC50, Kd, EC50 with their units and qualifiers
+5. Extract assay description
+6. Copy the exact piece of text the measurement comes from (e.g. a table row) as evidence
+
+RETURN ONLY A VALID JSON OBJECT with key "records" holding a list of objects with these keys:
+
+"Ki": "value with unit as written (e.g. '<10 nM', '1.2 μM') or null",
+"IC50": "value with unit as written or null",
+"Kd": "value with unit as written or null",
+"EC50": "value with unit as written or null",
+"assay_description": "brief description of how binding was measured",
+"ligand_name": "identified ligand name",
+"protein_name": "identified protein name",
+"evidence": "exact text of the fragment stating the value"
+
+CRITICAL RULES:
+- One object per ligand, protein and assay, return an empty list if there is no binding data
+- Only extract values that are explicitly stated with units (nM, μM, etc.)
+- Copy values, units, ranges and qualifiers like < or ~ exactly as written, do not convert units
+- Be conservative - only report high confidence data
+- Use ligand and protein names exactly as written in the text
+- Return ONLY the JSON, no other text
+- DO NOT USE MARKDOWN
+"""
+
+NULLABLE_STRING = {"type": ["string", "null"]}
+
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "Ki": NULLABLE_STRING,
+        "IC50": NULLABLE_STRING,
+        "Kd": NULLABLE_STRING,
+        "EC50": NULLABLE_STRING,
+        "assay_description": NULLABLE_STRING,
+        "ligand_name": NULLABLE_STRING,
+        "protein_name": NULLABLE_STRING,
+    },
+    "required": [
+        "Ki",
+        "IC50",
+        "Kd",
+        "EC50",
+        "assay_description",
+        "ligand_name",
+        "protein_name",
+    ],
+    "additionalProperties": False,
+}
+
+
+RECORDS_EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "records": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    **EXTRACTION_SCHEMA["properties"],
+                    "evidence": NULLABLE_STRING,
+                },
+                "required": [*EXTRACTION_SCHEMA["required"], "evidence"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["records"],
+    "additionalProperties": False,
+}
+
+
+def build_extraction_request(
+    text: str,
+    model: str = MODEL,
+    use_schema: bool = True,
+    multi_record: bool = False,
+) -> dict[str, Any]:
+    """Build chat completion request body to extract binding data from patent text"""
+    template = records_extraction_prompt if multi_record else extraction_prompt
+    request = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": extraction_system_prompt},
+            {"role": "user", "content": template.format(text=text)},
+        ],
+        "max_tokens": 4096,
+        "temperature": 0.0,
+    }
+    if use_schema:
+        request["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "binding_records" if multi_record else "binding_data",
+                "schema": (
+                    RECORDS_EXTRACTION_SCHEMA if multi_record else EXTRACTION_SCHEMA
+                ),
+                "strict": True,
+            },
+        }
+    return request
+
+
+def to_binding_record(data: dict[str, Any], raw_result: str) -> dict[str, Any]:
+    """Convert LLM output to the record format of agent extraction"""
+    return {
+        "Ki (nM)": data.get("Ki"),
+        "IC50 (nM)": data.get("IC50"),
+        "Kd (nM)": data.get("Kd"),
+        "EC50 (nM)": data.get("EC50"),
+        "assay": data.get("assay_description", ""),
+        "ligand_name": data.get("ligand_name"),
+        "ligand_SMILES": None,
+        "protein_name": data.get("protein_name"),
+        "protein_FASTA": None,
+        "raw_result": raw_result,
+    }
+
+
+def find_evidence(chunk_text: str, evidence: str | None) -> tuple[int, int] | None:
+    """Character offsets of the evidence quote in chunk text, None if not found"""
+    if not evidence:
+        return None
+    start = chunk_text.find(evidence.strip())
+    if start == -1:
+        return None
+    return start, start + len(evidence.strip())
+
+
+async def request_extraction(
+    chunk_text: str,
+    patent_name: str | None = None,
+    multi_record: bool = False,
+    base_url: str = BASE_URL,
+    api_key: str = API_KEY,
+    model: str = MODEL,
+    n_retries_response: int = 3,
+) -> tuple[str, str | None] | None:
+    """
+    Send a single extraction request for a chunk
+
+    Falls back to a plain json prompt if the backend rejects
+    json-schema constrained decoding.
+
+    Returns:
+        Raw LLM answer and its finish reason, or None on failure
+    """
+    client = get_async_client(base_url, api_key)
+    use_schema = (base_url, "schema") not in unsupported_output_modes
+
+    attempt = 0
+    async with acquire_timed(api_semaphore, "extraction"):
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await client.chat.completions.create(
+                    **build_extraction_request(
+                        chunk_text, model, use_schema, multi_record
+                    )
+                )
+                record_llm_call("extraction", started, "ok", response.usage)
+                break
+            except BadRequestError as e:
+                record_llm_call("extraction", started, "bad_request")
+                if not use_schema or not rejects_output_mode(e, "schema"):
+                    logger.warning(f"Extraction request rejected for {patent_name}: {e}")
+                    return None
+                logger.warning(
+                    f"Json schema rejected by {base_url}, falling back to json: {e}"
+                )
+                unsupported_output_modes.add((base_url, "schema"))
+                use_schema = False
+            except Exception as e:
+                record_llm_call("extraction", started, "error")
+                attempt += 1
+                logger.info(f"Attempt {attempt} failed: {e}")
+                if attempt > n_retries_response:
+                    logger.warning(f"Error processing chunk of {patent_name}: {e}")
+                    return None
+                get_metrics().counter("llm_retries_total", "Retried LLM requests").inc(
+                    api="extraction"
+                )
+                await asyncio.sleep(random.uniform(2, 3))
+
+    choice = response.choices[0]
+    return choice.message.content or "", choice.finish_reason
+
+
+async def extract_chunk_structured(
+    chunk_text: str, patent_name: str | None = None, **kwargs: Any
+) -> dict[str, Any]:
+    """
+    Extract a binding record from a chunk with a single LLM call
+
+    Ligand SMILES and protein FASTA are left empty, they are filled
+    by the bulk resolution stage.
+
+    Returns:
+        Binding record as from agent extraction
+
+    Raises:
+        ExtractionError: The LLM request failed
+    """
+    answer = await request_extraction(chunk_text, patent_name, **kwargs)
+    if answer is None:
+        raise ExtractionError(f"Extraction request failed for {patent_name}")
+    result, finish_reason = answer
+    if finish_reason == "length":
+        record_truncated("dropped")
+
+    data = parse_json_response(result.strip().strip("`"))
+    if not isinstance(data, dict) or "error" in data:
+        logger.warning(f"JSON parsing error processing chunk of {patent_name}: {data}")
+        return to_binding_record({}, result)
+
+    logger.info(f"Result {json.dumps(data, ensure_ascii=False)}")
+    return to_binding_record(data, result)
+
+
+def record_truncated(action: str):
+    get_metrics().counter(
+        "extraction_truncated_total", "Extraction answers cut off at the token limit"
+    ).inc(action=action)
+
+
+def split_text(text: str) -> tuple[str, str]:
+    """Split text in halves at the line break closest to the middle"""
+    middle = len(text) // 2
+    before, after = text.rfind("\n", 0, middle), text.find("\n", middle)
+    candidates = [pos for pos in (before, after) if 0 < pos < len(text) - 1]
+    if not candidates:
+        return text[:middle], text[middle:]
+    split_at = min(candidates, key=lambda pos: abs(pos - middle))
+    return text[:split_at], text[split_at + 1 :]
+
+
+def salvage_records(result: str) -> list[Any]:
+    """Complete records of a records answer cut off at the token limit"""
+    start = result.find("[")
+    if start == -1:
+        return []
+    decoder = json.JSONDecoder()
+    items = []
+    pos = start + 1
+    while True:
+        while pos < len(result) and result[pos] in " \t\r\n,":
+            pos += 1
+        try:
+            item, pos = decoder.raw_decode(result, pos)
+        except json.JSONDecodeError:
+            return items
+        items.append(item)
+
+
+async def request_records(
+    text: str, patent_name: str | None = None, **kwargs: Any
+) -> list[Any] | None:
+    """
+    Record items of the LLM answer for text
+
+    An answer cut off at the token limit loses every record when parsed as a
+    whole. Text of such an answer is split in halves and extracted again,
+    text too short to split keeps the complete records of the answer.
+
+    Returns:
+        Items of the answer, None on failure
+    """
+    answer = await request_extraction(text, patent_name, multi_record=True, **kwargs)
+    if answer is None:
+        return None
+    result, finish_reason = answer
+
+    if finish_reason == "length":
+        if len(text) >= 2 * EXTRACTION_MIN_SPLIT_SIZE:
+            record_truncated("split")
+            logger.warning(
+                f"Records of {patent_name} hit the token limit, "
+                + f"splitting {len(text)} symbols in halves"
+            )
+            halves = await asyncio.gather(
+                *[
+                    request_records(half, patent_name, **kwargs)
+                    for half in split_text(text)
+                ]
+            )
+            if all(items is None for items in halves):
+                return None
+            return [item for items in halves if items for item in items]
+
+        items = salvage_records(result)
+        record_truncated("salvaged" if items else "dropped")
+        logger.warning(
+            f"Records of {patent_name} hit the token limit, "
+            + f"kept {len(items)} complete records"
+        )
+        return items
+
+    data = parse_json_response(result.strip().strip("`"))
+    if isinstance(data, dict) and isinstance(data.get("records"), list):
+        return data["records"]
+    if isinstance(data, list):
+        return data
+    logger.warning(f"JSON parsing error processing chunk of {patent_name}: {data}")
+    return None
+
+
+async def extract_chunk_records(
+    chunk_text: str, patent_name: str | None = None, **kwargs: Any
+) -> list[dict[str, Any]]:
+    """
+    Extract all binding records from a chunk, usually with a single LLM call
+
+    Every record keeps the quoted evidence and, if the quote is found in
+    the chunk, its character offsets relative to the chunk start.
+
+    Returns:
+        List of binding records
+
+    Raises:
+        ExtractionError: The LLM request failed or its answer could not be parsed
+    """
+    items = await request_records(chunk_text, patent_name, **kwargs)
+    if items is None:
+        raise ExtractionError(f"Records extraction failed for {patent_name}")
+
+    records = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        record = to_binding_record(item, json.dumps(item, ensure_ascii=False))
+        record["evidence"] = item.get("evidence")
+        record["evidence_offsets"] = find_evidence(chunk_text, item.get("evidence"))
+        records.append(record)
+
+    logger.info(f"Extracted {len(records)} records from chunk of {patent_name}")
+    return records
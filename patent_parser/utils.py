@@ -1,7 +1,35 @@
-from typing import Any
+import asyncio
+
+from typing import Any, Awaitable, Callable, Iterable
 
 
 def batch_list(lst: list[Any], batch_size: int):
     """Split a list into batches of fixed size."""
     for i in range(0, len(lst), batch_size):
         yield lst[i : i + batch_size]
+
+
+async def map_bounded(
+    func: Callable[[Any], Awaitable[Any]], items: Iterable[Any], n_workers: int
+) -> list[Any]:
+    """
+    Await func for every item with at most n_workers calls in flight
+
+    Unlike gathering all calls at once, only n_workers tasks exist however many
+    items there are. Results are in the order of items.
+    """
+    items = list(items)
+    results: list[Any] = [None] * len(items)
+    pending = iter(enumerate(items))
+
+    async def worker():
+        for indx, item in pending:
+            results[indx] = await func(item)
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(n_workers, len(items)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+    return results
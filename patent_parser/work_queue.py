@@ -0,0 +1,347 @@
+import functools
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from pathlib import Path
+
+from config import (
+    WORK_QUEUE_PATH,
+    WORK_LEASE_DURATION,
+    WORK_MAX_ATTEMPTS,
+    USE_BATCH_MARKUP,
+    USE_CORPUS_STORE,
+)
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Shared queue of per-patent tasks, claimed by workers under time-limited leases
+
+    Tasks are (stage, item) pairs, e.g. ("parse_and_markup", patent name),
+    with a payload such as a link or a fingerprint. A worker claims tasks for
+    `lease_duration` seconds and renews the lease while it works. Tasks of
+    workers that died or stalled are re-queued once their lease expires, and
+    marked failed after `max_attempts` claims.
+
+    Only the worker holding a lease can complete a task, so every task is
+    completed, and its follow-up task queued, exactly once. Work of a worker
+    whose lease expired is redone by another one, stage outputs are per
+    patent and are overwritten.
+
+    The queue is a SQLite file with a rollback journal, so it can be shared by
+    processes on several hosts through a filesystem with working locks.
+    """
+
+    def __init__(
+        self,
+        path: Path = WORK_QUEUE_PATH,
+        lease_duration: float = WORK_LEASE_DURATION,
+        max_attempts: int = WORK_MAX_ATTEMPTS,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+
+        self._lock = threading.Lock()
+        # Transactions are explicit, claims must lock the database before reading
+        self._conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tasks (
+                    stage TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    worker TEXT,
+                    lease_expires_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (stage, item)
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (stage, status)"
+            )
+
+    def _transaction(self):
+        """Write transaction taken before any read, serializing all workers"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        return self._conn
+
+    def _enqueue(
+        self, stage: str, items: dict[str, str], now: float, requeue: bool = False
+    ) -> int:
+        n_queued = 0
+        for item, payload in items.items():
+            cursor = self._conn.execute(
+                """
+                INSERT INTO tasks (stage, item, payload, status, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (stage, item) DO UPDATE SET
+                    payload = excluded.payload,
+                    status = excluded.status,
+                    worker = NULL,
+                    lease_expires_at = NULL,
+                    attempts = 0,
+                    error = NULL,
+                    updated_at = excluded.updated_at
+                WHERE ? OR tasks.payload != excluded.payload
+                """,
+                (stage, item, payload, PENDING, now, requeue),
+            )
+            n_queued += cursor.rowcount
+        return n_queued
+
+    def enqueue(self, stage: str, items: dict[str, str], requeue: bool = False) -> int:
+        """
+        Queue tasks of a stage
+
+        Tasks already queued with the same payload are kept as they are,
+        tasks with a changed payload, or all tasks with `requeue`, are queued again.
+
+        Returns:
+            Number of new or re-queued tasks
+        """
+        with self._lock:
+            conn = self._transaction()
+            try:
+                n_queued = self._enqueue(stage, items, time.time(), requeue)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return n_queued
+
+    def _requeue_expired(self, now: float):
+        self._conn.execute(
+            """
+            UPDATE tasks SET
+                status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                error = 'lease of ' || worker || ' expired',
+                worker = NULL,
+                lease_expires_at = NULL,
+                updated_at = ?
+            WHERE status = ? AND lease_expires_at < ?
+            """,
+            (self.max_attempts, FAILED, PENDING, now, LEASED, now),
+        )
+
+    def claim(self, stage: str, worker: str, limit: int) -> dict[str, str]:
+        """
+        Lease up to `limit` pending tasks of a stage, expired leases are re-queued
+
+        Returns:
+            Payloads of claimed items
+        """
+        with self._lock:
+            conn = self._transaction()
+            try:
+                now = time.time()
+                self._requeue_expired(now)
+                rows = conn.execute(
+                    """
+                    SELECT item, payload FROM tasks
+                    WHERE stage = ? AND status = ?
+                    ORDER BY updated_at, item LIMIT ?
+                    """,
+                    (stage, PENDING, limit),
+                ).fetchall()
+                conn.executemany(
+                    """
+                    UPDATE tasks SET status = ?, worker = ?, lease_expires_at = ?,
+                        attempts = attempts + 1, updated_at = ?
+                    WHERE stage = ? AND item = ?
+                    """,
+                    [
+                        (LEASED, worker, now + self.lease_duration, now, stage, item)
+                        for item, _ in rows
+                    ],
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return dict(rows)
+
+    def renew(self, stage: str, items: list[str], worker: str) -> int:
+        """
+        Extend leases the worker still holds
+
+        Returns:
+            Number of renewed leases
+        """
+        with self._lock:
+            conn = self._transaction()
+            try:
+                now = time.time()
+                n_renewed = 0
+                for item in items:
+                    cursor = conn.execute(
+                        """
+                        UPDATE tasks SET lease_expires_at = ?
+                        WHERE stage = ? AND item = ? AND status = ? AND worker = ?
+                        """,
+                        (now + self.lease_duration, stage, item, LEASED, worker),
+                    )
+                    n_renewed += cursor.rowcount
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return n_renewed
+
+    def complete(
+        self,
+        stage: str,
+        item: str,
+        worker: str,
+        follow_up: tuple[str, str, str] | None = None,
+    ) -> bool:
+        """
+        Mark a leased task done and queue its follow-up task in one transaction
+
+        Args:
+            stage: Stage of the task
+            item: Item of the task
+            worker: Worker holding the lease
+            follow_up: (stage, item, payload) of the task of the next stage
+
+        Returns:
+            False if the worker lost the lease, the task is then left to its
+            new owner
+        """
+        with self._lock:
+            conn = self._transaction()
+            try:
+                now = time.time()
+                cursor = conn.execute(
+                    """
+                    UPDATE tasks SET status = ?, lease_expires_at = NULL,
+                        error = NULL, updated_at = ?
+                    WHERE stage = ? AND item = ? AND status = ? AND worker = ?
+                    """,
+                    (DONE, now, stage, item, LEASED, worker),
+                )
+                completed = cursor.rowcount == 1
+                if completed and follow_up is not None:
+                    next_stage, next_item, next_payload = follow_up
+                    self._enqueue(next_stage, {next_item: next_payload}, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        if not completed:
+            logger.warning(f"Lost lease of {stage} task {item}, result is dropped")
+        return completed
+
+    def fail(self, stage: str, item: str, worker: str, error: str) -> bool:
+        """
+        Release a leased task after an error, it is retried until `max_attempts`
+
+        Returns:
+            False if the worker lost the lease
+        """
+        with self._lock:
+            conn = self._transaction()
+            try:
+                cursor = conn.execute(
+                    """
+                    UPDATE tasks SET
+                        status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+                        worker = NULL, lease_expires_at = NULL, error = ?,
+                        updated_at = ?
+                    WHERE stage = ? AND item = ? AND status = ? AND worker = ?
+                    """,
+                    (
+                        self.max_attempts,
+                        FAILED,
+                        PENDING,
+                        error,
+                        time.time(),
+                        stage,
+                        item,
+                        LEASED,
+                        worker,
+                    ),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount == 1
+
+    def counts(self) -> dict[str, dict[str, int]]:
+        """Number of tasks of every stage by status"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, status, COUNT(*) FROM tasks GROUP BY stage, status"
+            ).fetchall()
+        counts: dict[str, dict[str, int]] = {}
+        for stage, status, n in rows:
+            counts.setdefault(stage, {})[status] = n
+        return counts
+
+    def done_items(self, stage: str) -> dict[str, str]:
+        """Payloads of done tasks of a stage"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT item, payload FROM tasks WHERE stage = ? AND status = ?",
+                (stage, DONE),
+            ).fetchall()
+        return dict(rows)
+
+    def is_drained(self) -> bool:
+        """No task is pending or leased"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM tasks WHERE status IN (?, ?) LIMIT 1", (PENDING, LEASED)
+            ).fetchone()
+        return row is None
+
+
+def check_sharding_config(
+    use_corpus_store: bool = USE_CORPUS_STORE,
+    use_batch_markup: bool = USE_BATCH_MARKUP,
+):
+    """
+    Fail before queueing work no run_worker process would take
+
+    Raises:
+        ValueError: Config is not supported by sharded workers
+    """
+    if use_batch_markup:
+        raise ValueError("Batch markup runs through the batch API, not sharded workers")
+    if use_corpus_store:
+        raise ValueError(
+            "Sharded workers need USE_CORPUS_STORE = False, "
+            + "the SQLite corpus store cannot be shared between hosts"
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_work_queue() -> WorkQueue:
+    """Shared work queue, opened on first use"""
+    queue = WorkQueue()
+    logger.info(f"Using work queue {queue.path}")
+    return queue
@@ -0,0 +1,91 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PARSER_DIR = Path(__file__).resolve().parents[1] / "patent_parser"
+
+# Dependencies only the steps using them should load
+HEAVY_MODULES = [
+    "langchain",
+    "openai",
+    "pandas",
+    "pyarrow",
+    "bs4",
+    "pdftotext",
+    "httpx",
+]
+
+CASES = {
+    "import run_parser": [sys.executable, "-c", "import run_parser"],
+    "import run_worker": [sys.executable, "-c", "import run_worker"],
+    "run_parser --help": [sys.executable, "run_parser.py", "--help"],
+}
+
+
+def time_command(cmd, repeats):
+    """Wall times of fresh interpreters running cmd"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=PARSER_DIR, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def loaded_heavy_modules(module):
+    """Heavy dependencies imported as a side effect of importing module"""
+    code = (
+        "import json, sys\n"
+        f"import {module}\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=PARSER_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(res.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure CLI startup time of patent_parser.")
+    parser.add_argument("--repeats", type=int, default=5, help="Runs per case")
+    parser.add_argument(
+        "--max_seconds",
+        type=float,
+        default=None,
+        help="Fail if the median startup time of any case is above this",
+    )
+    parser.add_argument("--output", default=None, help="Append results as a JSON line to this file")
+    args = parser.parse_args()
+
+    baseline = statistics.median(time_command([sys.executable, "-c", "pass"], args.repeats))
+    print(f"{'bare interpreter':20s}: {baseline:.3f} s")
+
+    results = {"timestamp": time.time(), "python": sys.version.split()[0], "cases": {}}
+    failed = False
+    for name, cmd in CASES.items():
+        median = statistics.median(time_command(cmd, args.repeats))
+        results["cases"][name] = median
+        print(f"{name:20s}: {median:.3f} s ({median - baseline:+.3f} s over bare interpreter)")
+        if args.max_seconds is not None and median > args.max_seconds:
+            failed = True
+
+    for module in ("run_parser", "run_worker"):
+        heavy = loaded_heavy_modules(module)
+        results[f"{module} heavy modules"] = heavy
+        print(f"Heavy modules loaded by {module}: {', '.join(heavy) or 'none'}")
+        if heavy:
+            failed = True
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(results) + "\n")
+
+    sys.exit(1 if failed else 0)
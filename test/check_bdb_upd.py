@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 import argparse
+import sys
+from pathlib import Path
 from rdkit import Chem
 from tqdm import tqdm
 from rdkit.Chem import rdchem
@@ -8,6 +10,9 @@ from rdkit.Chem.MolStandardize import rdMolStandardize
 from rdkit.Chem.rdchem import BondType as BT
 from typing import Optional
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "patent_parser"))
+from affinity_normalization import normalize_affinity
+
 def standardize(smiles):
     # follows the steps in
     # https://github.com/greglandrum/RSC_OpenScience_Standardization_202104/blob/main/MolStandardize%20pieces.ipynb
@@ -80,9 +85,29 @@ def standardize_and_validate_smiles(smiles: str) -> Optional[str]:
     except ValueError:
         return None
 
+def read_test_data(path: str, columns: list[str]) -> pd.DataFrame:
+    """Read test records from a CSV file or a parquet / jsonl results dataset of patent_parser"""
+    path = Path(path)
+    if path.is_dir():
+        if any(path.glob("*.parquet")):
+            return pd.read_parquet(path, columns=columns)
+        path_list = sorted(path.glob("*.jsonl"))
+    elif path.suffix == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+    elif path.suffix == ".jsonl":
+        path_list = [path]
+    else:
+        return pd.read_csv(path, usecols=columns, dtype=str)
+
+    return pd.concat(
+        [pd.read_json(p, lines=True, dtype=False)[columns] for p in path_list],
+        ignore_index=True,
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Evaluate test data against BindingDB dataset.')
-    parser.add_argument('--test_csv', help='Path to test CSV file', required=True)
+    parser.add_argument('--test_csv', help='Path to test CSV file or patent_parser results dataset (folder, .parquet or .jsonl)', required=True)
     parser.add_argument('--mol_representation_filter', default='smiles', choices=['smiles', 'InChI_key'],
                         help='Which molecular representation to use for identifying unique ligand-target pairs (default: smiles)')
     args = parser.parse_args()
@@ -96,12 +121,12 @@ if __name__ == "__main__":
         ], dtype=str
     )
 
-    test = pd.read_csv(
+    test = read_test_data(
         args.test_csv,
-        usecols=[
+        columns=[
             "Ligand SMILES", "Ligand InChI Key", "Sequence",
             "Ki (nM)", "IC50 (nM)", "Kd (nM)", "EC50 (nM)"
-        ], dtype=str
+        ]
     )
 
     if args.mol_representation_filter == 'smiles':
@@ -125,8 +150,8 @@ if __name__ == "__main__":
     )
 
     for c in aff_cols:
-        merged[f"{c}_patents"] = pd.to_numeric(merged[f"{c}_patents"].astype(str).str.strip(' <>~'), errors='coerce')
-        merged[f"{c}_bdb"] = pd.to_numeric(merged[f"{c}_bdb"].astype(str).str.strip(' <>~'), errors='coerce')
+        merged[f"{c}_patents"] = normalize_affinity(merged[f"{c}_patents"])["value_nM"]
+        merged[f"{c}_bdb"] = normalize_affinity(merged[f"{c}_bdb"])["value_nM"]
 
     corr_values = []
     corr = {}
@@ -0,0 +1,68 @@
+import math
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "patent_parser"))
+from affinity_normalization import normalize_affinity
+
+# raw value, value_nM, qualifier, low_nM, high_nM
+CASES = [
+    ("10 nM", 10.0, "=", None, None),
+    ("10nM", 10.0, "=", None, None),
+    ("7.5", 7.5, "=", None, None),
+    ("<10", 10.0, "<", None, None),
+    (">= 1,000 nM", 1000.0, ">=", None, None),
+    ("≤ 0.1 uM", 100.0, "<=", None, None),
+    ("~3", 3.0, "~", None, None),
+    ("1.2 μM", 1200.0, "=", None, None),
+    ("1.2 µM", 1200.0, "=", None, None),
+    ("500 pM", 0.5, "=", None, None),
+    ("0.5 mM", 5e5, "=", None, None),
+    ("1 M", 1e9, "=", None, None),
+    ("1.2e-3 µM", 1.2, "=", None, None),
+    ("2.5 x 10^-7 M", 250.0, "=", None, None),
+    ("5 ± 2 nM", 5.0, "=", None, None),
+    ("1,5 µM", 1500.0, "=", None, None),
+    ("5-10", math.sqrt(50), "range", 5.0, 10.0),
+    ("5 to 10 µM", math.sqrt(5e3 * 1e4), "range", 5e3, 1e4),
+    ("5 µM - 10 nM", math.sqrt(10 * 5e3), "range", 10.0, 5e3),
+    ("-5", None, None, None, None),
+    ("abc", None, None, None, None),
+    (None, None, None, None, None),
+]
+
+
+def assert_close(actual, expected):
+    if expected is None:
+        assert math.isnan(actual)
+    else:
+        assert actual == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("raw, value, qualifier, low, high", CASES)
+def test_normalize_affinity(raw, value, qualifier, low, high):
+    # Parsed together with other values, as a column of results is
+    values = pd.Series(["10 nM", raw, "abc"], dtype=object)
+    row = normalize_affinity(values).iloc[1]
+
+    assert_close(row["value_nM"], value)
+    assert row["qualifier"] == qualifier
+    assert_close(row["low_nM"], low)
+    assert_close(row["high_nM"], high)
+
+
+def test_keeps_index_and_repeated_values():
+    values = pd.Series(["<10", "1 µM", "<10", None], index=[7, 3, 5, 1], dtype=object)
+    result = normalize_affinity(values)
+
+    assert list(result.index) == [7, 3, 5, 1]
+    assert list(result["value_nM"][:3]) == [10.0, 1000.0, 10.0]
+    assert list(result["qualifier"]) == ["<", "=", "<", None]
+
+
+def test_default_unit():
+    result = normalize_affinity(pd.Series(["2", "2 nM"]), default_unit="µM")
+    assert list(result["value_nM"]) == [2000.0, 2.0]
@@ -0,0 +1,131 @@
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "patent_parser"))
+import reconcile_results
+from reconcile_results import reconcile_records
+
+
+def make_record(chunk_index, ligand="compound 1", protein="EGFR"):
+    record = {
+        "ligand_name": ligand,
+        "ligand_SMILES": None,
+        "protein_name": protein,
+        "protein_FASTA": None,
+        "Ki (nM)": None,
+        "IC50 (nM)": None,
+        "Kd (nM)": None,
+        "EC50 (nM)": None,
+        "chunk_index": chunk_index,
+        "char_start": chunk_index * 100,
+        "char_end": chunk_index * 100 + 10,
+    }
+    return record
+
+
+def with_constant(record, column, value):
+    record[column] = value
+    return record
+
+
+def test_duplicates_are_merged_with_mentions():
+    first = with_constant(make_record(0), "IC50 (nM)", "10")
+    second = with_constant(make_record(3), "IC50 (nM)", "10")
+    # Same structure under different names
+    first["ligand_SMILES"] = second["ligand_SMILES"] = "CCO"
+    second["ligand_name"] = "Compound-1"
+
+    reconciled, stats = reconcile_records([first, second])
+
+    assert len(reconciled) == 1
+    record = reconciled[0]
+    assert [mention["chunk_index"] for mention in record["mentions"]] == [0, 3]
+    assert record["mentions"][1] == {
+        "chunk_index": 3,
+        "char_start": 300,
+        "char_end": 310,
+    }
+    assert record["conflicts"] == []
+    assert stats == {"records": 2, "empty": 0, "reconciled": 1, "conflicting": 0}
+
+
+def test_merged_record_fills_missing_fields():
+    first = with_constant(make_record(0), "Ki (nM)", "5")
+    second = with_constant(make_record(1), "Ki (nM)", "5")
+    first["assay"] = None
+    second["assay"] = "binding"
+
+    reconciled, _ = reconcile_records([first, second])
+
+    assert len(reconciled) == 1
+    assert reconciled[0]["assay"] == "binding"
+
+
+def test_values_are_compared_after_normalization():
+    first = with_constant(make_record(0), "IC50 (nM)", "<0.01 µM")
+    second = with_constant(make_record(1), "IC50 (nM)", "< 10 nM")
+    third = with_constant(make_record(2), "IC50 (nM)", "10")
+
+    reconciled, stats = reconcile_records([first, second, third])
+
+    assert len(reconciled) == 2
+    assert len(reconciled[0]["mentions"]) == 2
+    # "<10" and "10" are different values of the same pair
+    assert all(record["conflicts"] == ["IC50 (nM)"] for record in reconciled)
+    assert stats["conflicting"] == 2
+
+
+def test_different_pairs_do_not_conflict():
+    first = with_constant(make_record(0, ligand="compound 1"), "Ki (nM)", "5")
+    second = with_constant(make_record(1, ligand="compound 2"), "Ki (nM)", "50")
+
+    reconciled, stats = reconcile_records([first, second])
+
+    assert len(reconciled) == 2
+    assert all(record["conflicts"] == [] for record in reconciled)
+    assert stats["conflicting"] == 0
+
+
+def test_records_without_constants_are_dropped():
+    empty = make_record(0)
+    null = with_constant(make_record(1), "Kd (nM)", "n/a")
+    kept = with_constant(make_record(2), "Kd (nM)", "3 nM")
+
+    reconciled, stats = reconcile_records([empty, null, kept])
+
+    assert [record["chunk_index"] for record in reconciled] == [2]
+    assert stats == {"records": 3, "empty": 2, "reconciled": 1, "conflicting": 0}
+
+
+def test_reconciliation_is_stable():
+    records = [
+        with_constant(make_record(0), "EC50 (nM)", "1 µM"),
+        with_constant(make_record(1), "EC50 (nM)", "1000"),
+        with_constant(make_record(2), "EC50 (nM)", "2000"),
+    ]
+
+    reconciled, _ = reconcile_records(records)
+    again, _ = reconcile_records(reconciled)
+
+    assert again == reconciled
+
+
+def test_patent_results_are_reconciled_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(reconcile_results, "CHECKPOINTS_FOLDER", str(tmp_path))
+    output_path = tmp_path / "patent_results"
+    output_path.mkdir()
+    records = [
+        with_constant(make_record(0), "Ki (nM)", "5"),
+        with_constant(make_record(1), "Ki (nM)", "5 nM"),
+    ]
+    (output_path / "P-1.json").write_text(json.dumps(records))
+    (output_path / "P-2.json").write_text(json.dumps([make_record(0)]))
+
+    totals = reconcile_results.reconcile_patent_results()
+
+    assert totals == {"records": 3, "empty": 1, "reconciled": 1, "conflicting": 0}
+    saved = json.loads((output_path / "P-1.json").read_text())
+    assert len(saved) == 1
+    assert len(saved[0]["mentions"]) == 2
+    assert json.loads((output_path / "P-2.json").read_text()) == []
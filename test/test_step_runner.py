@@ -0,0 +1,153 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "patent_parser"))
+from step_runner import Step, StepRunner
+
+
+class FakeStep:
+    """Item step with fingerprints and results set by the test"""
+
+    def __init__(self, items: dict[str, str]):
+        self.items = items
+        self.failing: set[str] = set()
+        self.return_none = False
+        self.contexts = []
+
+    async def run(self, context):
+        self.contexts.append(context)
+        if self.return_none:
+            return None
+        return [item for item in context.changed_items if item not in self.failing]
+
+    def step(self, **params) -> Step:
+        return Step(
+            name="extract",
+            run=self.run,
+            params=params,
+            items=lambda hasher: dict(self.items),
+        )
+
+
+def run_step(tmp_path, step: Step, force: bool = False):
+    runner = StepRunner([step], tmp_path / "manifests", force=force)
+    asyncio.run(runner.run())
+    return runner.load_manifest(step)
+
+
+def test_only_done_items_are_recorded(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b", "P-3": "c"})
+    fake.failing = {"P-2"}
+
+    manifest = run_step(tmp_path, fake.step())
+    assert manifest["items"] == {"P-1": "a", "P-3": "c"}
+
+    # Failed item is retried alone and recorded once it is done
+    fake.failing = set()
+    manifest = run_step(tmp_path, fake.step())
+    assert fake.contexts[-1].changed_items == {"P-2": "b"}
+    assert not fake.contexts[-1].rerun_all
+    assert manifest["items"] == {"P-1": "a", "P-2": "b", "P-3": "c"}
+
+    # Nothing left to do
+    run_step(tmp_path, fake.step())
+    assert len(fake.contexts) == 2
+
+
+def test_none_means_all_items_done(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b"})
+    fake.return_none = True
+
+    manifest = run_step(tmp_path, fake.step())
+    assert manifest["items"] == {"P-1": "a", "P-2": "b"}
+
+
+def test_changed_fingerprint_reruns_only_that_item(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b"})
+    run_step(tmp_path, fake.step())
+
+    fake.items = {"P-1": "a", "P-2": "changed", "P-3": "c"}
+    manifest = run_step(tmp_path, fake.step())
+
+    context = fake.contexts[-1]
+    assert context.changed_items == {"P-2": "changed", "P-3": "c"}
+    assert context.previous_items == {"P-1": "a", "P-2": "b"}
+    assert manifest["items"] == {"P-1": "a", "P-2": "changed", "P-3": "c"}
+
+
+def test_changed_item_that_fails_is_retried(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b"})
+    run_step(tmp_path, fake.step())
+
+    fake.items = {"P-1": "a", "P-2": "changed"}
+    fake.failing = {"P-2"}
+    manifest = run_step(tmp_path, fake.step())
+
+    # Old fingerprint is not kept, the stale result must not count as done
+    assert manifest["items"] == {"P-1": "a"}
+    fake.failing = set()
+    run_step(tmp_path, fake.step())
+    assert fake.contexts[-1].changed_items == {"P-2": "changed"}
+
+
+def test_removed_items_are_dropped(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b"})
+    run_step(tmp_path, fake.step())
+
+    fake.items = {"P-1": "a", "P-3": "c"}
+    manifest = run_step(tmp_path, fake.step())
+    assert manifest["items"] == {"P-1": "a", "P-3": "c"}
+
+
+def test_params_change_reruns_all_items(tmp_path):
+    fake = FakeStep({"P-1": "a", "P-2": "b"})
+    run_step(tmp_path, fake.step(model="small"))
+
+    fake.failing = {"P-1"}
+    manifest = run_step(tmp_path, fake.step(model="large"))
+
+    context = fake.contexts[-1]
+    assert context.rerun_all
+    assert context.changed_items == {"P-1": "a", "P-2": "b"}
+    # Results of the old parameters no longer count
+    assert manifest["items"] == {"P-2": "b"}
+
+    fake.failing = set()
+    run_step(tmp_path, fake.step(model="large"))
+    assert fake.contexts[-1].changed_items == {"P-1": "a"}
+    assert not fake.contexts[-1].rerun_all
+
+
+def test_force_reruns_all_items(tmp_path):
+    fake = FakeStep({"P-1": "a"})
+    run_step(tmp_path, fake.step())
+    run_step(tmp_path, fake.step(), force=True)
+
+    assert len(fake.contexts) == 2
+    assert fake.contexts[-1].rerun_all
+
+
+def test_file_step_reruns_for_changed_input_or_missing_output(tmp_path):
+    source = tmp_path / "source.tsv"
+    output = tmp_path / "output.tsv"
+    source.write_text("a")
+    runs = []
+
+    async def run(context):
+        runs.append(context)
+        output.write_text(source.read_text())
+
+    step = Step(name="convert", run=run, inputs=[source], outputs=[output])
+    run_step(tmp_path, step)
+    run_step(tmp_path, step)
+    assert len(runs) == 1
+
+    # Hashes are cached by size and modification time, the size changes too
+    source.write_text("bb")
+    run_step(tmp_path, step)
+    assert len(runs) == 2
+
+    output.unlink()
+    run_step(tmp_path, step)
+    assert len(runs) == 3
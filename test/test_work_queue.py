@@ -0,0 +1,129 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "patent_parser"))
+import work_queue
+from work_queue import DONE, FAILED, LEASED, PENDING, WorkQueue, check_sharding_config
+
+LEASE = 60.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time seen by the queue, advanced by the test"""
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(work_queue, "time", SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return WorkQueue(tmp_path / "queue.sqlite", lease_duration=LEASE, max_attempts=2)
+
+
+def test_claimed_tasks_are_leased_once(queue):
+    assert queue.enqueue("parse", {"P-1": "a", "P-2": "b"}) == 2
+
+    assert queue.claim("parse", "w1", limit=1) == {"P-1": "a"}
+    assert queue.claim("parse", "w2", limit=5) == {"P-2": "b"}
+    assert queue.claim("parse", "w3", limit=5) == {}
+    assert queue.counts() == {"parse": {LEASED: 2}}
+
+
+def test_only_lease_holder_completes(queue):
+    queue.enqueue("parse", {"P-1": "a"})
+    queue.claim("parse", "w1", limit=1)
+
+    assert not queue.complete("parse", "P-1", "w2")
+    assert not queue.fail("parse", "P-1", "w2", "error")
+    assert queue.complete("parse", "P-1", "w1")
+    assert queue.done_items("parse") == {"P-1": "a"}
+    # Completing twice is refused as well
+    assert not queue.complete("parse", "P-1", "w1")
+    assert queue.is_drained()
+
+
+def test_expired_lease_is_taken_over(queue, clock):
+    queue.enqueue("parse", {"P-1": "a"})
+    queue.claim("parse", "w1", limit=1)
+
+    clock.value += LEASE / 2
+    assert queue.claim("parse", "w2", limit=1) == {}
+
+    clock.value += LEASE
+    assert queue.claim("parse", "w2", limit=1) == {"P-1": "a"}
+    # Late result of the first worker is dropped
+    assert not queue.complete("parse", "P-1", "w1")
+    assert queue.complete("parse", "P-1", "w2")
+    assert queue.counts() == {"parse": {DONE: 1}}
+
+
+def test_renewed_lease_does_not_expire(queue, clock):
+    queue.enqueue("parse", {"P-1": "a"})
+    queue.claim("parse", "w1", limit=1)
+
+    clock.value += LEASE * 0.9
+    assert queue.renew("parse", ["P-1"], "w1") == 1
+    assert queue.renew("parse", ["P-1"], "w2") == 0
+    clock.value += LEASE * 0.9
+
+    assert queue.claim("parse", "w2", limit=1) == {}
+    assert queue.complete("parse", "P-1", "w1")
+
+
+def test_task_fails_after_max_attempts(queue, clock):
+    queue.enqueue("parse", {"P-1": "a", "P-2": "b"})
+
+    # P-1 is abandoned twice, P-2 fails twice
+    for worker in ("w1", "w2"):
+        assert queue.claim("parse", worker, limit=2) == {"P-1": "a", "P-2": "b"}
+        assert queue.fail("parse", "P-2", worker, "bad pdf")
+        clock.value += LEASE * 2
+
+    assert queue.claim("parse", "w3", limit=2) == {}
+    assert queue.counts() == {"parse": {FAILED: 2}}
+    assert queue.is_drained()
+
+
+def test_changed_payload_is_requeued(queue):
+    queue.enqueue("parse", {"P-1": "a", "P-2": "b"})
+    for item in queue.claim("parse", "w1", limit=2):
+        queue.complete("parse", item, "w1")
+
+    assert queue.enqueue("parse", {"P-1": "a", "P-2": "changed"}) == 1
+    assert queue.claim("parse", "w1", limit=2) == {"P-2": "changed"}
+    assert queue.enqueue("parse", {"P-1": "a"}, requeue=True) == 1
+    assert queue.claim("parse", "w1", limit=2) == {"P-1": "a"}
+
+
+def test_completion_queues_follow_up(queue):
+    queue.enqueue("parse", {"P-1": "a"})
+    queue.claim("parse", "w1", limit=1)
+
+    assert not queue.complete("parse", "P-1", "w2", follow_up=("markup", "P-1", "x"))
+    assert queue.claim("markup", "w1", limit=1) == {}
+
+    assert queue.complete("parse", "P-1", "w1", follow_up=("markup", "P-1", "x"))
+    assert queue.claim("markup", "w1", limit=1) == {"P-1": "x"}
+    assert queue.counts() == {"parse": {DONE: 1}, "markup": {LEASED: 1}}
+
+
+def test_queue_is_shared_between_connections(queue, tmp_path):
+    other = WorkQueue(tmp_path / "queue.sqlite", lease_duration=LEASE)
+    queue.enqueue("parse", {"P-1": "a"})
+
+    assert other.claim("parse", "w2", limit=1) == {"P-1": "a"}
+    assert queue.claim("parse", "w1", limit=1) == {}
+    assert queue.counts() == {"parse": {LEASED: 1}}
+    assert PENDING not in other.counts()["parse"]
+
+
+def test_sharding_config_is_checked():
+    check_sharding_config(use_corpus_store=False, use_batch_markup=False)
+    with pytest.raises(ValueError):
+        check_sharding_config(use_corpus_store=True, use_batch_markup=False)
+    with pytest.raises(ValueError):
+        check_sharding_config(use_corpus_store=False, use_batch_markup=True)